@@ -4,11 +4,15 @@ import os
 import signal
 import sys
 
+from bot.session_store import flush_session_store
 from channel import channel_factory
+from common import token_counter
 from common.log import logger
 from config import conf, load_config
 from plugins import *
 
+running_channel = None  # 当前运行的通道，退出时等待其处理中的消息完成
+
 
 def sigterm_handler_wrap(_signo):
     old_handler = signal.getsignal(_signo)
@@ -16,6 +20,9 @@ def sigterm_handler_wrap(_signo):
     def func(_signo, _stack_frame):
         logger.info("signal {} received, exiting...".format(_signo))
         conf().save_user_datas()
+        if hasattr(running_channel, "drain"):
+            running_channel.drain(conf().get("shutdown_drain_timeout", 10))
+        flush_session_store(5)
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
         sys.exit(0)
@@ -24,9 +31,13 @@ def sigterm_handler_wrap(_signo):
 
 
 def run():
+    global running_channel
     try:
         # load config
         load_config()
+        # 预加载对话模型的tiktoken编码器
+        if conf().get("tiktoken_warm_up", True):
+            token_counter.warm_up(conf().get("model") or "gpt-3.5-turbo")
         # ctrl + c
         sigterm_handler_wrap(signal.SIGINT)
         # kill signal
@@ -43,6 +54,7 @@ def run():
             # os.environ['WECHATY_PUPPET_SERVICE_ENDPOINT'] = '127.0.0.1:9001'
 
         channel = channel_factory.create_channel(channel_name)
+        running_channel = channel
         if channel_name in ["wx", "wxy", "terminal", "wechatmp", "wechatmp_service", "wechatcom_app"]:
             PluginManager().load_plugins()
 
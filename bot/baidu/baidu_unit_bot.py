@@ -1,9 +1,8 @@
 # encoding:utf-8
 
-import requests
-
 from bot.bot import Bot
 from bridge.reply import Reply, ReplyType
+from common.http_client import get_http_client
 
 
 # Baidu Unit对话接口 (可用, 但能力较弱)
@@ -18,7 +17,7 @@ class BaiduUnitBot(Bot):
         )
         print(post_data)
         headers = {"content-type": "application/x-www-form-urlencoded"}
-        response = requests.post(url, data=post_data.encode(), headers=headers)
+        response = get_http_client().post(url, data=post_data.encode(), headers=headers)
         if response:
             reply = Reply(
                 ReplyType.TEXT,
@@ -30,7 +29,7 @@ class BaiduUnitBot(Bot):
         access_key = "YOUR_ACCESS_KEY"
         secret_key = "YOUR_SECRET_KEY"
         host = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id=" + access_key + "&client_secret=" + secret_key
-        response = requests.get(host)
+        response = get_http_client().get(host)
         if response:
             print(response.json())
             return response.json()["access_token"]
@@ -2,9 +2,29 @@
 Auto-replay chat robot abstract class
 """
 
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from bridge.context import Context
 from bridge.reply import Reply
+from config import conf
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_bot_executor() -> ThreadPoolExecutor:
+    """
+    async_handler模式下bot执行阻塞步骤的线程池，按async_handler_bot_workers设置大小
+    不使用事件循环默认的线程池，避免其较小的线程数限制同时处理的消息数
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=conf().get("async_handler_bot_workers", 32), thread_name_prefix="bot")
+    return _executor
 
 
 class Bot(object):
@@ -15,3 +35,17 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def reply_async(self, query, context: Context = None) -> Reply:
+        """
+        bot auto-reply content in coroutine, used by the async handler of ChatChannel
+        bots without native async support run reply() in the bot executor
+        :param req: received message
+        :return: reply content
+        """
+        return await self.run_blocking(self.reply, query, context)
+
+    async def run_blocking(self, func, *args):
+        """在bot的线程池中执行阻塞的函数，不阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_bot_executor(), func, *args)
@@ -1,20 +1,30 @@
 # encoding:utf-8
 
+import asyncio
 import time
 
 import openai
 import openai.error
-import requests
 
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
+from bot.session_compactor import SessionCompactor
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.circuit_breaker import CIRCUIT_OPEN_REPLY, CircuitOpenError, RetryLater, backoff_delay, retry_after
+from common.hedge import create_hedger
+from common.http_client import get_http_client
 from common.log import logger
+from common.single_flight import SingleFlight, payload_key
 from common.token_bucket import TokenBucket
-from config import conf, load_config
+from common.upstream_pool import create_upstream_pool
+from config import conf, conf_snapshot, load_config
+
+# 按rate_limit_chatgpt_tpm限流时预估的回复token数，请求完成后按实际用量修正
+COMPLETION_TOKENS_ESTIMATE = 256
 
 
 # OpenAI对话模型API (可用)
@@ -30,6 +40,8 @@ class ChatGPTBot(Bot, OpenAIImage):
             openai.proxy = proxy
         if conf().get("rate_limit_chatgpt"):
             self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+        if conf().get("rate_limit_chatgpt_tpm"):
+            self.tb4chatgpt_tpm = TokenBucket(conf().get("rate_limit_chatgpt_tpm"))
 
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {
@@ -42,70 +54,115 @@ class ChatGPTBot(Bot, OpenAIImage):
             "request_timeout": conf().get("request_timeout", None),  # 请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
             "timeout": conf().get("request_timeout", None),  # 重试超时时间，在这个时间内，将会自动重试
         }
+        if conf().get("conversation_compact", False):
+            self.sessions.compactor = SessionCompactor(
+                self._summarize,
+                threshold=conf().get("conversation_compact_threshold", 0.8),
+                keep=conf().get("conversation_compact_keep", 4),
+            )
+        # 合并同时进行中的相同请求，未开启时为None
+        self.single_flight = SingleFlight("chatgpt") if conf().get("request_coalescing", False) else None
+        # 多个api_key、api_base之间的负载均衡，未配置open_ai_api_pool时为None
+        pool_entries = conf().get("open_ai_api_pool")
+        if not pool_entries and conf().get("circuit_breaker", False):
+            # 只有一个端点时也通过接口池记录熔断状态
+            pool_entries = [{"api_key": conf().get("open_ai_api_key"), "api_base": conf().get("open_ai_api_base")}]
+        self.upstream_pool = create_upstream_pool(pool_entries, conf().get("upstream_cooldown", 60))
+        # 长尾请求的对冲，只在async_handler模式下使用，未开启时为None
+        self.hedger = create_hedger("chatgpt") if conf().get("request_hedging", False) else None
+        if self.hedger is not None and not conf().get("async_handler", False):
+            logger.warning("[CHATGPT] request_hedging only works with async_handler, requests will not be hedged")
+        for name, component in (("single_flight", self.single_flight), ("upstream_pool", self.upstream_pool), ("hedger", self.hedger)):
+            if component is not None:
+                metrics.register("{}.chatgpt".format(name), component.get_metrics)
 
     def reply(self, query, context=None):
         # acquire reply content
         if context.type == ContextType.TEXT:
-            logger.info("[CHATGPT] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply, session, api_key, args = self._prepare_text_query(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            if context.get("stream"):
+                return self.reply_text_stream(session, api_key, args=args)
+            try:
+                reply_content = self.reply_text(session, api_key, args=args)
+            except RetryLater as e:  # 重试在等待后由通道继续，继续时同样构造回复
+                raise e.then(lambda content: self._build_text_reply(session, content))
+            return self._build_text_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
-            ok, retstring = self.create_img(query, 0)
-            reply = None
-            if ok:
-                reply = Reply(ReplyType.IMAGE_URL, retstring)
-            else:
-                reply = Reply(ReplyType.ERROR, retstring)
-            return reply
+            try:
+                result = self.create_img(query, 0)
+            except RetryLater as e:
+                raise e.then(_image_reply)
+            return _image_reply(result)
         else:
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def reply_async(self, query, context=None):
+        if context.type != ContextType.TEXT:
+            return await super().reply_async(query, context)
+        # 会话指令、会话的加载和token计数会阻塞，在线程池中执行
+        reply, session, api_key, args = await self.run_blocking(self._prepare_text_query, query, context)
+        if reply:
+            return reply
+        if context.get("stream"):
+            return Reply(ReplyType.STREAM, self.reply_text_stream_async(session, api_key, args=args))
+        reply_content = await self.reply_text_async(session, api_key, args=args)
+        return await self.run_blocking(self._build_text_reply, session, reply_content)
+
+    def _prepare_text_query(self, query, context):
+        """
+        处理会话指令，并把query加入会话
+        :return: (指令的回复, 会话, api_key, 请求参数)，指令的回复不为空时无需请求openai
+        """
+        logger.info("[CHATGPT] query={}".format(query))
+
+        session_id = context["session_id"]
+        reply = None
+        clear_memory_commands = conf_snapshot().clear_memory_commands
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            reply = Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            reply = Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            reply = Reply(ReplyType.INFO, "配置已更新")
+        if reply:
+            return reply, None, None, None
+        session = self.sessions.session_query(query, session_id)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return None, session, api_key, new_args
+
+    def _build_text_reply(self, session: ChatGPTSession, reply_content: dict) -> Reply:
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session.session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session.session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
     def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -115,52 +172,350 @@ class ChatGPTBot(Bot, OpenAIImage):
         :return: {}
         """
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
             # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            messages = session.to_payload()
+            if self.single_flight is not None:
+                return self.single_flight.do(payload_key(api_key, messages, args), self._complete, session, api_key, messages, args)
+            return self._complete(session, api_key, messages, args)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                need_retry = False
-                result["content"] = "我连接不到你的网络"
+            need_retry, delay, result = self._handle_error(e, session, retry_count)
+            if need_retry:
+                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
+                return retry_after(delay, self.reply_text, session, api_key, args, retry_count + 1)
             else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+                return result
 
+    async def reply_text_async(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+        """
+        reply_text的协程版本，等待openai响应和重试间隔时不占用线程
+        """
+        try:
+            if args is None:
+                args = self.args
+            messages = session.to_payload()
+            if self.single_flight is not None:
+                return await self.single_flight.do_async(payload_key(api_key, messages, args), self._complete_async, session, api_key, messages, args)
+            return await self._complete_async(session, api_key, messages, args)
+        except Exception as e:
+            need_retry, delay, result = self._handle_error(e, session, retry_count)
             if need_retry:
+                await asyncio.sleep(delay)
                 logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+                return await self.reply_text_async(session, api_key, args, retry_count + 1)
             else:
                 return result
 
+    def _complete(self, session: ChatGPTSession, api_key, messages, args) -> dict:
+        """限流后调用ChatCompletion，合并相同请求时只有leader调用；同步的http请求无法取消，不对冲"""
+        return self._call(session, api_key, messages, args)
+
+    async def _complete_async(self, session: ChatGPTSession, api_key, messages, args) -> dict:
+        """开启对冲时可能调用两次，落后的请求会被取消"""
+        if self.hedger is not None:
+            return await self.hedger.run_async(self._call_async, session, api_key, messages, args)
+        return await self._call_async(session, api_key, messages, args)
+
+    def _call(self, session: ChatGPTSession, api_key, messages, args, prompt_tokens=0) -> dict:
+        """
+        :param prompt_tokens: session为None时用于限流和端点预扣的prompt的token数
+        """
+        estimate = self._acquire_quota(session, prompt_tokens)
+        endpoint, reserved = self._acquire_endpoint(session, api_key, estimate, prompt_tokens)
+        start = time.monotonic()
+        try:
+            response = openai.ChatCompletion.create(messages=messages, **self._endpoint_args(endpoint, api_key), **args)
+            # logger.debug("[CHATGPT] response={}".format(response))
+            result = self._parse_response(response)
+        except Exception as e:
+            self._settle_quota(estimate, 0)
+            self._release_endpoint(endpoint, reserved, error=e)
+            raise
+        self._settle_quota(estimate, result["total_tokens"])
+        self._release_endpoint(endpoint, reserved, time.monotonic() - start, total_tokens=result["total_tokens"])
+        return result
+
+    async def _call_async(self, session: ChatGPTSession, api_key, messages, args) -> dict:
+        estimate = await self._acquire_quota_async(session)
+        endpoint, reserved = await self._acquire_endpoint_async(session, api_key, estimate)
+        start = time.monotonic()
+        try:
+            response = await openai.ChatCompletion.acreate(messages=messages, **self._endpoint_args(endpoint, api_key), **args)
+            result = self._parse_response(response)
+        except asyncio.CancelledError as e:
+            # 对冲请求中落后的一方被取消，不计为端点的错误
+            self._settle_quota(estimate, 0)
+            self._release_endpoint(endpoint, reserved, error=e)
+            raise
+        except Exception as e:
+            self._settle_quota(estimate, 0)
+            self._release_endpoint(endpoint, reserved, error=e)
+            raise
+        latency = time.monotonic() - start
+        if self.hedger is not None:  # 只记录上游请求的耗时，不包含限流和端点的等待
+            self.hedger.record(latency)
+        self._settle_quota(estimate, result["total_tokens"])
+        self._release_endpoint(endpoint, reserved, latency, total_tokens=result["total_tokens"])
+        return result
+
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None) -> Reply:
+        """
+        以流式方式调用ChatCompletion，在当前线程建立请求，返回逐段输出回复内容的流式回复，全部输出后把完整的回复加入会话
+        建立请求失败时按reply_text的方式重试并返回普通的回复；输出中途中断时保留已经输出的部分
+        :param session: a conversation session
+        """
+        estimate = reserved = 0
+        endpoint = None
+        try:
+            estimate = self._acquire_quota(session)
+            endpoint, reserved = self._acquire_endpoint(session, api_key, estimate)
+            if args is None:
+                args = self.args
+            start = time.monotonic()
+            response = openai.ChatCompletion.create(messages=session.to_payload(), stream=True, **self._endpoint_args(endpoint, api_key), **args)
+        except Exception as e:
+            self._settle_quota(estimate, 0)
+            self._release_endpoint(endpoint, reserved, error=e)
+            need_retry, delay, result = self._handle_error(e, session, 0)
+            if need_retry:
+                logger.warn("[CHATGPT] 第1次重试")
+                try:
+                    result = retry_after(delay, self.reply_text, session, api_key, args, 1)
+                except RetryLater as retry:
+                    raise retry.then(lambda content: self._build_text_reply(session, content))
+            return self._build_text_reply(session, result)
+        return Reply(ReplyType.STREAM, self._iter_stream(session, response, start, endpoint, reserved, estimate))
+
+    def _iter_stream(self, session: ChatGPTSession, response, start, endpoint, reserved, estimate):
+        """
+        :return: 回复内容增量的生成器
+        """
+        contents = []
+        latency = error = None
+        try:
+            for chunk in response:
+                delta = _stream_delta(chunk)
+                if delta:
+                    if latency is None:
+                        latency = time.monotonic() - start
+                    contents.append(delta)
+                    yield delta
+        except Exception as e:
+            logger.warn("[CHATGPT] stream interrupted: {}".format(e))
+            error = e
+            if not contents:
+                yield "我现在有点累了，等会再来吧"
+                return
+        finally:
+            # 流可能没有读完就被丢弃(GeneratorExit)，在finally中归还端点、修正预扣的token数
+            self._settle_stream(endpoint, reserved, estimate, latency, error, contents)
+        self._stream_reply(session, contents)
+
+    async def reply_text_stream_async(self, session: ChatGPTSession, api_key=None, args=None):
+        """
+        reply_text_stream的协程版本，返回回复内容增量的异步生成器，建立请求在第一次迭代时进行
+        """
+        estimate = reserved = 0
+        endpoint = None
+        try:
+            estimate = await self._acquire_quota_async(session)
+            endpoint, reserved = await self._acquire_endpoint_async(session, api_key, estimate)
+            if args is None:
+                args = self.args
+            start = time.monotonic()
+            response = await openai.ChatCompletion.acreate(messages=session.to_payload(), stream=True, **self._endpoint_args(endpoint, api_key), **args)
+        except Exception as e:
+            self._settle_quota(estimate, 0)
+            self._release_endpoint(endpoint, reserved, error=e)
+            need_retry, delay, result = self._handle_error(e, session, 0)
+            if need_retry:
+                await asyncio.sleep(delay)
+                logger.warn("[CHATGPT] 第1次重试")
+                result = await self.reply_text_async(session, api_key, args, 1)
+            yield (await self.run_blocking(self._build_text_reply, session, result)).content
+            return
+        contents = []
+        latency = error = None
+        try:
+            async for chunk in response:
+                delta = _stream_delta(chunk)
+                if delta:
+                    if latency is None:
+                        latency = time.monotonic() - start
+                    contents.append(delta)
+                    yield delta
+        except Exception as e:
+            logger.warn("[CHATGPT] stream interrupted: {}".format(e))
+            error = e
+            if not contents:
+                yield "我现在有点累了，等会再来吧"
+                return
+        finally:
+            self._settle_stream(endpoint, reserved, estimate, latency, error, contents)
+        await self.run_blocking(self._stream_reply, session, contents)
+
+    def _stream_tokens(self, estimate, contents):
+        """流式响应没有用量，按每个chunk约为一个token，由预估值估算总token数"""
+        return estimate - COMPLETION_TOKENS_ESTIMATE + len(contents) if estimate else 0
+
+    def _settle_stream(self, endpoint, reserved, estimate, latency, error, contents):
+        self._release_endpoint(endpoint, reserved, latency, error, self._stream_tokens(reserved, contents))
+        self._settle_quota(estimate, self._stream_tokens(estimate, contents))
+
+    def _stream_reply(self, session: ChatGPTSession, contents):
+        """流正常结束(包括中途中断但已有输出)时把回复加入会话"""
+        reply_content = "".join(contents)
+        logger.debug("[CHATGPT] stream finished, session_id={}, reply_cont={}".format(session.session_id, reply_content))
+        if reply_content:
+            self.sessions.session_reply(reply_content, session.session_id)
+
+    def _acquire_endpoint(self, session: ChatGPTSession, api_key, estimate, prompt_tokens=0):
+        """
+        从上游接口池选择端点，用户指定了api_key时不参与选择，只经过熔断器
+        :return: (端点, 在端点上预扣的token数)，没有配置接口池时返回(None, 0)
+        """
+        if self.upstream_pool is None:
+            return None, 0
+        if api_key:
+            return self.upstream_pool.acquire_direct(api_key, conf().get("open_ai_api_base")), 0
+        tokens = (estimate or self._estimate_tokens(session, prompt_tokens)) if self.upstream_pool.limits_tokens else 0
+        return self.upstream_pool.acquire(tokens), tokens
+
+    async def _acquire_endpoint_async(self, session: ChatGPTSession, api_key, estimate):
+        if self.upstream_pool is None:
+            return None, 0
+        if api_key:
+            return self.upstream_pool.acquire_direct(api_key, conf().get("open_ai_api_base")), 0
+        tokens = (estimate or self._estimate_tokens(session, 0)) if self.upstream_pool.limits_tokens else 0
+        return await self.upstream_pool.acquire_async(tokens), tokens
+
+    def _release_endpoint(self, endpoint, reserved, latency=None, error=None, total_tokens=0):
+        """归还端点，按实际用量修正端点预扣的token数，请求失败时退还"""
+        if endpoint is None:
+            return
+        tokens_delta = total_tokens - reserved if reserved and total_tokens else -reserved
+        self.upstream_pool.release(endpoint, latency, error, tokens_delta)
+
+    def _endpoint_args(self, endpoint, api_key):
+        """请求使用的api_key和api_base，api_key为None时使用默认的openai.api_key"""
+        if endpoint is None:
+            return {"api_key": api_key}
+        kwargs = {"api_key": endpoint.api_key}
+        if endpoint.api_base:
+            kwargs["api_base"] = endpoint.api_base
+        return kwargs
+
+    def _summarize(self, messages) -> str:
+        """
+        把较早的对话总结为摘要，供会话压缩使用，在后台线程中调用
+        :param messages: 要总结的消息，可能包含之前的摘要
+        """
+        conversation = "\n".join("{}: {}".format(message.role, message.content) for message in messages)
+        prompt = "请用简洁的语言总结以下对话，保留后续对话需要的人物、事实、约定和未完成的问题，只输出摘要：\n" + conversation
+        # 与对话请求一样经过限流和上游接口池，按字符数估算prompt的token数
+        return self._call(None, None, [{"role": "user", "content": prompt}], self.args, prompt_tokens=len(prompt))["content"]
+
+    def _acquire_quota(self, session: ChatGPTSession = None, prompt_tokens=0) -> int:
+        """
+        按rate_limit_chatgpt(每分钟请求数)和rate_limit_chatgpt_tpm(每分钟token数)限流，超出时排队等待
+        :param session: 要请求的会话，用于计算prompt的token数
+        :param prompt_tokens: 没有会话时prompt的token数
+        :return: 按tpm预扣的token数，请求结束后交给_settle_quota按实际用量修正
+        """
+        config = conf_snapshot()
+        if config.rate_limit_chatgpt and not self.tb4chatgpt.get_token():
+            raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        if not config.rate_limit_chatgpt_tpm:
+            return 0
+        estimate = self._estimate_tokens(session, prompt_tokens)
+        if not self.tb4chatgpt_tpm.get_token(estimate):
+            raise openai.error.RateLimitError("RateLimitError: token rate limit exceeded")
+        return estimate
+
+    async def _acquire_quota_async(self, session: ChatGPTSession = None, prompt_tokens=0) -> int:
+        """_acquire_quota的协程版本，等待令牌时不占用线程"""
+        config = conf_snapshot()
+        if config.rate_limit_chatgpt and not await self.tb4chatgpt.get_token_async():
+            raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
+        if not config.rate_limit_chatgpt_tpm:
+            return 0
+        estimate = self._estimate_tokens(session, prompt_tokens)
+        if not await self.tb4chatgpt_tpm.get_token_async(estimate):
+            raise openai.error.RateLimitError("RateLimitError: token rate limit exceeded")
+        return estimate
+
+    def _estimate_tokens(self, session: ChatGPTSession, prompt_tokens):
+        if session is not None:
+            try:
+                prompt_tokens = session.calc_tokens()
+            except Exception as e:
+                logger.debug("[CHATGPT] count prompt tokens failed, estimate by length: {}".format(e))
+                prompt_tokens = session.approx_size() // 2
+        return prompt_tokens + COMPLETION_TOKENS_ESTIMATE
+
+    def _settle_quota(self, estimate, total_tokens):
+        """按实际用量修正预扣的token数，请求失败时total_tokens为0，退还预扣的部分"""
+        if estimate:
+            self.tb4chatgpt_tpm.charge(total_tokens - estimate)
+
+    def _parse_response(self, response) -> dict:
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_error(self, e, session: ChatGPTSession, retry_count):
+        """
+        根据异常类型决定是否重试
+        :return: (是否重试, 重试前等待的秒数, 不再重试时返回的结果)
+        """
+        need_retry = retry_count < 2
+        delay = 0
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, CircuitOpenError):
+            logger.warn("[CHATGPT] {}, fail fast".format(e))
+            need_retry = False
+            result["content"] = CIRCUIT_OPEN_REPLY
+        elif isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+            delay = backoff_delay(retry_count, 20)
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            delay = backoff_delay(retry_count, 5)
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            delay = backoff_delay(retry_count, 10)
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            need_retry = False
+            result["content"] = "我连接不到你的网络"
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        return need_retry, delay, result
+
+
+def _image_reply(result) -> Reply:
+    """把create_img的结果(是否成功, 图片地址或错误信息)转换为回复"""
+    ok, retstring = result
+    if ok:
+        return Reply(ReplyType.IMAGE_URL, retstring)
+    return Reply(ReplyType.ERROR, retstring)
+
+
+def _stream_delta(chunk):
+    """流式响应中一个chunk的回复内容增量"""
+    choices = chunk.get("choices")
+    if not choices:
+        return None
+    return choices[0].get("delta", {}).get("content")
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
@@ -176,18 +531,29 @@ class AzureChatGPTBot(ChatGPTBot):
         headers = {"api-key": api_key, "Content-Type": "application/json"}
         try:
             body = {"caption": query, "resolution": conf().get("image_create_size", "256x256")}
-            submission = requests.post(url, headers=headers, json=body)
+            submission = get_http_client(use_proxy=True).post(url, headers=headers, json=body)
             operation_location = submission.headers["Operation-Location"]
-            retry_after = submission.headers["Retry-after"]
-            status = ""
-            image_url = ""
-            while status != "Succeeded":
-                logger.info("waiting for image create..., " + status + ",retry after " + retry_after + " seconds")
-                time.sleep(int(retry_after))
-                response = requests.get(operation_location, headers=headers)
-                status = response.json()["status"]
-            image_url = response.json()["result"]["contentUrl"]
-            return True, image_url
+            retry_after_seconds = int(submission.headers["Retry-after"])
+            logger.info("waiting for image create..., retry after {} seconds".format(retry_after_seconds))
+            return retry_after(retry_after_seconds, self._poll_img, operation_location, headers, retry_after_seconds)
+        except RetryLater:
+            raise
+        except Exception as e:
+            logger.error("create image error: {}".format(e))
+            return False, "图片生成失败"
+
+    def _poll_img(self, operation_location, headers, retry_after_seconds):
+        """查询画图任务的状态，未完成时等待后再次查询"""
+        try:
+            response = get_http_client(use_proxy=True).get(operation_location, headers=headers)
+            result = response.json()
+            status = result["status"]
+            if status != "Succeeded":
+                logger.info("waiting for image create..., " + status + ",retry after " + str(retry_after_seconds) + " seconds")
+                return retry_after(retry_after_seconds, self._poll_img, operation_location, headers, retry_after_seconds)
+            return True, result["result"]["contentUrl"]
+        except RetryLater:
+            raise
         except Exception as e:
             logger.error("create image error: {}".format(e))
             return False, "图片生成失败"
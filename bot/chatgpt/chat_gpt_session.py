@@ -1,5 +1,6 @@
-from bot.session_manager import Session
+from bot.session_manager import ROLE_SYSTEM, Message, Session
 from common.log import logger
+from common.token_counter import get_token_params
 
 """
     e.g.  [
@@ -15,8 +16,26 @@ class ChatGPTSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
         self.model = model
+        self.token_params = None  # (encoding, tokens_per_message, tokens_per_name)，首次计数时按model确定
         self.reset()
 
+    # 每条消息的token数在添加时计算并缓存在消息上，会话只维护总和；无法计算(如没有安装tiktoken)的消息记录在unknown中
+    def reset(self):
+        super().reset()
+        self._rebuild_tokens()
+
+    def add_query(self, query):
+        super().add_query(query)
+        self._append_tokens(self.messages[-1])
+
+    def add_reply(self, reply):
+        super().add_reply(reply)
+        self._append_tokens(self.messages[-1])
+
+    def restore(self, record):
+        super().restore(record)
+        self._rebuild_tokens()
+
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
@@ -28,15 +47,15 @@ class ChatGPTSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self._pop(1)
+            elif len(self.messages) == 2 and self.messages[1].role == "assistant":
+                self._pop(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
+            elif len(self.messages) == 2 and self.messages[1].role == "user":
                 logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
                 break
             else:
@@ -48,40 +67,93 @@ class ChatGPTSession(Session):
                 cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
+    def compact(self, old_messages, summary):
+        """
+        把system之后的old_messages替换为一条摘要消息，期间已被丢弃的开头部分忽略，调用方需持有self.lock
+        :return: 是否替换成功，消息已被修改(如会话被重置)时返回False
+        """
+        if len(self.messages) < 2:
+            return False
+        for skipped, message in enumerate(old_messages):
+            if message is self.messages[1]:
+                break
+        else:
+            return False
+        remaining = old_messages[skipped:]
+        current = self.messages[1 : 1 + len(remaining)]
+        if len(current) != len(remaining) or any(a is not b for a, b in zip(current, remaining)):
+            return False
+        for _ in remaining:
+            self._pop(1)
+        message = Message(ROLE_SYSTEM, summary)
+        self._insert(1, message)
+        self._append_tokens(message)
+        return True
+
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        if self.unknown:
+            self._count_unknown()
+        return self.tokens_sum + 3  # every reply is primed with <|start|>assistant<|message|>
+
+    def _get_token_params(self):
+        if self.token_params is None:
+            self.token_params = get_token_params(self.model)
+        return self.token_params
+
+    def _count(self, message: Message):
+        """返回消息的token数，优先使用消息上缓存的结果"""
+        if message.tokens is not None and message.tokens[0] == self.model:
+            return message.tokens[1]
+        encoding, tokens_per_message, tokens_per_name = self._get_token_params()
+        tokens = num_tokens_from_message(message, encoding, tokens_per_message, tokens_per_name)
+        message.tokens = (self.model, tokens)
+        return tokens
+
+    def _append_tokens(self, message: Message):
+        try:
+            self.tokens_sum += self._count(message)
+        except Exception as e:
+            logger.debug("Exception when counting tokens for message: {}".format(e))
+            self.unknown.append(message)
+
+    def _rebuild_tokens(self):
+        self.tokens_sum = 0  # 已知token数的总和
+        self.unknown = []  # token数未知的消息
+        for message in self.messages:
+            self._append_tokens(message)
+
+    def _pop(self, index):
+        message = super()._pop(index)
+        for i, unknown in enumerate(self.unknown):
+            if unknown is message:
+                del self.unknown[i]
+                return message
+        self.tokens_sum -= self._count(message)
+        return message
+
+    def _count_unknown(self):
+        """补算之前无法计算的消息，仍然失败时抛出异常"""
+        while self.unknown:
+            self.tokens_sum += self._count(self.unknown[0])
+            self.unknown.pop(0)
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+def num_tokens_from_message(message, encoding, tokens_per_message, tokens_per_name):
+    """Returns the number of tokens used by a single message, without the reply priming tokens."""
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-    import tiktoken
-
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo"]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613", "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k"]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
+    params = get_token_params(model)
     num_tokens = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+        num_tokens += num_tokens_from_message(message, *params)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
@@ -1,9 +1,8 @@
 # access LinkAI knowledge base platform
 # docs: https://link-ai.tech/platform/link-app/wechat
 
-import time
-
-import requests
+import asyncio
+import json
 
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -11,7 +10,11 @@ from bot.openai.open_ai_image import OpenAIImage
 from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.circuit_breaker import CIRCUIT_OPEN_REPLY, CircuitOpenError, backoff_delay, get_circuit_breaker, is_upstream_failure, retry_after
+from common.http_client import get_http_client
 from common.log import logger
+from common.single_flight import SingleFlight, payload_key
 from config import conf
 
 
@@ -19,11 +22,17 @@ class LinkAIBot(Bot, OpenAIImage):
     # authentication failed
     AUTH_FAILED_CODE = 401
     NO_QUOTA_CODE = 406
+    MAX_RETRY = 2
+    RETRY_DELAY = 2  # 第一次重试前的等待时间，之后按指数增长
 
     def __init__(self):
         super().__init__()
         self.base_url = "https://api.link-ai.chat/v1"
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
+        # 合并同时进行中的相同请求，未开启时为None
+        self.single_flight = SingleFlight("linkai") if conf().get("request_coalescing", False) else None
+        if self.single_flight is not None:
+            metrics.register("single_flight.linkai", self.single_flight.get_metrics)
 
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
@@ -40,12 +49,34 @@ class LinkAIBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
-    def _chat(self, query, context, retry_count=0):
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return Reply(ReplyType.ERROR, "请再问我一次吧")
+    async def reply_async(self, query, context: Context = None) -> Reply:
+        if context.type != ContextType.TEXT:
+            return await super().reply_async(query, context)
+        # 请求在线程池中执行，重试前的等待不占用线程
+        for retry_count in range(self.MAX_RETRY):
+            reply = await self.run_blocking(self._chat_once, query, context, retry_count)
+            if reply is not None:
+                return reply
+            if retry_count + 1 < self.MAX_RETRY:
+                await asyncio.sleep(backoff_delay(retry_count, self.RETRY_DELAY))
+        logger.warn("[LINKAI] failed after maximum number of retry times")
+        return Reply(ReplyType.ERROR, "请再问我一次吧")
 
+    def _chat(self, query, context, retry_count=0):
+        reply = self._chat_once(query, context, retry_count)
+        if reply is not None:
+            return reply
+        if retry_count + 1 < self.MAX_RETRY:
+            return retry_after(backoff_delay(retry_count, self.RETRY_DELAY), self._chat, query, context, retry_count + 1)
+        # exit from retry 2 times
+        logger.warn("[LINKAI] failed after maximum number of retry times")
+        return Reply(ReplyType.ERROR, "请再问我一次吧")
+
+    def _chat_once(self, query, context, retry_count):
+        """
+        请求一次LinkAI
+        :return: 回复，需要重试时返回None
+        """
         try:
             # load config
             if context.get("generate_breaked_by"):
@@ -60,14 +91,15 @@ class LinkAIBot(Bot, OpenAIImage):
             session = self.sessions.session_query(query, session_id)
 
             # remove system message
-            if app_code and session.messages[0].get("role") == "system":
-                session.messages.pop(0)
+            messages = session.to_payload()
+            if app_code and messages and messages[0].get("role") == "system":
+                messages = messages[1:]
 
             logger.info(f"[LINKAI] query={query}, app_code={app_code}")
 
             body = {
                 "appCode": app_code,
-                "messages": session.messages,
+                "messages": messages,
                 "model": conf().get("model") or "gpt-3.5-turbo",  # 对话模型的名称
                 "temperature": conf().get("temperature"),
                 "top_p": conf().get("top_p", 1),
@@ -76,8 +108,15 @@ class LinkAIBot(Bot, OpenAIImage):
             }
             headers = {"Authorization": "Bearer " + linkai_api_key}
 
+            if context.get("stream"):
+                body["stream"] = True
+                return Reply(ReplyType.STREAM, self._chat_stream(session_id, body, headers))
+
             # do http request
-            res = requests.post(url=self.base_url + "/chat/completion", json=body, headers=headers).json()
+            if self.single_flight is not None:
+                res = self.single_flight.do(payload_key(body, linkai_api_key), self._post_chat, body, headers)
+            else:
+                res = self._post_chat(body, headers)
 
             if not res or not res["success"]:
                 if res.get("code") == self.AUTH_FAILED_CODE:
@@ -90,9 +129,8 @@ class LinkAIBot(Bot, OpenAIImage):
 
                 else:
                     # retry
-                    time.sleep(2)
                     logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    return None
 
             # execute success
             reply_content = res["data"]["content"]
@@ -100,9 +138,75 @@ class LinkAIBot(Bot, OpenAIImage):
             self.sessions.session_reply(reply_content, session_id)
             return Reply(ReplyType.TEXT, reply_content)
 
+        except CircuitOpenError as e:
+            logger.warn(f"[LINKAI] {e}, fail fast")
+            return Reply(ReplyType.ERROR, CIRCUIT_OPEN_REPLY)
         except Exception as e:
             logger.exception(e)
             # retry
-            time.sleep(2)
             logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            return None
+
+    def _post_chat(self, body, headers):
+        return self._post(body, headers).json()
+
+    def _post(self, body, headers, **kwargs):
+        """请求LinkAI，开启circuit_breaker时记录是否为上游故障，熔断时抛出CircuitOpenError"""
+        breaker = get_circuit_breaker("linkai")
+        if breaker is not None:
+            breaker.check()
+        try:
+            res = get_http_client().post(url=self.base_url + "/chat/completion", json=body, headers=headers, **kwargs)
+        except Exception as e:
+            if breaker is not None:
+                breaker.record(is_upstream_failure(e))
+            raise
+        if breaker is not None:
+            breaker.record(res.status_code >= 500)
+        return res
+
+    def _chat_stream(self, session_id, body, headers):
+        """
+        以流式方式请求LinkAI，逐段返回回复内容，全部返回后把完整的回复加入会话
+        :return: 回复内容增量的生成器
+        """
+        contents = []
+        try:
+            res = self._post(body, headers, stream=True)
+            if not res.headers.get("Content-Type", "").startswith("text/event-stream"):
+                # 请求失败时返回普通的json
+                res = res.json()
+                if res.get("code") == self.AUTH_FAILED_CODE:
+                    logger.error(f"[LINKAI] please check your linkai_api_key, res={res}")
+                elif res.get("code") == self.NO_QUOTA_CODE:
+                    logger.error(f"[LINKAI] please check your account quota, https://chat.link-ai.tech/console/account")
+                    yield "提问太快啦，请休息一下再问我吧"
+                    return
+                else:
+                    logger.warn(f"[LINKAI] stream request failed, res={res}")
+                yield "请再问我一次吧"
+                return
+            for line in res.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices")
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    contents.append(delta)
+                    yield delta
+        except CircuitOpenError as e:
+            logger.warn(f"[LINKAI] {e}, fail fast")
+            yield CIRCUIT_OPEN_REPLY
+            return
+        except Exception as e:
+            logger.exception(e)
+            if not contents:
+                yield "请再问我一次吧"
+                return
+        reply_content = "".join(contents)
+        logger.info(f"[LINKAI] reply={reply_content}")
+        if reply_content:
+            self.sessions.session_reply(reply_content, session_id)
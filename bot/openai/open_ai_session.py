@@ -1,5 +1,6 @@
 from bot.session_manager import Session
 from common.log import logger
+from common.token_counter import get_encoding
 
 
 class OpenAISession(Session):
@@ -39,9 +40,9 @@ class OpenAISession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 1:
-                self.messages.pop(0)
+                self._pop(0)
             elif len(self.messages) == 1 and self.messages[0]["role"] == "assistant":
-                self.messages.pop(0)
+                self._pop(0)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -66,8 +67,6 @@ class OpenAISession(Session):
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_string(string: str, model: str) -> int:
     """Returns the number of tokens in a text string."""
-    import tiktoken
-
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_encoding(model)
     num_tokens = len(encoding.encode(string, disallowed_special=()))
     return num_tokens
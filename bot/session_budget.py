@@ -0,0 +1,128 @@
+"""
+进程内所有SessionManager共享的会话内存预算
+
+各个bot(以及通过bot.sessions创建的角色扮演会话)每次访问或修改会话时登记会话的大小，
+超出 session_budget_max_sessions 或 session_budget_max_bytes 时，按最近最少使用的顺序从所属的SessionManager中淘汰会话。
+会话过期或超出session_cache_max_entries被移除时同时从预算中移除。
+会话大小按消息文本的UTF-8字节数估算，由会话随消息的增删维护；开启session_store时被淘汰的会话在下次访问时重新加载，否则相当于会话过期。
+正在等待回复的会话(session.pinned_until未到)不会被淘汰，否则回复会加入重新创建的、没有这次提问的会话。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from common import metrics
+from common.log import logger
+from config import conf
+
+
+class SessionBudget(object):
+    def __init__(self, max_sessions=0, max_bytes=0):
+        """
+        :param max_sessions: 最多保留的会话数，0表示不限制
+        :param max_bytes: 所有会话消息文本的总字节数上限，0表示不限制
+        """
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (id(manager), session_id) -> [manager, session, 字节数]
+        self.resident_bytes = 0
+        self.evictions = 0
+
+    def touch(self, manager, session):
+        """
+        登记会话的最新大小并标记为最近使用，超出预算时淘汰其它会话
+        淘汰时调用SessionManager.evict_session，可能涉及存储的读写，在释放锁之后进行
+        :param manager: 会话所属的SessionManager
+        :param session: 会话，大小取session.approx_size()
+        """
+        key = (id(manager), session.session_id)
+        size = session.approx_size()
+        victims = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = [manager, session, size]
+            else:
+                self.resident_bytes -= entry[2]
+                entry[1] = session
+                entry[2] = size
+                self.entries.move_to_end(key)
+            self.resident_bytes += size
+            if self._exceeded(len(self.entries), self.resident_bytes):
+                victims = self._select_victims(key)
+            for oldest_key, oldest_entry in victims:
+                del self.entries[oldest_key]
+                self.resident_bytes -= oldest_entry[2]
+                self.evictions += 1
+                if self.evictions % 100 == 0:
+                    logger.info("[SessionBudget] resident sessions={}, bytes={}, evictions={}".format(len(self.entries), self.resident_bytes, self.evictions))
+            resident = (len(self.entries), self.resident_bytes)
+        for (_, session_id), (oldest_manager, oldest_session, oldest_size) in victims:
+            logger.debug(
+                "[SessionBudget] evict session {} from {}, bytes={}, resident sessions={}, bytes={}".format(session_id, oldest_manager.namespace, oldest_size, *resident)
+            )
+            oldest_manager.evict_session(session_id, oldest_session)
+
+    def remove(self, manager, session_id, session=None):
+        """
+        :param session: 不为None时只在登记的是这个会话时移除，避免移除已被重新创建的会话
+        """
+        key = (id(manager), session_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (session is None or entry[1] is session):
+                del self.entries[key]
+                self.resident_bytes -= entry[2]
+
+    def remove_all(self, manager):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == id(manager)]:
+                self.resident_bytes -= self.entries.pop(key)[2]
+
+    def get_metrics(self) -> dict:
+        """
+        :return: 当前登记的会话数、总字节数和累计淘汰次数
+        """
+        with self.lock:
+            return {"sessions": len(self.entries), "bytes": self.resident_bytes, "evictions": self.evictions}
+
+    def _select_victims(self, current_key):
+        """
+        从最久未使用的开始选出需要淘汰的会话，跳过当前会话和正在等待回复的会话，需持有self.lock
+        :return: [(key, entry)]
+        """
+        victims = []
+        sessions, resident_bytes = len(self.entries), self.resident_bytes
+        now = time.monotonic()
+        for key, entry in self.entries.items():
+            if not self._exceeded(sessions, resident_bytes):
+                break
+            if key == current_key or entry[1].pinned_until > now:
+                continue
+            victims.append((key, entry))
+            sessions -= 1
+            resident_bytes -= entry[2]
+        return victims
+
+    def _exceeded(self, sessions, resident_bytes):
+        return (self.max_sessions and sessions > self.max_sessions) or (self.max_bytes and resident_bytes > self.max_bytes)
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def get_session_budget():
+    """获取进程内共享的会话预算，未配置上限时返回None"""
+    global _budget
+    max_sessions = conf().get("session_budget_max_sessions", 0)
+    max_bytes = conf().get("session_budget_max_bytes", 0)
+    if not max_sessions and not max_bytes:
+        return None
+    with _budget_lock:
+        if _budget is None:
+            _budget = SessionBudget(max_sessions, max_bytes)
+            metrics.register("session_budget", _budget.get_metrics)
+        return _budget
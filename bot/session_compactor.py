@@ -0,0 +1,67 @@
+"""
+会话压缩
+
+开启 conversation_compact 后，会话的token数接近 conversation_max_tokens 时，在后台线程中把较早的消息总结为一条摘要消息，
+替换掉这些消息；之后的请求携带摘要而不是完整的历史，不会因为超出上限直接丢弃较早的上下文。
+压缩不在回复流程中执行，回复不需要等待总结完成；总结期间这些消息如已被丢弃或修改，只替换仍然存在的部分。
+读取和替换消息时持有会话的锁，与处理消息的线程互斥。
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common.log import logger
+
+SUMMARY_PREFIX = "以下是之前对话的摘要：\n"
+
+
+class SessionCompactor(object):
+    def __init__(self, summarize, threshold=0.8, keep=4):
+        """
+        :param summarize: 总结函数，参数为要压缩的消息列表，返回摘要文本
+        :param threshold: token数达到 max_tokens * threshold 时开始压缩
+        :param keep: 保留不压缩的最近消息数
+        """
+        self.summarize = summarize
+        self.threshold = threshold
+        self.keep = keep
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.inflight = set()  # 正在压缩的会话，同一会话同时只有一个压缩任务
+
+    def maybe_compact(self, manager, session, max_tokens):
+        """会话的token数接近上限时提交压缩任务，立即返回"""
+        try:
+            tokens = session.calc_tokens()
+        except Exception as e:
+            logger.debug("[Compactor] count tokens failed: {}".format(e))
+            return
+        if tokens < max_tokens * self.threshold or len(session.messages) < self.keep + 3:
+            return
+        key = (id(manager), session.session_id)
+        with self.lock:
+            if key in self.inflight:
+                return
+            self.inflight.add(key)
+        self.pool.submit(self._compact, manager, session, key)
+
+    def _compact(self, manager, session, key):
+        try:
+            with session.lock:
+                old_messages = session.messages[1 : len(session.messages) - self.keep]
+            if len(old_messages) < 2:
+                return
+            # 总结期间不持有会话的锁，不阻塞处理消息的线程
+            summary = self.summarize(old_messages)
+            if not summary:
+                return
+            with session.lock:
+                compacted = session.compact(old_messages, SUMMARY_PREFIX + summary)
+            if compacted:
+                logger.info("[Compactor] session {} compacted {} messages, tokens={}".format(session.session_id, len(old_messages), session.calc_tokens()))
+                manager.session_compacted(session)
+        except Exception as e:
+            logger.warning("[Compactor] compact session {} failed: {}".format(session.session_id, e))
+        finally:
+            with self.lock:
+                self.inflight.discard(key)
@@ -1,50 +1,177 @@
+import sys
+import threading
+import time
+
+from bot.session_budget import get_session_budget
+from bot.session_store import get_session_store
 from common.expired_dict import ExpiredDict
 from common.log import logger
-from config import conf
+from config import conf, conf_snapshot
+
+
+ROLE_SYSTEM = "system"
+ROLE_USER = "user"
+ROLE_ASSISTANT = "assistant"
+_ROLES = {role: role for role in (ROLE_SYSTEM, ROLE_USER, ROLE_ASSISTANT)}
+
+
+class Message(object):
+    """
+    会话中的一条消息，role使用共享的字符串，tokens缓存消息的token数
+    兼容按 message["role"]、message["content"] 读取，发送给接口时通过 to_dict() 转换
+    """
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role, content):
+        self.role = _ROLES.get(role) or sys.intern(role)
+        self.content = content
+        self.tokens = None  # (计数使用的模型, token数)
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return (("role", self.role), ("content", self.content))
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+_system_messages = {}  # system_prompt -> Message，相同的system_prompt在所有会话间共享同一条消息
+_system_messages_lock = threading.Lock()
+_SYSTEM_MESSAGES_LIMIT = 256
+
+
+def system_message(system_prompt) -> Message:
+    """获取共享的system消息，共享的消息不能被修改"""
+    message = _system_messages.get(system_prompt)
+    if message is None:
+        with _system_messages_lock:
+            message = _system_messages.get(system_prompt)
+            if message is None:
+                if len(_system_messages) >= _SYSTEM_MESSAGES_LIMIT:
+                    _system_messages.clear()
+                message = Message(ROLE_SYSTEM, system_prompt)
+                _system_messages[system_prompt] = message
+    return message
+
+
+def message_size(message) -> int:
+    """消息文本的UTF-8字节数"""
+    return len(message.content.encode("utf-8"))
 
 
 class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.size = 0  # 消息文本的字节数，随消息的增删维护，用于估算会话占用的内存
+        self.pinned_until = 0  # 等待回复期间不被会话预算淘汰，time.monotonic()的时间
+        # 处理消息的线程和后台压缩的线程都会修改会话，修改消息的复合操作需持有该锁
+        self.lock = threading.RLock()
         if system_prompt is None:
-            self.system_prompt = conf().get("character_desc", "")
+            self.system_prompt = conf_snapshot().character_desc
         else:
             self.system_prompt = system_prompt
 
     # 重置会话
     def reset(self):
-        system_item = {"role": "system", "content": self.system_prompt}
+        system_item = system_message(self.system_prompt)
+        self.system_prompt = system_item.content
         self.messages = [system_item]
+        self.size = message_size(system_item)
 
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
         self.reset()
 
     def add_query(self, query):
-        user_item = {"role": "user", "content": query}
+        user_item = Message(ROLE_USER, query)
         self.messages.append(user_item)
+        self.size += message_size(user_item)
 
     def add_reply(self, reply):
-        assistant_item = {"role": "assistant", "content": reply}
+        assistant_item = Message(ROLE_ASSISTANT, reply)
         self.messages.append(assistant_item)
+        self.size += message_size(assistant_item)
 
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
         raise NotImplementedError
 
+    # 导出用于持久化的会话记录
+    def dump(self):
+        with self.lock:
+            return {
+                "system_prompt": self.system_prompt,
+                "messages": [[item.role, item.content] for item in self.messages],
+                "updated": time.time(),
+            }
+
+    # 消息文本的字节数，用于估算会话占用的内存
+    def approx_size(self):
+        return self.size
+
+    # 在index处插入消息
+    def _insert(self, index, message):
+        self.messages.insert(index, message)
+        self.size += message_size(message)
+
+    # 移除并返回index处的消息
+    def _pop(self, index):
+        message = self.messages.pop(index)
+        self.size -= message_size(message)
+        return message
+
+    # 从会话记录恢复
+    def restore(self, record):
+        self.system_prompt = system_message(record["system_prompt"]).content
+        self.messages = [
+            system_message(content) if role == ROLE_SYSTEM and content == self.system_prompt else Message(role, content) for role, content in record["messages"]
+        ]
+        self.size = sum(message_size(item) for item in self.messages)
+
+    # 转换为对话接口需要的消息列表
+    def to_payload(self):
+        with self.lock:
+            return [item.to_dict() for item in self.messages]
+
     def calc_tokens(self):
         raise NotImplementedError
 
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
+        max_entries = conf().get("session_cache_max_entries", 0)
         if conf().get("expires_in_seconds"):
-            sessions = ExpiredDict(conf().get("expires_in_seconds"))
+            sessions = ExpiredDict(conf().get("expires_in_seconds"), max_entries, on_expire=self._session_expired)
+        elif max_entries:
+            sessions = ExpiredDict(float("inf"), max_entries, on_expire=self._session_expired)
         else:
             sessions = dict()
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        # 会话持久化存储，内存中没有的会话从存储中加载，未开启时为None
+        self.store = get_session_store()
+        self.namespace = sessioncls.__name__
+        # 进程内所有bot共享的会话内存预算，未配置上限时为None
+        self.budget = get_session_budget()
+        # 会话压缩，由支持总结的bot设置，为None时超出上限直接丢弃较早的消息
+        self.compactor = None
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -55,37 +182,122 @@ class SessionManager(object):
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            session = self._load_session(session_id)
+            if session is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            elif system_prompt is not None:
+                session.set_system_prompt(system_prompt)
+            self.sessions[session_id] = session
+            if system_prompt is not None:
+                self._save_session(session)
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
+            session = self.sessions[session_id]
+            with session.lock:
+                session.set_system_prompt(system_prompt)
+            self._save_session(session)
         session = self.sessions[session_id]
+        self._touch_session(session)
         return session
 
-    def session_query(self, query, session_id):
-        session = self.build_session(session_id)
-        session.add_query(query)
+    def peek_session(self, session_id):
+        """
+        读取会话但不创建，内存中没有时从存储中加载但不放入内存
+        :return: 会话，不存在时返回None
+        """
+        if session_id is None:
+            return None
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self._load_session(session_id)
+        return session
+
+    def _touch_session(self, session):
+        if self.budget is not None and session.session_id is not None:
+            self.budget.touch(self, session)
+
+    # 会话过期或超出session_cache_max_entries被移除时由ExpiredDict调用
+    def _session_expired(self, session_id, session):
+        if self.budget is not None:
+            self.budget.remove(self, session_id, session)
+
+    # 超出会话预算时由SessionBudget调用，只从内存中移除，开启session_store时下次访问会重新加载
+    def evict_session(self, session_id, session):
+        # 淘汰在预算的锁外进行，期间会话可能已被重新创建，只移除登记时的那个会话
+        if self.sessions.get(session_id) is session:
+            self.sessions.pop(session_id, None)
+
+    def _load_session(self, session_id):
+        if self.store is None:
+            return None
         try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            total_tokens = session.discard_exceeding(max_tokens, None)
-            logger.debug("prompt tokens used={}".format(total_tokens))
+            record = self.store.load(self.namespace, session_id)
         except Exception as e:
-            logger.debug("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+            logger.warning("[SessionManager] load session {} failed: {}".format(session_id, e))
+            return None
+        if record is None:
+            return None
+        expires_in_seconds = conf().get("expires_in_seconds")
+        if expires_in_seconds and time.time() - record["updated"] > expires_in_seconds:
+            self.store.delete(self.namespace, session_id)
+            return None
+        session = self.sessioncls(session_id, record["system_prompt"], **self.session_args)
+        session.restore(record)
+        logger.debug("[SessionManager] session {} loaded, {} messages".format(session_id, len(session.messages)))
+        return session
+
+    def _save_session(self, session):
+        if self.store is not None and session.session_id is not None:
+            self.store.save(self.namespace, session.session_id, session)
+
+    def session_query(self, query, session_id):
+        session = self.build_session(session_id)
+        with session.lock:
+            session.add_query(query)
+            try:
+                max_tokens = conf_snapshot().conversation_max_tokens
+                total_tokens = session.discard_exceeding(max_tokens, None)
+                logger.debug("prompt tokens used={}".format(total_tokens))
+            except Exception as e:
+                logger.debug("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        # 不在这里保存，每轮对话在session_reply后保存一次；没有回复的query在下一次保存时一起写入
+        # 等待回复期间不被会话预算淘汰，请求失败没有回复时在重试超时后解除
+        session.pinned_until = time.monotonic() + conf().get("timeout", 120)
+        self._touch_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
         session = self.build_session(session_id)
-        session.add_reply(reply)
-        try:
-            max_tokens = conf().get("conversation_max_tokens", 1000)
-            tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
-        except Exception as e:
-            logger.debug("Exception when counting tokens precisely for session: {}".format(str(e)))
+        with session.lock:
+            session.add_reply(reply)
+            try:
+                max_tokens = conf_snapshot().conversation_max_tokens
+                tokens_cnt = session.discard_exceeding(max_tokens, total_tokens)
+                logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+                if self.compactor is not None and session.session_id is not None:
+                    self.compactor.maybe_compact(self, session, max_tokens)
+            except Exception as e:
+                logger.debug("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self._save_session(session)
+        session.pinned_until = 0
+        self._touch_session(session)
         return session
 
+    # 会话在后台被压缩后由SessionCompactor调用
+    def session_compacted(self, session):
+        self._save_session(session)
+        self._touch_session(session)
+
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        if self.store is not None:
+            self.store.delete(self.namespace, session_id)
+        if self.budget is not None:
+            self.budget.remove(self, session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        if self.store is not None:
+            self.store.clear(self.namespace)
+        if self.budget is not None:
+            self.budget.remove_all(self)
@@ -0,0 +1,174 @@
+"""
+会话持久化存储
+
+开启 session_store 后，SessionManager 在内存中找不到会话时从存储中加载，会话变化后异步写回(write-behind)，
+重启后可以继续之前的对话；内存中只保留最近使用的会话(session_cache_max_entries)，其余的在下次访问时重新加载。
+存储的是精简的会话记录：system_prompt 和 [role, content] 形式的消息列表。
+保存时只登记会话对象，由后台线程在写入时导出记录，同一会话在一批写入前的多次保存只导出、编码一次，不占用处理消息的线程。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore(object):
+    def load(self, namespace, session_id):
+        """
+        :return: 会话记录，不存在时返回None
+        """
+        raise NotImplementedError
+
+    def save(self, namespace, session_id, session):
+        """
+        :param session: 会话对象，写入时通过session.dump()导出记录
+        """
+        raise NotImplementedError
+
+    def delete(self, namespace, session_id):
+        raise NotImplementedError
+
+    def clear(self, namespace):
+        raise NotImplementedError
+
+    def flush(self, timeout=None):
+        """
+        等待所有写入完成
+        :return: 是否在超时前完成
+        """
+        return True
+
+
+class SqliteSessionStore(SessionStore):
+    """SQLite存储，写入先合并到内存中，由后台线程批量提交，同一会话只写最新的状态"""
+
+    _DELETED = object()
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "namespace TEXT NOT NULL, session_id TEXT NOT NULL, updated REAL NOT NULL, record TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, session_id))"
+        )
+        self.db_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.pending = {}  # (namespace, session_id) -> 会话对象，_DELETED表示删除
+        self.writing = {}  # 后台线程正在写入的记录
+        _thread = threading.Thread(target=self._worker)
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def load(self, namespace, session_id):
+        key = (namespace, session_id)
+        with self.cond:
+            record = self.pending.get(key, self.writing.get(key))
+        if record is self._DELETED:
+            return None
+        if record is not None:
+            return record.dump()
+        with self.db_lock:
+            row = self.conn.execute("SELECT record FROM sessions WHERE namespace = ? AND session_id = ?", key).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, namespace, session_id, session):
+        with self.cond:
+            self.pending[(namespace, session_id)] = session
+            self.cond.notify_all()
+
+    def delete(self, namespace, session_id):
+        with self.cond:
+            self.pending[(namespace, session_id)] = self._DELETED
+            self.cond.notify_all()
+
+    def clear(self, namespace):
+        with self.cond:
+            while self.writing:  # 等待正在写入的批次完成，避免清除后又被写回
+                self.cond.wait()
+            for key in [key for key in self.pending if key[0] == namespace]:
+                del self.pending[key]
+            with self.db_lock:
+                self.conn.execute("DELETE FROM sessions WHERE namespace = ?", (namespace,))
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.pending or self.writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                self.writing, self.pending = self.pending, {}
+            try:
+                self._write(self.writing)
+            except Exception as e:
+                logger.exception("[SessionStore] write {} sessions failed: {}".format(len(self.writing), e))
+            with self.cond:
+                self.writing = {}
+                self.cond.notify_all()
+
+    def _write(self, records):
+        upserts = []
+        deletes = []
+        for key, session in records.items():
+            if session is self._DELETED:
+                deletes.append(key)
+            else:
+                record = session.dump()
+                upserts.append(key + (record["updated"], json.dumps(record, ensure_ascii=False)))
+        with self.db_lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("DELETE FROM sessions WHERE namespace = ? AND session_id = ?", deletes)
+                self.conn.executemany("INSERT OR REPLACE INTO sessions (namespace, session_id, updated, record) VALUES (?, ?, ?, ?)", upserts)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def create_session_store(store_type) -> SessionStore:
+    """
+    create a session store instance
+    :param store_type: session store type code
+    :return: session store instance
+    """
+    if store_type == "sqlite":
+        return SqliteSessionStore(os.path.join(get_appdata_dir(), "sessions.db"))
+    raise RuntimeError("unknown session store type {}".format(store_type))
+
+
+def get_session_store():
+    """获取进程内共享的会话存储，未开启时返回None"""
+    global _store
+    store_type = conf().get("session_store")
+    if not store_type:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = create_session_store(store_type)
+        return _store
+
+
+def flush_session_store(timeout=None):
+    """退出前调用，等待会话写入完成"""
+    if _store is not None and not _store.flush(timeout):
+        logger.warning("[SessionStore] flush timeout, some sessions may be lost")
@@ -1,7 +1,9 @@
 from bot.bot_factory import create_bot
 from bridge.context import Context
 from bridge.reply import Reply
+from bridge.reply_cache import get_reply_cache
 from common import const
+from common.circuit_breaker import RetryLater
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -26,6 +28,8 @@ class Bridge(object):
         if conf().get("use_linkai") and conf().get("linkai_api_key"):
             self.btype["chat"] = const.LINKAI
         self.bots = {}
+        # 回复缓存在创建Bridge时按当时的配置创建，未开启时为None
+        self.reply_cache = get_reply_cache()
 
     def get_bot(self, typename):
         if self.bots.get(typename) is None:
@@ -44,7 +48,28 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        bot = self.get_bot("chat")
+        cache = self.reply_cache
+        if cache is None:
+            return bot.reply(query, context)
+        key, reply = cache.lookup(bot, query, context)
+        if reply is not None:
+            return reply
+        try:
+            reply = bot.reply(query, context)
+        except RetryLater as e:  # 重试在等待后由通道继续，继续得到的回复同样写入缓存
+            raise e.then(lambda reply: cache.store(key, bot, context, reply))
+        return cache.store(key, bot, context, reply)
+
+    async def fetch_reply_content_async(self, query, context: Context) -> Reply:
+        bot = self.get_bot("chat")
+        cache = self.reply_cache
+        if cache is None:
+            return await bot.reply_async(query, context)
+        key, reply = cache.lookup(bot, query, context)
+        if reply is not None:
+            return reply
+        return cache.store(key, bot, context, await bot.reply_async(query, context))
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
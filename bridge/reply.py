@@ -8,6 +8,7 @@ class ReplyType(Enum):
     VOICE = 2  # 音频文件
     IMAGE = 3  # 图片文件
     IMAGE_URL = 4  # 图片URL
+    STREAM = 5  # 流式文本，content为逐段返回回复内容的迭代器(或异步迭代器)
 
     INFO = 9
     ERROR = 10
@@ -0,0 +1,198 @@
+"""
+对话回复缓存
+
+开启 reply_cache 后，Bridge在把文本消息交给对话bot之前先查缓存，相同的问题直接返回之前的回复，不再请求接口。
+缓存的key由以下部分组成：
+- 归一化的问题：全角转半角、忽略大小写、合并空白、去掉结尾的标点
+- 会话的system prompt(角色扮演等插件会修改)和使用的模型
+- reply_cache_context_turns大于0时，再加上会话最近几条消息的哈希，只有上下文也相同时才命中
+条目在写入reply_cache_ttl秒后过期，超过reply_cache_max_entries时淘汰最久未命中的。
+命中时问题和回复照常记入会话，后续的对话不受影响；只缓存正常的文本回复，指令和错误回复不缓存。
+reply_cache_disabled_sessions中的会话，以及被插件设置了context["no_reply_cache"]的消息不使用缓存。
+"""
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common import metrics
+from common.log import logger
+from config import conf, conf_snapshot
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s,.!?;:~，。！？；：、…]+$")
+
+
+def normalize_query(query: str) -> str:
+    """归一化问题文本，只有标点、空白、大小写或全半角不同的问题视为相同"""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = _SPACES.sub(" ", query).strip()
+    return _TRAILING_PUNCTUATION.sub("", query)
+
+
+class ReplyCache(object):
+    def __init__(self, ttl=3600, max_entries=1000, context_turns=0):
+        """
+        :param ttl: 条目写入后的有效期，单位秒
+        :param max_entries: 最多缓存的条目数，超出时淘汰最久未命中的
+        :param context_turns: 计入key的最近消息数，0表示不考虑上下文
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.context_turns = context_turns
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (回复内容, 过期时间)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, bot, query, context: Context):
+        """
+        查询缓存
+        :return: (key, 命中时的回复)，不可缓存时key为None
+        """
+        key = self._make_key(bot, query, context)
+        if key is None:
+            return None, None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return key, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        logger.debug("[ReplyCache] hit, session_id={}, query={}".format(context["session_id"], query))
+        self._record_hit(bot, query, context, entry[0])
+        return key, Reply(ReplyType.TEXT, entry[0])
+
+    def store(self, key, bot, context: Context, reply: Reply):
+        """
+        缓存bot的回复，流式回复包装为读完后再写入缓存的迭代器
+        :return: 交给通道的回复
+        """
+        if key is None or reply is None:
+            return reply
+        if reply.type == ReplyType.TEXT and reply.content:
+            self._put(key, reply.content)
+        elif reply.type == ReplyType.STREAM:
+            reply.content = self._tee_stream(key, reply.content, lambda content: self._recorded(bot, context, content))
+        return reply
+
+    def get_metrics(self) -> dict:
+        """
+        :return: 当前条目数、命中数、未命中数和淘汰数
+        """
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _put(self, key, content):
+        with self.lock:
+            self.entries[key] = (content, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def _tee_stream(self, key, stream, succeeded):
+        """
+        :param succeeded: 判断读完的内容是否为正常回复的函数，出错时流中返回的是错误提示，不能缓存
+        """
+        if hasattr(stream, "__aiter__"):
+
+            async def tee():
+                contents = []
+                async for delta in stream:
+                    contents.append(delta)
+                    yield delta
+                content = "".join(contents)
+                if succeeded(content):
+                    self._put(key, content)
+
+        else:
+
+            def tee():
+                contents = []
+                for delta in stream:
+                    contents.append(delta)
+                    yield delta
+                content = "".join(contents)
+                if succeeded(content):
+                    self._put(key, content)
+
+        return tee()
+
+    def _recorded(self, bot, context: Context, content):
+        """bot只在正常回复时把回复记入会话，以此判断流式回复是否成功"""
+        sessions = getattr(bot, "sessions", None)
+        if sessions is None or not content:
+            return False
+        session = sessions.sessions.get(context["session_id"])
+        return session is not None and len(session.messages) > 1 and session.messages[-1].content == content
+
+    def _make_key(self, bot, query, context: Context):
+        if context is None or context.type != ContextType.TEXT or not query:
+            return None
+        config = conf_snapshot()
+        if query.startswith("#") or query in config.clear_memory_commands:
+            return None
+        session_id = context["session_id"]
+        if context.get("no_reply_cache") or session_id in (conf().get("reply_cache_disabled_sessions") or []):
+            return None
+        system_prompt = config.character_desc
+        recent = ""
+        sessions = getattr(bot, "sessions", None)
+        # 只读取已有的会话，不存在的会话与新建的会话一样使用默认的system prompt、没有上下文
+        session = sessions.peek_session(session_id) if sessions is not None else None
+        if session is not None:
+            system_prompt = session.system_prompt
+            if self.context_turns:
+                with session.lock:
+                    recent = "\n".join("{}:{}".format(item.role, item.content) for item in session.messages[1:][-self.context_turns :])
+        model = context.get("gpt_model") or config.model
+        raw = "\0".join([normalize_query(query), system_prompt or "", model or "", recent])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _record_hit(self, bot, query, context: Context, content):
+        """把命中的问题和回复记入会话，保持上下文连贯"""
+        sessions = getattr(bot, "sessions", None)
+        if sessions is None:
+            return
+        try:
+            sessions.session_query(query, context["session_id"])
+            sessions.session_reply(content, context["session_id"])
+        except Exception as e:
+            logger.warning("[ReplyCache] record cached reply to session failed: {}".format(e))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_reply_cache():
+    """获取进程内共享的回复缓存，未开启reply_cache时返回None"""
+    global _cache
+    if not conf().get("reply_cache", False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ReplyCache(
+                    ttl=conf().get("reply_cache_ttl", 3600),
+                    max_entries=conf().get("reply_cache_max_entries", 1000),
+                    context_turns=conf().get("reply_cache_context_turns", 0),
+                )
+                metrics.register("reply_cache", _cache.get_metrics)
+    return _cache
@@ -5,6 +5,7 @@ Message sending channel abstract class
 from bridge.bridge import Bridge
 from bridge.context import Context
 from bridge.reply import *
+from common import latency
 
 
 class Channel(object):
@@ -34,10 +35,17 @@ class Channel(object):
         raise NotImplementedError
 
     def build_reply_content(self, query, context: Context = None) -> Reply:
-        return Bridge().fetch_reply_content(query, context)
+        with latency.timer(latency.STAGE_BOT, Bridge().get_bot_type("chat")):
+            return Bridge().fetch_reply_content(query, context)
+
+    async def build_reply_content_async(self, query, context: Context = None) -> Reply:
+        with latency.timer(latency.STAGE_BOT, Bridge().get_bot_type("chat")):
+            return await Bridge().fetch_reply_content_async(query, context)
 
     def build_voice_to_text(self, voice_file) -> Reply:
-        return Bridge().fetch_voice_to_text(voice_file)
+        with latency.timer(latency.STAGE_VOICE_TO_TEXT, Bridge().get_bot_type("voice_to_text")):
+            return Bridge().fetch_voice_to_text(voice_file)
 
     def build_text_to_voice(self, text) -> Reply:
-        return Bridge().fetch_text_to_voice(text)
+        with latency.timer(latency.STAGE_TEXT_TO_VOICE, Bridge().get_bot_type("text_to_voice")):
+            return Bridge().fetch_text_to_voice(text)
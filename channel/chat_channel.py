@@ -1,16 +1,25 @@
+import asyncio
 import os
-import re
 import threading
 import time
 from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.chat_scheduler import LANE_ADMIN, LANE_GROUP, LANE_PRIVATE, create_scheduler
+from channel.inbound_store import REPLAYABLE_TYPES, InboundStore
+from channel.outbound_dispatcher import OutboundDispatcher
+from channel.reorder_buffer import ReorderBuffer
+from channel.stream_chunker import StreamChunker
+from channel.trigger_matcher import get_trigger_matcher
+from common import latency, metrics
+from common.circuit_breaker import RetryLater, deferrable
 from common.dequeue import Dequeue
 from common.log import logger
-from config import conf
+from config import conf, conf_snapshot, get_appdata_dir
 from plugins import *
 
 try:
@@ -24,11 +33,41 @@ class ChatChannel(Channel):
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
-    sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    retries = {}  # 等待结束、等待处理名额的重试，值为[(context, RetryLater)]，重试期间仍占用session的并发名额
+    retry_timers = {}  # 还在等待的重试，值为[(threading.Timer, context)]，等待结束后移到retries
+    sessions = {}  # 用于控制并发，每个session_id同时最多有concurrency_in_session个context在处理，值为[排队队列, 信号量, 回复重排缓冲区]
+    lock = threading.RLock()  # 用于控制对sessions的访问，future被取消或提前完成时回调会在持锁线程中同步执行，因此需要可重入
     handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+    handler_loop = None  # async_handler模式下处理消息的事件循环，wechaty会共用自己的事件循环
+    outbound_inline = False  # 是否在处理线程中同步发送回复，需要同步拿到发送结果的通道(如公众号被动回复)设为True
+    durable_inbound = True  # 是否支持持久化待处理消息，重启后无法再回复的通道(如公众号被动回复)设为False
+    support_stream = False  # 是否支持流式回复，一条回复可以分多条消息发送的通道设为True
 
     def __init__(self):
+        # 有待处理消息或有任务结束时通知调度器，consume阻塞在调度器上等待下一个要处理的session
+        self.scheduler = create_scheduler(conf().get("chat_scheduler", "wfq"), conf().get("chat_scheduler_lane_weights"))
+        metrics.register("scheduler.{}".format(self.__class__.__name__), self.scheduler.get_metrics)
+        # 开启后消息在事件循环中以协程处理，同时处理的消息数不再受线程池大小限制
+        self.async_handler = conf().get("async_handler", False)
+        # 处理中消息的空闲名额，只在有空闲名额时才从调度器取session，避免消息堆积在线程池内部的队列中绕过调度
+        if self.async_handler:
+            self.worker_slots = threading.Semaphore(conf().get("async_handler_max_inflight", 256))
+        else:
+            self.worker_slots = threading.Semaphore(self.handler_pool._max_workers)
+        # 发送调度器，处理线程把回复交给它后立即返回，发送、重试和分段间隔都不再占用处理线程
+        self.outbound = OutboundDispatcher(
+            self.__class__.__name__,
+            workers=conf().get("outbound_workers", 4),
+            rate_limit=conf().get("outbound_rate_limit", 0),
+            inline=self.outbound_inline,
+        )
+        # 持久化待处理消息，重启后重放上次没有处理完的消息
+        self.inbound_store = None
+        if conf().get("inbound_queue_durable", False) and self.durable_inbound:
+            self.inbound_store = InboundStore(os.path.join(get_appdata_dir(), "inbound_queue.db"))
+        self.inbound_replayed = False
+        self.draining = False  # 退出前等待处理中的消息完成，不再处理新消息
+        self.retrying = 0  # 正在等待重试的消息数
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
@@ -46,7 +85,8 @@ class ChatChannel(Channel):
         first_in = "receiver" not in context
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
-            config = conf()
+            config = conf_snapshot()
+            matcher = get_trigger_matcher()
             cmsg = context["msg"]
             user_data = conf().get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
@@ -55,23 +95,9 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.is_group_in_white_list(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if matcher.is_group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     return None
@@ -84,20 +110,22 @@ class ChatChannel(Channel):
             context = e_context["context"]
             if e_context.is_pass() or context is None:
                 return context
-            if cmsg.from_user_id == self.user_id and not config.get("trigger_by_self", True):
+            if cmsg.from_user_id == self.user_id and not config.trigger_by_self:
                 logger.debug("[WX]self message skipped")
                 return None
 
         # 消息内容匹配过程，并处理content
+        config = conf_snapshot()
         if ctype == ContextType.TEXT:
+            matcher = get_trigger_matcher()
             if first_in and "」\n- - - - - - -" in content:  # 初次匹配 过滤引用消息
                 logger.debug("[WX]reference query skipped")
                 return None
 
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = matcher.group_chat_prefix.match(content)
+                match_contain = matcher.group_chat_keyword.search(content)
                 flag = False
                 if match_prefix is not None or match_contain is not None:
                     flag = True
@@ -105,17 +133,16 @@ class ChatChannel(Channel):
                         content = content.replace(match_prefix, "", 1).strip()
                 if context["msg"].is_at:
                     logger.info("[WX]receive group at")
-                    if not conf().get("group_at_off", False):
+                    if not config.group_at_off:
                         flag = True
-                    pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                    content = re.sub(pattern, r"", content)
+                    content = matcher.mention_pattern(self.name).sub(r"", content)
 
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
                         logger.info("[WX]receive group voice, but checkprefix didn't match")
                     return None
             else:  # 单聊
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.single_chat_prefix.match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -123,31 +150,36 @@ class ChatChannel(Channel):
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix"))
+            img_match_prefix = matcher.image_create_prefix.match(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.always_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.voice_reply_voice and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
 
         return context
 
-    def _handle(self, context: Context):
+    def _handle(self, context: Context, retry: RetryLater = None):
         if context is None or not context.content:
             return
         logger.debug("[WX] ready to handle context: {}".format(context))
-        # reply的构建步骤
-        reply = self._generate_reply(context)
+        # reply的构建步骤，需要等待后重试时抛出RetryLater，由_thread_pool_callback在等待结束后重新提交，retry为重新提交的重试
+        if retry is None:
+            reply = self._generate_reply(context)
+        else:
+            with deferrable():
+                reply = retry.resume()
 
         logger.debug("[WX] ready to decorate reply: {}".format(reply))
         # reply的包装步骤
-        reply = self._decorate_reply(context, reply)
+        with latency.timer(latency.STAGE_DECORATE, self.__class__.__name__):
+            reply = self._decorate_reply(context, reply)
 
         # reply的发送步骤
         self._send_reply(context, reply)
@@ -165,28 +197,11 @@ class ChatChannel(Channel):
             if e_context.is_break():
                 context["generate_breaked_by"] = e_context["breaked_by"]
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
-                reply = super().build_reply_content(context.content, context)
+                self._mark_stream(context)
+                with deferrable():  # bot的重试不在处理线程中等待
+                    reply = super().build_reply_content(context.content, context)
             elif context.type == ContextType.VOICE:  # 语音消息
-                cmsg = context["msg"]
-                cmsg.prepare()
-                file_path = context.content
-                wav_path = os.path.splitext(file_path)[0] + ".wav"
-                try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[WX]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
-                # 语音识别
-                reply = super().build_voice_to_text(wav_path)
-                # 删除临时文件
-                try:
-                    os.remove(file_path)
-                    if wav_path != file_path:
-                        os.remove(wav_path)
-                except Exception as e:
-                    pass
-                    # logger.warning("[WX]delete temp file error: " + str(e))
-
+                reply = self._voice_to_text(context)
                 if reply.type == ReplyType.TEXT:
                     new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
                     if new_context:
@@ -200,6 +215,33 @@ class ChatChannel(Channel):
                 return
         return reply
 
+    # 开启stream_reply时请求bot流式回复，bot是否支持由bot决定；需要语音回复的消息不使用流式回复
+    def _mark_stream(self, context: Context):
+        if self.support_stream and context.type == ContextType.TEXT and "desire_rtype" not in context and conf_snapshot().stream_reply:
+            context["stream"] = True
+
+    def _voice_to_text(self, context: Context) -> Reply:
+        cmsg = context["msg"]
+        cmsg.prepare()
+        file_path = context.content
+        wav_path = os.path.splitext(file_path)[0] + ".wav"
+        try:
+            any_to_wav(file_path, wav_path)
+        except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+            logger.warning("[WX]any to wav error, use raw path. " + str(e))
+            wav_path = file_path
+        # 语音识别
+        reply = super().build_voice_to_text(wav_path)
+        # 删除临时文件
+        try:
+            os.remove(file_path)
+            if wav_path != file_path:
+                os.remove(wav_path)
+        except Exception as e:
+            pass
+            # logger.warning("[WX]delete temp file error: " + str(e))
+        return reply
+
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -221,12 +263,22 @@ class ChatChannel(Channel):
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
+                    config = conf_snapshot()
                     if context.get("isgroup", False):
                         reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+                        reply_text = config.group_chat_reply_prefix + reply_text + config.group_chat_reply_suffix
                     else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
+                        reply_text = config.single_chat_reply_prefix + reply_text + config.single_chat_reply_suffix
                     reply.content = reply_text
+                elif reply.type == ReplyType.STREAM:
+                    config = conf_snapshot()
+                    if context.get("isgroup", False):
+                        prefix = config.group_chat_reply_prefix + "@" + context["msg"].actual_user_nickname + "\n"
+                        suffix = config.group_chat_reply_suffix
+                    else:
+                        prefix = config.single_chat_reply_prefix
+                        suffix = config.single_chat_reply_suffix
+                    reply.content = _decorate_stream(reply.content, prefix, suffix)
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE:
@@ -239,6 +291,12 @@ class ChatChannel(Channel):
             return reply
 
     def _send_reply(self, context: Context, reply: Reply):
+        reply = self._emit_send_reply(context, reply)
+        if reply:
+            self._deliver_reply(reply, context)
+
+    # 触发ON_SEND_REPLY事件，返回需要发送的回复，不需要发送时返回None
+    def _emit_send_reply(self, context: Context, reply: Reply):
         if reply and reply.type:
             e_context = PluginManager().emit_event(
                 EventContext(
@@ -249,19 +307,152 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[WX] ready to send reply: {}, context: {}".format(reply, context))
-                self._send(reply, context)
+                return reply
+        return None
+
+    def _deliver_reply(self, reply: Reply, context: Context):
+        if reply.type == ReplyType.STREAM:
+            self._send_stream(reply, context)
+        else:
+            self._send(reply, context)
 
-    def _send(self, reply: Reply, context: Context, retry_cnt=0):
+    # 边接收流式回复边按句子分段发送，每段作为一条文本回复经过重排缓冲区和发送调度器，保证按顺序发出
+    def _send_stream(self, reply: Reply, context: Context):
+        sink = self._create_stream_sink(context)
         try:
-            self.send(reply, context)
+            for delta in reply.content:
+                sink.feed(delta)
         except Exception as e:
-            logger.error("[WX] sendMsg error: {}".format(str(e)))
-            if isinstance(e, NotImplementedError):
+            logger.exception("[WX] stream reply interrupted: {}".format(e))
+        finally:
+            sink.close()
+
+    async def _send_stream_async(self, reply: Reply, context: Context):
+        sink = self._create_stream_sink(context)
+        try:
+            async for delta in reply.content:
+                sink.feed(delta)
+        except Exception as e:
+            logger.exception("[WX] stream reply interrupted: {}".format(e))
+        finally:
+            sink.close()
+
+    # 流式回复的接收方，需要提供feed和close方法，通道可以重写以改变分段的发送方式
+    def _create_stream_sink(self, context: Context):
+        def send_chunk(text):
+            text = text.strip("\n")
+            if text.strip():
+                self._send(Reply(ReplyType.TEXT, text), context)
+
+        return StreamChunker(send_chunk, conf_snapshot().stream_reply_min_chars)
+
+    # 交给发送调度器，同一接收者按顺序发送，失败时由调度器延迟重试
+    # 同一会话并行处理多条消息时，先经过重排缓冲区，保证回复按消息的处理顺序发出
+    def _send(self, reply: Reply, context: Context):
+        self._in_reply_order(context, self._submit_send, reply, context)
+
+    def _submit_send(self, reply: Reply, context: Context):
+        self.outbound.submit(context["receiver"], self._send_now, reply, context)
+
+    # 有重排缓冲区时按消息的处理顺序放行func，否则直接执行
+    def _in_reply_order(self, context: Context, func, *args):
+        reorder_buffer = self._get_reorder_buffer(context)
+        if reorder_buffer is not None:
+            reorder_buffer.put(context["reorder_seq"], func, *args)
+        else:
+            func(*args)
+
+    @staticmethod
+    def _release_reordered(func, *args):
+        func(*args)
+
+    def _get_reorder_buffer(self, context: Context):
+        if "reorder_seq" not in context:
+            return None
+        with self.lock:
+            session = self.sessions.get(context["session_id"])
+            return session[2] if session is not None else None
+
+    def _send_now(self, reply: Reply, context: Context):
+        with latency.timer(latency.STAGE_SEND, self.__class__.__name__):
+            self.send(reply, context)
+
+    # async_handler模式下的处理流程，在事件循环中运行，对话请求以协程方式等待，插件、语音和发送等阻塞步骤放到线程池中执行
+    async def _handle_async(self, context: Context):
+        if context is None or not context.content:
+            return
+        logger.debug("[WX] ready to handle context: {}".format(context))
+        # reply的构建步骤
+        reply = await self._generate_reply_async(context)
+
+        logger.debug("[WX] ready to decorate reply: {}".format(reply))
+        # reply的包装步骤
+        with latency.timer(latency.STAGE_DECORATE, self.__class__.__name__):
+            reply = await self._decorate_reply_async(context, reply)
+
+        # reply的发送步骤
+        await self._send_reply_async(context, reply)
+
+    async def _generate_reply_async(self, context: Context, reply: Reply = Reply()) -> Reply:
+        e_context = await self._run_blocking(
+            PluginManager().emit_event,
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            ),
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[WX] ready to handle context: type={}, content={}".format(context.type, context.content))
+            if e_context.is_break():
+                context["generate_breaked_by"] = e_context["breaked_by"]
+            if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+                self._mark_stream(context)
+                reply = await super().build_reply_content_async(context.content, context)
+            elif context.type == ContextType.VOICE:  # 语音消息
+                reply = await self._run_blocking(self._voice_to_text, context)
+                if reply.type == ReplyType.TEXT:
+                    new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
+                    if new_context:
+                        reply = await self._generate_reply_async(new_context)
+                    else:
+                        return
+            elif context.type == ContextType.IMAGE:  # 图片消息，当前无默认逻辑
+                pass
+            else:
+                logger.error("[WX] unknown context type: {}".format(context.type))
                 return
-            logger.exception(e)
-            if retry_cnt < 2:
-                time.sleep(3 + 3 * retry_cnt)
-                self._send(reply, context, retry_cnt + 1)
+        return reply
+
+    async def _decorate_reply_async(self, context: Context, reply: Reply) -> Reply:
+        return await self._run_blocking(self._decorate_reply, context, reply)
+
+    async def _send_reply_async(self, context: Context, reply: Reply):
+        reply = await self._run_blocking(self._emit_send_reply, context, reply)
+        if not reply:
+            return
+        if reply.type == ReplyType.STREAM and hasattr(reply.content, "__aiter__"):
+            # 异步迭代的流式回复直接在事件循环中接收，分段的发送不会阻塞
+            await self._send_stream_async(reply, context)
+        else:
+            await self._run_blocking(self._deliver_reply, reply, context)
+
+    async def _run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.handler_pool, func, *args)
+
+    def _get_handler_loop(self):
+        if self.handler_loop is None:
+            loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=self._run_handler_loop, args=(loop,))
+            _thread.setDaemon(True)
+            _thread.start()
+            self.handler_loop = loop
+        return self.handler_loop
+
+    def _run_handler_loop(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
 
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
@@ -271,9 +462,12 @@ class ChatChannel(Channel):
 
     def _thread_pool_callback(self, session_id, **kwargs):
         def func(worker: Future):
+            retry = None
             try:
                 worker_exception = worker.exception()
-                if worker_exception:
+                if isinstance(worker_exception, RetryLater):
+                    retry = worker_exception
+                elif worker_exception:
                     self._fail_callback(session_id, exception=worker_exception, **kwargs)
                 else:
                     self._success_callback(session_id, **kwargs)
@@ -281,68 +475,297 @@ class ChatChannel(Channel):
                 logger.info("Worker cancelled, session_id = {}".format(session_id))
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
+            self.worker_slots.release()
+            if retry is not None:
+                self._schedule_retry(session_id, kwargs["context"], retry)
+                return
             with self.lock:
-                self.sessions[session_id][1].release()
+                self._finish_context(session_id, kwargs["context"])
 
         return func
 
+    # context处理结束(完成、异常、被取消)，归还session的并发名额，需持有self.lock
+    def _finish_context(self, session_id, context: Context):
+        # 回复都发送完毕后才从持久化队列删除，发送前退出时下次启动会重放
+        self._in_reply_order(context, self._ack_after_send, context)
+        reorder_buffer = self.sessions[session_id][2]
+        if reorder_buffer is not None:
+            reorder_buffer.complete(context["reorder_seq"])
+        self.sessions[session_id][1].release()
+        self._notify(session_id, context)  # 信号量已释放，通知consume继续处理该session
+
+    def _ack_after_send(self, context: Context):
+        if self.inbound_store is not None and "inbound_id" in context:
+            self.outbound.after(context["receiver"], self._ack, context)
+
+    # 等待期间只释放处理名额，保留session的并发名额和回复顺序，等待结束后由调度器重新分配处理名额
+    def _schedule_retry(self, session_id, context: Context, retry: RetryLater):
+        logger.debug("[WX] context will be retried in {:.2f}s: {}".format(retry.delay, context))
+        timer = threading.Timer(retry.delay, self._retry_ready, args=(session_id, context, retry))
+        timer.setDaemon(True)
+        with self.lock:
+            self.retrying += 1
+            self.retry_timers.setdefault(session_id, []).append((timer, context))
+        timer.start()
+
+    def _retry_ready(self, session_id, context: Context, retry: RetryLater):
+        with self.lock:
+            timers = self.retry_timers.get(session_id, [])
+            waiting = [item for item in timers if item[1] is context]
+            if not waiting:  # 等待期间session被取消
+                return
+            timers.remove(waiting[0])
+            if not timers:
+                del self.retry_timers[session_id]
+            if session_id not in self.retries:
+                self.retries[session_id] = deque()
+            self.retries[session_id].append((context, retry))
+            self.scheduler.put(session_id, self._get_lane(context))
+
     def produce(self, context: Context):
         session_id = context["session_id"]
+        if self.inbound_store is not None:
+            if not self.inbound_replayed:
+                with self.lock:
+                    if not self.inbound_replayed:
+                        self._replay_inbound()
+            self._persist(context)  # 在锁外写入，写入由存储的后台线程提交，不会阻塞其它消息的排队和调度
         with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
+            if self.draining:  # 正在退出，开启持久化时消息留在队列中等下次启动处理
+                logger.info("[WX] channel is draining, skip context: {}".format(context))
+                return
+            self._get_session(session_id)
             if context.type == ContextType.TEXT and context.content.startswith("#"):
                 self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
-            else:
-                self.sessions[session_id][0].put(context)
+            elif not self._enqueue_bounded(session_id, context):
+                return
+            if latency.enabled():
+                context["produce_time"] = time.monotonic()
+            self._notify(session_id, context)
+
+    # 获取session，不存在时创建，需持有self.lock
+    def _get_session(self, session_id):
+        if session_id not in self.sessions:
+            config = conf_snapshot()
+            concurrency = config.concurrency_in_session
+            self.sessions[session_id] = [
+                Dequeue(),
+                threading.BoundedSemaphore(concurrency),
+                ReorderBuffer(self._release_reordered, config.reorder_timeout) if concurrency > 1 else None,
+            ]
+        return self.sessions[session_id]
+
+    # 写入持久化队列，已写入的context(如被合并后)更新记录
+    # 语音、图片等消息的文件需要通过原始消息对象下载，重启后无法恢复，只持久化文字消息
+    def _persist(self, context: Context):
+        if self.inbound_store is None or context.type not in REPLAYABLE_TYPES:
+            return
+        if "inbound_id" in context:
+            self.inbound_store.update(context["inbound_id"], context)
+        else:
+            context["inbound_id"] = self.inbound_store.append(self.__class__.__name__, context)
+
+    # 处理完成、被丢弃或取消时从持久化队列删除
+    def _ack(self, context: Context):
+        if self.inbound_store is not None and "inbound_id" in context:
+            self.inbound_store.ack(context["inbound_id"])
+
+    # 把上次没有处理完的消息放回队列，在收到第一条消息(通道已经可以发送)时调用，需持有self.lock
+    def _replay_inbound(self):
+        self.inbound_replayed = True
+        pending = self.inbound_store.pending_records(self.__class__.__name__)
+        for inbound_id, context in pending:
+            context["inbound_id"] = inbound_id
+            if context.type not in REPLAYABLE_TYPES:
+                logger.warning("[WX] replay skip context, media message can not be restored: {}".format(context))
+                self._ack(context)
+                continue
+            cmsg = context.get("msg")
+            if cmsg is not None:  # api key不写入数据库，按发送者重新读取
+                context["openai_api_key"] = conf().get_user_data(cmsg.from_user_id).get("openai_api_key")
+            session_id = context["session_id"]
+            self._get_session(session_id)[0].put(context)
+            self._notify(session_id, context)
+        if pending:
+            logger.info("[WX] replay {} unfinished contexts".format(len(pending)))
+
+    # 按session_queue_max_size限制排队长度，超出后按session_queue_overflow_policy处理，返回context是否被接收(含合并)
+    def _enqueue_bounded(self, session_id, context: Context):
+        context_queue = self.sessions[session_id][0]
+        config = conf_snapshot()
+        max_size = config.session_queue_max_size
+        if not max_size or context_queue.qsize() < max_size:
+            context_queue.put(context)
+            return True
+        policy = config.session_queue_overflow_policy
+        if policy == "drop_newest":
+            logger.warning("[WX] session {} queue is full, drop newest context: {}".format(session_id, context))
+            self._ack(context)
+            return False
+        if policy == "coalesce":
+            last = context_queue.queue[-1]
+            if _coalesce(last, context):
+                logger.info("[WX] session {} queue is full, coalesce context into the last one".format(session_id))
+                self._persist(last)
+                self._ack(context)
+                return True
+            for merged in _coalesce_queue(context_queue):
+                self._ack(merged)
+            if self.inbound_store is not None:
+                for queued in list(context_queue.queue):
+                    self._persist(queued)
+        if context_queue.qsize() >= max_size:
+            dropped = self._drop_oldest(context_queue)
+            if dropped is None:  # 排队的都是管理命令，不丢弃，改为丢弃新消息
+                logger.warning("[WX] session {} queue is full of admin commands, drop newest context: {}".format(session_id, context))
+                self._ack(context)
+                return False
+            logger.warning("[WX] session {} queue is full, drop oldest context: {}".format(session_id, dropped))
+            self._ack(dropped)
+        context_queue.put(context)
+        return True
+
+    # 从队列中取出最早的非管理命令消息，管理命令和插件指定在管理通道的消息不会被丢弃，没有可丢弃的消息时返回None
+    def _drop_oldest(self, context_queue: Dequeue):
+        with context_queue.mutex:
+            for queued in context_queue.queue:
+                if self._get_lane(queued) != LANE_ADMIN:
+                    context_queue.queue.remove(queued)
+                    return queued
+        return None
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 调度通道，插件可以通过context["lane"]指定
+    def _get_lane(self, context: Context):
+        if context is None:
+            return LANE_PRIVATE
+        if "lane" in context:
+            return context["lane"]
+        if context.type == ContextType.TEXT and context.content.startswith("#"):
+            return LANE_ADMIN
+        if context.get("isgroup", False):
+            return LANE_GROUP
+        return LANE_PRIVATE
+
+    # 通知调度器session有待处理的工作，以队首消息决定所在的调度通道，需持有self.lock
+    def _notify(self, session_id, context: Context = None):
+        context_queue = self.sessions[session_id][0]
+        if not context_queue.empty():
+            context = context_queue.queue[0]
+        self.scheduler.put(session_id, self._get_lane(context))
+
+    # 消费者函数，单独线程，阻塞等待调度器给出下一个被通知的session，只处理该session
     def consume(self):
         while True:
-            with self.lock:
-                session_ids = list(self.sessions.keys())
-                for session_id in session_ids:
-                    context_queue, semaphore = self.sessions[session_id]
-                    if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                        if not context_queue.empty():
-                            context = context_queue.get()
-                            logger.debug("[WX] consume context: {}".format(context))
-                            future: Future = self.handler_pool.submit(self._handle, context)
-                            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                        elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                        else:
-                            semaphore.release()
-            time.sleep(0.1)
-
-    # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
+            self.worker_slots.acquire()
+            session_id = self.scheduler.get()
+            if not self._dispatch(session_id):
+                self.worker_slots.release()
+
+    # 尝试把session队首的消息提交到线程池，返回是否占用了线程池的名额
+    def _dispatch(self, session_id):
+        with self.lock:
+            if session_id not in self.sessions:  # 重复的通知，session已经被清理
+                return False
+            if self.draining:
+                return False
+            context_queue, semaphore, reorder_buffer = self.sessions[session_id]
+            retries = self.retries.get(session_id)
+            if retries:  # 等待结束的重试已占用session的并发名额，优先处理
+                context, retry = retries.popleft()
+                if retries:
+                    self.scheduler.put(session_id, self._get_lane(retries[0][0]))
+                else:
+                    del self.retries[session_id]
+                self.retrying -= 1
+                self._submit(session_id, context, retry)
+                if not context_queue.empty():
+                    self._notify(session_id)
+                return True
+            if not semaphore.acquire(blocking=False):  # 没有空闲的并发名额，等任务结束的回调再次通知
+                return False
+            if not context_queue.empty():
+                context = context_queue.get()
+                logger.debug("[WX] consume context: {}".format(context))
+                if reorder_buffer is not None:
+                    context["reorder_seq"] = reorder_buffer.stamp()
+                if "produce_time" in context:
+                    latency.record(latency.STAGE_QUEUE_WAIT, self.__class__.__name__, time.monotonic() - context["produce_time"])
+                self._submit(session_id, context)
+                if not context_queue.empty():  # 还有排队的消息，可能还有空闲的并发名额，排到所在通道的末尾
+                    self._notify(session_id)
+                return True
+            elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
+                self.futures[session_id] = [t for t in self.futures.get(session_id, []) if not t.done()]
+                assert len(self.futures[session_id]) == 0, "thread pool error"
+                del self.sessions[session_id]
+                del self.futures[session_id]
+            else:
+                semaphore.release()
+
+    # 把context提交到事件循环或线程池，retry为等待结束后继续的重试，需持有self.lock
+    def _submit(self, session_id, context: Context, retry: RetryLater = None):
+        if self.async_handler:
+            future: Future = asyncio.run_coroutine_threadsafe(self._handle_async(context), self._get_handler_loop())
+        else:
+            future: Future = self.handler_pool.submit(self._handle, context, retry)
+        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+        if session_id not in self.futures:
+            self.futures[session_id] = []
+        self.futures[session_id].append(future)
+
+    # 取消session_id对应的所有任务，只能取消排队的消息、等待重试的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+                self._cancel_session(session_id)
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            for session_id in list(self.sessions):
+                self._cancel_session(session_id)
+
+    # 需持有self.lock
+    def _cancel_session(self, session_id):
+        for future in self.futures.get(session_id, []):
+            future.cancel()
+        cnt = self.sessions[session_id][0].qsize()
+        if cnt > 0:
+            logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+        for context in list(self.sessions[session_id][0].queue):
+            self._ack(context)
+        self.sessions[session_id][0] = Dequeue()
+        # 等待重试的消息占用着session的并发名额，取消时按处理结束归还
+        cancelled = [context for context, retry in self.retries.pop(session_id, [])]
+        for timer, context in self.retry_timers.pop(session_id, []):
+            timer.cancel()
+            cancelled.append(context)
+        if cancelled:
+            logger.info("Cancel {} retrying messages in session {}".format(len(cancelled), session_id))
+        for context in cancelled:
+            self.retrying -= 1
+            self._finish_context(session_id, context)
+
+    def drain(self, timeout):
+        """
+        退出前调用，不再处理新消息，等待处理中的消息完成并发送，最多等待timeout秒
+        排队中的消息在开启持久化时会在下次启动后重放
+        :return: 是否在超时前完成
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            self.draining = True
+            futures = [future for session_futures in self.futures.values() for future in session_futures]
+        logger.info("[WX] draining {} running contexts, timeout={}s".format(len([f for f in futures if not f.done()]), timeout))
+        _, not_done = wait(futures, timeout=timeout)
+        finished = not not_done and self.outbound.join(max(deadline - time.monotonic(), 0))
+        if self.retrying:  # 等待重试的消息不再处理，开启持久化时下次启动后重放
+            logger.warning("[WX] drain skip {} contexts waiting for retry".format(self.retrying))
+            finished = False
+        if self.inbound_store is not None:  # ack和排队中消息的写入
+            finished = self.inbound_store.flush(max(deadline - time.monotonic(), 0)) and finished
+        if not finished:
+            logger.warning("[WX] drain timeout, {} contexts still running, {} waiting for retry".format(len(not_done), self.retrying))
+        return finished
 
 
 def check_prefix(content, prefix_list):
@@ -361,3 +784,61 @@ def check_contain(content, keyword_list):
         if content.find(ky) != -1:
             return True
     return None
+
+
+def _coalesce_key(context: Context):
+    """可合并的文本消息返回发送者id，否则返回None"""
+    if context.type != ContextType.TEXT or context.content.startswith("#") or "desire_rtype" in context:
+        return None
+    cmsg = context.get("msg")
+    if cmsg is None:
+        return None
+    return cmsg.actual_user_id if context.get("isgroup", False) else cmsg.from_user_id
+
+
+def _coalesce(last: Context, context: Context):
+    """把同一发送者连续的文本消息合并到前一条中，合并成功返回True"""
+    key = _coalesce_key(context)
+    if key is None or key != _coalesce_key(last):
+        return False
+    last.content = last.content + "\n" + context.content
+    return True
+
+
+def _coalesce_queue(context_queue: Dequeue):
+    """合并队列中同一发送者连续的文本消息，腾出排队位置，返回被合并掉的消息"""
+    with context_queue.mutex:
+        merged = []
+        removed = []
+        for context in context_queue.queue:
+            if merged and _coalesce(merged[-1], context):
+                removed.append(context)
+                continue
+            merged.append(context)
+        context_queue.queue.clear()
+        context_queue.queue.extend(merged)
+        return removed
+
+
+def _decorate_stream(stream, prefix, suffix):
+    """在流式回复的开头和结尾加上回复前缀和后缀，保持原来的同步或异步迭代方式"""
+    if hasattr(stream, "__aiter__"):
+
+        async def decorated():
+            if prefix:
+                yield prefix
+            async for delta in stream:
+                yield delta
+            if suffix:
+                yield suffix
+
+    else:
+
+        def decorated():
+            if prefix:
+                yield prefix
+            yield from stream
+            if suffix:
+                yield suffix
+
+    return decorated()
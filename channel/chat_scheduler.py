@@ -0,0 +1,195 @@
+"""
+ChatChannel跨session的调度器
+
+ChatChannel在session有待处理消息(或有任务结束)时调用put通知调度器，consume线程阻塞在get上，
+由调度器决定下一个被处理的session。每个session同一时刻在调度器中最多只有一个有效条目。
+
+lane: 调度通道，同一通道内的session按轮询顺序处理，不同通道之间按权重分配处理机会
+    admin: 管理命令(以#开头的文本)
+    private: 私聊
+    group: 群聊
+    plugin: 插件内部产生的消息(插件可以通过context["lane"]指定)
+"""
+
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+
+LANE_ADMIN = "admin"
+LANE_PRIVATE = "private"
+LANE_GROUP = "group"
+LANE_PLUGIN = "plugin"
+
+DEFAULT_LANE_WEIGHTS = {
+    LANE_ADMIN: 8,
+    LANE_PRIVATE: 4,
+    LANE_PLUGIN: 2,
+    LANE_GROUP: 1,
+}
+
+
+class LaneMetrics(object):
+    """记录某个通道中session从通知到被调度的等待时间"""
+
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        self.count += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+
+    def to_dict(self, queued=0):
+        return {
+            "queued": queued,
+            "count": self.count,
+            "avg_wait": self.total_wait / self.count if self.count else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class SessionScheduler(object):
+    def put(self, session_id, lane=LANE_PRIVATE):
+        """
+        通知调度器session_id有待处理的工作
+        :param session_id: 会话id
+        :param lane: session当前所属的调度通道
+        """
+        raise NotImplementedError
+
+    def get(self):
+        """
+        阻塞直到有可调度的session
+        :return: session_id
+        """
+        raise NotImplementedError
+
+    def get_metrics(self) -> dict:
+        """
+        :return: 每个通道的排队数量和等待时间统计
+        """
+        raise NotImplementedError
+
+
+class FifoScheduler(SessionScheduler):
+    """按通知的先后顺序调度，不区分通道"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.queued = {}  # session_id -> 入队时间
+        self.metrics = LaneMetrics()
+
+    def put(self, session_id, lane=LANE_PRIVATE):
+        with self.cond:
+            if session_id in self.queued:
+                return
+            self.queued[session_id] = time.monotonic()
+            self.queue.append(session_id)
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            session_id = self.queue.popleft()
+            self.metrics.record(time.monotonic() - self.queued.pop(session_id))
+            return session_id
+
+    def get_metrics(self) -> dict:
+        with self.cond:
+            return {"fifo": self.metrics.to_dict(len(self.queue))}
+
+
+class WeightedFairScheduler(SessionScheduler):
+    """
+    差额轮询(deficit round-robin)调度
+    每轮访问到一个通道时，该通道的额度增加其权重，每调度一个session消耗1个额度；
+    同一通道内的session轮流调度，某个session处理完一条消息后如仍有消息，会重新排到通道末尾。
+    """
+
+    def __init__(self, weights=None):
+        weights = dict(DEFAULT_LANE_WEIGHTS, **(weights or {}))
+        self.weights = {lane: float(weight) for lane, weight in weights.items() if weight and weight > 0}
+        if not self.weights:
+            raise ValueError("at least one lane should have a positive weight")
+        self.order = sorted(self.weights, key=lambda lane: self.weights[lane], reverse=True)
+        self.cond = threading.Condition()
+        self.lanes = {lane: deque() for lane in self.order}
+        self.deficits = {lane: 0.0 for lane in self.order}
+        self.metrics = {lane: LaneMetrics() for lane in self.order}
+        self.queued = {}  # session_id -> (lane, 入队时间)，与通道中的条目一一对应，通道中对不上的条目已失效
+        self.cursor = 0
+        self.deficits[self.order[0]] = self.weights[self.order[0]]
+
+    def _lane(self, lane):
+        if lane in self.weights:
+            return lane
+        logger.debug("[Scheduler] unknown lane {}, use {}".format(lane, self.order[-1]))
+        return self.order[-1]
+
+    def put(self, session_id, lane=LANE_PRIVATE):
+        lane = self._lane(lane)
+        with self.cond:
+            entry = self.queued.get(session_id)
+            if entry is not None:
+                if self.weights[lane] <= self.weights[entry[0]]:
+                    return
+                # 升级到权重更高的通道(例如排队时收到了管理命令)，原通道中的条目失效
+            entry = (lane, time.monotonic())
+            self.queued[session_id] = entry
+            self.lanes[lane].append((session_id, entry))
+            self.cond.notify()
+
+    def _advance(self):
+        self.cursor = (self.cursor + 1) % len(self.order)
+        lane = self.order[self.cursor]
+        self.deficits[lane] += self.weights[lane]
+
+    def get(self):
+        with self.cond:
+            while True:
+                while not self.queued:
+                    self.cond.wait()
+                lane = self.order[self.cursor]
+                queue = self.lanes[lane]
+                while queue and self.queued.get(queue[0][0]) is not queue[0][1]:
+                    queue.popleft()  # 丢弃失效的条目
+                if not queue:
+                    self.deficits[lane] = 0.0
+                    self._advance()
+                    continue
+                if self.deficits[lane] < 1:
+                    self._advance()
+                    continue
+                session_id, entry = queue.popleft()
+                del self.queued[session_id]
+                self.deficits[lane] -= 1
+                self.metrics[lane].record(time.monotonic() - entry[1])
+                return session_id
+
+    def get_metrics(self) -> dict:
+        with self.cond:
+            queued = {lane: 0 for lane in self.order}
+            for lane, _ in self.queued.values():
+                queued[lane] += 1
+            return {lane: self.metrics[lane].to_dict(queued[lane]) for lane in self.order}
+
+
+def create_scheduler(scheduler_type, weights=None) -> SessionScheduler:
+    """
+    create a scheduler instance
+    :param scheduler_type: scheduler type code
+    :param weights: lane weights, only used by weighted fair scheduler
+    :return: scheduler instance
+    """
+    if scheduler_type == "fifo":
+        return FifoScheduler()
+    elif scheduler_type == "wfq":
+        return WeightedFairScheduler(weights)
+    raise RuntimeError("unknown scheduler type {}".format(scheduler_type))
@@ -0,0 +1,214 @@
+"""
+持久化的待处理消息队列
+
+开启 inbound_queue_durable 后，ChatChannel.produce 接收的每条文字消息都会写入 appdata 目录下的 SQLite 数据库(WAL模式)，
+处理完成、被丢弃或被取消时删除。写入由后台线程批量提交(write-behind)，退出前通过flush等待写入完成。进程重启后，上次没有处理完的消息会在收到第一条新消息时(此时通道已经登录)重新放回队列。
+数据库中保存的是精简的context记录：消息类型、内容、可以用JSON表示的参数，以及ChatMessage的公共字段，不保存原始消息对象和用户的api key。
+"""
+
+import itertools
+import json
+import sqlite3
+import threading
+import time
+from enum import Enum
+
+from bridge.context import Context, ContextType
+from bridge.reply import ReplyType
+from channel.chat_message import ChatMessage
+from common.log import logger
+
+_ENUM_TYPES = {"ContextType": ContextType, "ReplyType": ReplyType}
+# 可以重放的消息类型，语音、图片等消息的文件需要原始消息对象下载，重启后无法恢复
+REPLAYABLE_TYPES = (ContextType.TEXT, ContextType.IMAGE_CREATE)
+# 只在当前进程内有意义的参数，不写入数据库
+_TRANSIENT_KEYS = {"msg", "inbound_id", "produce_time", "reorder_seq"}
+# 密钥不以明文写入数据库，重放时从用户数据中重新读取
+_SECRET_KEYS = {"openai_api_key"}
+_MESSAGE_FIELDS = (
+    "msg_id",
+    "create_time",
+    "ctype",
+    "content",
+    "from_user_id",
+    "from_user_nickname",
+    "to_user_id",
+    "to_user_nickname",
+    "other_user_id",
+    "other_user_nickname",
+    "is_group",
+    "is_at",
+    "actual_user_id",
+    "actual_user_nickname",
+)
+
+
+def _encode_value(value):
+    if isinstance(value, Enum):
+        return {"__enum__": type(value).__name__, "name": value.name}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "__enum__" in value:
+        return _ENUM_TYPES[value["__enum__"]][value["name"]]
+    return value
+
+
+def _is_plain(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and _is_plain(v) for k, v in value.items())
+    return False
+
+
+def encode_context(context: Context) -> str:
+    """把context转换为JSON记录，无法用JSON表示的参数会被忽略"""
+    kwargs = {}
+    for key, value in context.kwargs.items():
+        if key in _TRANSIENT_KEYS or key in _SECRET_KEYS:
+            continue
+        value = _encode_value(value)
+        if _is_plain(value):
+            kwargs[key] = value
+    record = {"type": context.type.name, "content": context.content, "kwargs": kwargs}
+    cmsg = context.kwargs.get("msg")
+    if isinstance(cmsg, ChatMessage):
+        record["msg"] = {field: _encode_value(getattr(cmsg, field)) for field in _MESSAGE_FIELDS}
+    return json.dumps(record, ensure_ascii=False)
+
+
+def decode_context(data: str) -> Context:
+    record = json.loads(data)
+    kwargs = {key: _decode_value(value) for key, value in record["kwargs"].items()}
+    if "msg" in record:
+        cmsg = ChatMessage(None)
+        for field, value in record["msg"].items():
+            setattr(cmsg, field, _decode_value(value))
+        kwargs["msg"] = cmsg
+    return Context(ContextType[record["type"]], record["content"], kwargs)
+
+
+class InboundStore(object):
+    """写入先合并到内存中，由后台线程批量提交，ChatChannel持锁调用时不会等待磁盘"""
+
+    _DELETED = object()
+
+    def __init__(self, path):
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS inbound ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, created REAL NOT NULL, record TEXT NOT NULL)"
+        )
+        # 记录id在进程内分配，之前的记录id都小于first_id，用于区分需要重放的消息
+        self.first_id = (self.conn.execute("SELECT MAX(id) FROM inbound").fetchone()[0] or 0) + 1
+        self.ids = itertools.count(self.first_id)
+        self.cond = threading.Condition()
+        self.pending = {}  # 记录id -> (channel, created, record)新增、record更新或_DELETED删除
+        self.writing = {}  # 后台线程正在写入的记录
+        _thread = threading.Thread(target=self._worker)
+        _thread.setDaemon(True)
+        _thread.start()
+
+    def append(self, channel, context: Context):
+        """
+        写入一条消息
+        :return: 记录id，用于ack
+        """
+        inbound_id = next(self.ids)
+        row = (channel, time.time(), encode_context(context))
+        with self.cond:
+            self.pending[inbound_id] = row
+            self.cond.notify_all()
+        return inbound_id
+
+    def update(self, inbound_id, context: Context):
+        """消息内容被修改(如合并)后更新记录"""
+        record = encode_context(context)
+        with self.cond:
+            current = self.pending.get(inbound_id)
+            if current is self._DELETED:
+                return
+            if isinstance(current, tuple):  # 还没有写入，直接替换要写入的内容
+                self.pending[inbound_id] = current[:2] + (record,)
+            else:
+                self.pending[inbound_id] = record
+            self.cond.notify_all()
+
+    def ack(self, inbound_id):
+        """消息已处理完成或被丢弃，删除记录"""
+        with self.cond:
+            self.pending[inbound_id] = self._DELETED
+            self.cond.notify_all()
+
+    def pending_records(self, channel):
+        """
+        按写入顺序返回通道中上次运行时未ack的消息
+        :return: [(记录id, context)]，无法解析的记录会被删除
+        """
+        with self.db_lock:
+            rows = self.conn.execute("SELECT id, record FROM inbound WHERE channel = ? AND id < ? ORDER BY id", (channel, self.first_id)).fetchall()
+        result = []
+        for inbound_id, data in rows:
+            try:
+                result.append((inbound_id, decode_context(data)))
+            except Exception as e:
+                logger.warning("[Inbound] drop broken record {}: {}".format(inbound_id, e))
+                self.ack(inbound_id)
+        return result
+
+    def flush(self, timeout=None):
+        """
+        等待所有写入完成
+        :return: 是否在超时前完成
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.pending or self.writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                self.writing, self.pending = self.pending, {}
+            try:
+                self._write(self.writing)
+            except Exception as e:
+                logger.exception("[Inbound] write {} records failed: {}".format(len(self.writing), e))
+            with self.cond:
+                self.writing = {}
+                self.cond.notify_all()
+
+    def _write(self, records):
+        inserts = []
+        updates = []
+        deletes = []
+        for inbound_id, row in records.items():
+            if row is self._DELETED:
+                deletes.append((inbound_id,))
+            elif isinstance(row, tuple):
+                inserts.append((inbound_id,) + row)
+            else:
+                updates.append((row, inbound_id))
+        with self.db_lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO inbound (id, channel, created, record) VALUES (?, ?, ?, ?)", inserts)
+                self.conn.executemany("UPDATE inbound SET record = ? WHERE id = ?", updates)
+                self.conn.executemany("DELETE FROM inbound WHERE id = ?", deletes)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
@@ -0,0 +1,193 @@
+"""
+发送调度器
+
+处理线程把要发送的消息交给调度器后立即返回，由调度器的发送线程完成实际发送：
+- 同一接收者的消息严格按提交顺序发送，不同接收者之间互不阻塞
+- 发送失败时通过延迟队列重试，重试等待期间不占用任何线程，也不会被同一接收者后续的消息插队
+- pace: 发送完成后距离该接收者下一条消息的最小间隔，用于分段发送的长文本、语音等
+- rate_limit: 每个账号(即每个通道实例)每分钟最多发送的消息数
+在发送任务中为同一接收者提交的新任务(如拆分后的分段)，会紧跟在当前任务之后发送。
+after提交的回调在同一接收者此前提交的任务都结束(发送成功或放弃重试)后执行，不占用发送名额。
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+
+
+class OutboundJob(object):
+    __slots__ = ("func", "args", "pace", "retry_cnt", "callbacks")
+
+    def __init__(self, func, args, pace):
+        self.func = func
+        self.args = args
+        self.pace = pace
+        self.retry_cnt = 0
+        self.callbacks = []  # 任务结束后执行的回调，(func, args)
+
+    def __str__(self):
+        return "OutboundJob(func={}, retry_cnt={})".format(getattr(self.func, "__name__", self.func), self.retry_cnt)
+
+
+class OutboundDispatcher(object):
+    MAX_RETRY = 2
+
+    def __init__(self, name, workers=4, rate_limit=0, inline=False):
+        """
+        :param name: 账号名称，用于日志
+        :param workers: 发送线程数
+        :param rate_limit: 每分钟最多发送的消息数，0表示不限制
+        :param inline: 为True时在提交线程中直接发送，用于需要同步拿到发送结果的通道(如公众号被动回复)
+        """
+        self.name = name
+        self.inline = inline
+        self.min_interval = 60.0 / rate_limit if rate_limit else 0
+        self.cond = threading.Condition()
+        self.queues = {}  # receiver -> deque[OutboundJob]，只包含有待发送消息的接收者
+        self.ready = deque()  # 队首消息可以立即发送的接收者
+        self.delayed = []  # (可发送时间, 序号, receiver)，等待重试或发送间隔的接收者
+        self.counter = itertools.count()
+        self.next_send_time = 0  # 账号限速，下一条消息最早的发送时间
+        self.local = threading.local()
+        if not inline:
+            for i in range(workers):
+                _thread = threading.Thread(target=self._worker, name="outbound-{}-{}".format(name, i))
+                _thread.setDaemon(True)
+                _thread.start()
+
+    def submit(self, receiver, func, *args, pace=0):
+        """
+        提交一个发送任务，立即返回
+        :param receiver: 接收者，同一接收者的任务按顺序执行
+        :param func: 发送函数，抛出异常时会延迟重试，NotImplementedError不重试
+        :param pace: 该任务完成后，距离同一接收者下一个任务的最小间隔(秒)
+        """
+        job = OutboundJob(func, args, pace)
+        if self.inline:
+            self._run_inline(job)
+            return
+        current = getattr(self.local, "current", None)
+        if current is not None and current[0] == receiver:
+            current[1].append(job)  # 当前任务派生的任务，在当前任务结束后紧接着发送
+            return
+        with self.cond:
+            queue = self.queues.get(receiver)
+            if queue is None:
+                self.queues[receiver] = deque([job])
+                self.ready.append(receiver)
+                self.cond.notify()
+            else:
+                queue.append(job)
+
+    def after(self, receiver, func, *args):
+        """
+        同一接收者此前提交的任务都结束后执行func，没有待发送的任务时立即执行
+        func在发送线程中执行，应当很快返回，不能再提交任务
+        """
+        with self.cond:
+            queue = self.queues.get(receiver)
+            if queue:
+                queue[-1].callbacks.append((func, args))
+                return
+        func(*args)
+
+    def join(self, timeout=None):
+        """
+        等待所有任务发送完毕
+        :return: 是否在超时前发送完毕
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.queues:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def _run_inline(self, job: OutboundJob):
+        while True:
+            ok, delay = self._execute(job)
+            if ok:
+                if job.pace:
+                    time.sleep(job.pace)
+                return
+            time.sleep(delay)
+
+    def _run_callbacks(self, job: OutboundJob):
+        for func, args in job.callbacks:
+            try:
+                func(*args)
+            except Exception as e:
+                logger.exception("[Outbound] {} callback error: {}".format(self.name, e))
+
+    def _execute(self, job: OutboundJob):
+        """
+        执行任务
+        :return: (是否结束, 失败重试前的等待时间)
+        """
+        try:
+            job.func(*job.args)
+            return True, 0
+        except Exception as e:
+            logger.error("[Outbound] {} send error: {}".format(self.name, e))
+            if isinstance(e, NotImplementedError):
+                return True, 0
+            logger.exception(e)
+            if job.retry_cnt >= self.MAX_RETRY:
+                return True, 0
+            delay = 3 + 3 * job.retry_cnt
+            job.retry_cnt += 1
+            return False, delay
+
+    def _take(self):
+        """取出下一个可发送的接收者，需持有self.cond"""
+        while True:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                self.ready.append(heapq.heappop(self.delayed)[2])
+            wait = None
+            if self.ready:
+                if now >= self.next_send_time:
+                    self.next_send_time = max(now, self.next_send_time) + self.min_interval
+                    return self.ready.popleft()
+                wait = self.next_send_time - now
+            if self.delayed:
+                delayed_wait = self.delayed[0][0] - now
+                wait = delayed_wait if wait is None else min(wait, delayed_wait)
+            self.cond.wait(wait)
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                receiver = self._take()
+                job = self.queues[receiver][0]
+            continuations = []
+            self.local.current = (receiver, continuations)
+            try:
+                finished, delay = self._execute(job)
+            finally:
+                self.local.current = None
+            with self.cond:
+                queue = self.queues[receiver]
+                if finished:
+                    if continuations:  # 派生的任务属于当前任务，回调推迟到它们之后
+                        continuations[-1].callbacks.extend(job.callbacks)
+                    else:  # 持有self.cond执行，避免与after竞争，join返回时回调都已执行
+                        self._run_callbacks(job)
+                    queue.popleft()
+                    queue.extendleft(reversed(continuations))
+                    delay = job.pace
+                else:  # 重试的任务仍在队首，失败前派生的任务丢弃，重试时会重新派生
+                    logger.warn("[Outbound] {} retry {} after {}s, receiver={}".format(self.name, job, delay, receiver))
+                if not queue:
+                    del self.queues[receiver]
+                elif delay:
+                    heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.counter), receiver))
+                else:
+                    self.ready.append(receiver)
+                self.cond.notify_all()
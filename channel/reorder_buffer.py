@@ -0,0 +1,94 @@
+"""
+会话内的回复重排缓冲区
+
+concurrency_in_session大于1时，同一会话的多条消息会并行处理，先完成的回复可能先发出。
+每条消息开始处理时领取一个递增的序号，回复按序号依次放行：
+- 序号最小的未完成消息(队首)的回复直接发送
+- 其它消息的回复先缓存，等排在前面的消息都处理完毕后再按顺序发送
+- 队首消息超过timeout仍未完成时跳过它，放行后面的回复，被跳过的消息之后的回复直接发送
+消息处理结束(无论是否有回复、是否异常或被取消)时都要调用complete，否则后面的回复要等到超时才能发送。
+"""
+
+import threading
+
+from common.log import logger
+
+
+class ReorderBuffer(object):
+    def __init__(self, release, timeout=60):
+        """
+        :param release: 放行回复时调用的函数，参数为put传入的参数
+        :param timeout: 队首消息的最长等待时间(秒)，超时后跳过
+        """
+        self.release = release
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.next_stamp = 0  # 下一个领取的序号
+        self.head = 0  # 当前队首的序号，小于它的回复直接发送
+        self.completed = set()  # 已处理完但排在队首之后的序号
+        self.pending = {}  # 序号 -> 缓存的回复列表
+        self.timer = None
+        self.timer_generation = 0
+
+    def stamp(self):
+        """领取序号，需按消息开始处理的顺序调用"""
+        with self.lock:
+            seq = self.next_stamp
+            self.next_stamp += 1
+            return seq
+
+    def put(self, seq, *args):
+        """提交序号为seq的消息的一条回复"""
+        with self.lock:
+            if seq <= self.head:
+                self.release(*args)
+                return
+            self.pending.setdefault(seq, []).append(args)
+            if self.timer is None:
+                self._start_timer()
+
+    def complete(self, seq):
+        """序号为seq的消息处理结束"""
+        with self.lock:
+            if seq < self.head:  # 已因超时被跳过
+                return
+            self.completed.add(seq)
+            self._advance()
+
+    def empty(self):
+        with self.lock:
+            return not self.pending
+
+    def _advance(self):
+        """队首已完成时依次后移，放行新队首已缓存的回复，需持有self.lock"""
+        moved = False
+        while self.head in self.completed:
+            self.completed.remove(self.head)
+            self.head += 1
+            moved = True
+            for args in self.pending.pop(self.head, []):
+                self.release(*args)
+        if moved:
+            self._cancel_timer()
+            if self.pending:  # 新的队首重新计时
+                self._start_timer()
+
+    def _start_timer(self):
+        self.timer_generation += 1
+        self.timer = threading.Timer(self.timeout, self._on_timeout, args=(self.timer_generation,))
+        self.timer.setDaemon(True)
+        self.timer.start()
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _on_timeout(self, generation):
+        with self.lock:
+            if generation != self.timer_generation or not self.pending:
+                return
+            logger.warning("[Reorder] reply {} not ready in {}s, skip it and release later replies".format(self.head, self.timeout))
+            self.timer = None
+            self.completed.add(self.head)
+            self._advance()
@@ -0,0 +1,52 @@
+"""
+流式回复的分段
+
+对话接口流式返回的内容是很短的增量片段，逐个发送会刷屏，也容易触发通道的发送频率限制。
+StreamChunker把增量片段累积起来，达到min_chars后在最近的句子结尾处切分，整句发送；
+没有句子结尾时继续累积，超过max_chars仍没有时直接切分，结束时发送剩余的内容。
+"""
+
+SENTENCE_ENDS = "。！？!?；;\n"
+
+
+class StreamChunker(object):
+    def __init__(self, send, min_chars=50, max_chars=500):
+        """
+        :param send: 发送一段文本的函数
+        :param min_chars: 每段的最少字数
+        :param max_chars: 找不到句子结尾时的最大字数
+        """
+        self.send = send
+        self.min_chars = max(min_chars, 1)
+        self.max_chars = max(max_chars, self.min_chars)
+        self.buffer = ""
+
+    def feed(self, delta):
+        """追加一个增量片段，够一段时发送"""
+        if not delta:
+            return
+        self.buffer += delta
+        while len(self.buffer) >= self.min_chars:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            self._emit(self.buffer[:cut])
+            self.buffer = self.buffer[cut:]
+
+    def close(self):
+        """流结束，发送剩余的内容"""
+        self._emit(self.buffer)
+        self.buffer = ""
+
+    def _find_cut(self):
+        """在min_chars之后找最后一个句子结尾，返回切分位置，没有时返回None"""
+        for i in range(len(self.buffer) - 1, self.min_chars - 2, -1):
+            if self.buffer[i] in SENTENCE_ENDS:
+                return i + 1
+        if len(self.buffer) >= self.max_chars:
+            return self.max_chars
+        return None
+
+    def _emit(self, text):
+        if text:
+            self.send(text)
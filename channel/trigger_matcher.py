@@ -0,0 +1,151 @@
+"""
+预编译的消息触发匹配器
+
+_compose_context 每条消息都要匹配前缀、关键词和群名单，这里把配置中的列表编译成前缀树、AC自动机和集合，
+配置重新加载时(如 #更新配置)自动重新编译。
+"""
+
+import re
+import threading
+from collections import deque
+
+from config import ConfigSnapshot, conf_snapshot, subscribe_config_reload
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "hit")
+
+    def __init__(self):
+        self.children = {}
+        self.hit = None  # (前缀在列表中的序号, 前缀)
+
+
+class PrefixTrie(object):
+    """前缀树，返回列表中最靠前的、被文本匹配的前缀，与 check_prefix 的结果一致"""
+
+    def __init__(self, prefixes):
+        self.empty = not prefixes
+        self.root = _TrieNode()
+        for index, prefix in enumerate(prefixes or []):
+            node = self.root
+            for ch in prefix:
+                node = node.children.setdefault(ch, _TrieNode())
+            if node.hit is None:
+                node.hit = (index, prefix)
+
+    def match(self, content):
+        if self.empty:
+            return None
+        node = self.root
+        best = node.hit
+        for ch in content:
+            node = node.children.get(ch)
+            if node is None:
+                break
+            if node.hit is not None and (best is None or node.hit[0] < best[0]):
+                best = node.hit
+        return best[1] if best is not None else None
+
+
+class AhoCorasick(object):
+    """AC自动机，判断文本中是否包含任意一个关键词，与 check_contain 的结果一致"""
+
+    def __init__(self, keywords):
+        self.empty = not keywords
+        self.match_all = any(keyword == "" for keyword in keywords or [])
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        for keyword in keywords or []:
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(False)
+                    self.goto[state][ch] = nxt
+                state = nxt
+            self.output[state] = True
+        # 按层构建失败指针，第一层的失败指针指向根节点
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.output[nxt] = self.output[nxt] or self.output[self.fail[nxt]]
+
+    def search(self, content):
+        if self.empty:
+            return None
+        if self.match_all:
+            return True
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                return True
+        return None
+
+
+class TriggerMatcher(object):
+    def __init__(self, snapshot: ConfigSnapshot):
+        self.version = snapshot.version
+        self.single_chat_prefix = PrefixTrie(snapshot.single_chat_prefix)
+        self.group_chat_prefix = PrefixTrie(snapshot.group_chat_prefix)
+        self.image_create_prefix = PrefixTrie(snapshot.image_create_prefix)
+        self.group_chat_keyword = AhoCorasick(snapshot.group_chat_keyword)
+        self.group_name_keyword_white_list = AhoCorasick(snapshot.group_name_keyword_white_list)
+        self.group_name_white_list = frozenset(snapshot.group_name_white_list)
+        self.group_chat_in_one_session = frozenset(snapshot.group_chat_in_one_session)
+        self.mention_patterns = {}
+
+    def is_group_in_white_list(self, group_name):
+        return (
+            group_name in self.group_name_white_list
+            or "ALL_GROUP" in self.group_name_white_list
+            or self.group_name_keyword_white_list.search(group_name) is not None
+        )
+
+    def is_group_in_one_session(self, group_name):
+        return group_name in self.group_chat_in_one_session or "ALL_GROUP" in self.group_chat_in_one_session
+
+    def mention_pattern(self, name):
+        pattern = self.mention_patterns.get(name)
+        if pattern is None:
+            pattern = re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
+            self.mention_patterns[name] = pattern
+        return pattern
+
+
+_matcher = None
+_matcher_lock = threading.Lock()
+
+
+def get_trigger_matcher() -> TriggerMatcher:
+    """获取当前配置对应的匹配器"""
+    global _matcher
+    matcher = _matcher
+    if matcher is None:
+        with _matcher_lock:
+            if _matcher is None:
+                _matcher = TriggerMatcher(conf_snapshot())
+            matcher = _matcher
+    return matcher
+
+
+def _rebuild(snapshot: ConfigSnapshot):
+    global _matcher
+    with _matcher_lock:
+        _matcher = TriggerMatcher(snapshot)
+
+
+subscribe_config_reload(_rebuild)
@@ -10,13 +10,12 @@ import os
 import threading
 import time
 
-import requests
-
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechat.wechat_message import *
 from common.expired_dict import ExpiredDict
+from common.http_client import get_http_client
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
@@ -102,6 +101,7 @@ def qrCallback(uuid, status, qrcode):
 @singleton
 class WechatChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    support_stream = True
 
     def __init__(self):
         super().__init__()
@@ -189,7 +189,7 @@ class WechatChannel(ChatChannel):
             logger.info("[WX] sendFile={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = get_http_client(use_proxy=True).get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
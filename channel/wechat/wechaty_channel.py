@@ -31,6 +31,7 @@ except Exception as e:
 @singleton
 class WechatyChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    support_stream = True
 
     def __init__(self):
         super().__init__()
@@ -45,6 +46,8 @@ class WechatyChannel(ChatChannel):
         loop = asyncio.get_event_loop()
         # 将asyncio的loop传入处理线程
         self.handler_pool._initializer = lambda: asyncio.set_event_loop(loop)
+        # async_handler模式下，消息处理协程也运行在这个事件循环中
+        self.handler_loop = loop
         self.bot = Wechaty()
         self.bot.on("login", self.on_login)
         self.bot.on("message", self.on_message)
@@ -58,7 +61,8 @@ class WechatyChannel(ChatChannel):
     # 统一的发送函数，每个Channel自行实现，根据reply的type字段发送不同类型的消息
     def send(self, reply: Reply, context: Context):
         receiver_id = context["receiver"]
-        loop = asyncio.get_event_loop()
+        # send在发送调度器的线程中执行，这些线程没有事件循环，协程都提交到启动时保存的wechaty事件循环
+        loop = self.handler_loop
         if context["isgroup"]:
             receiver = asyncio.run_coroutine_threadsafe(self.bot.Room.find(receiver_id), loop).result()
         else:
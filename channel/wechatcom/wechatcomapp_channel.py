@@ -1,9 +1,7 @@
 # -*- coding=utf-8 -*-
 import io
 import os
-import time
 
-import requests
 import web
 from wechatpy.enterprise import create_reply, parse_message
 from wechatpy.enterprise.crypto import WeChatCrypto
@@ -15,6 +13,7 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
+from common.http_client import get_http_client
 from common.log import logger
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length
@@ -27,6 +26,7 @@ MAX_UTF8_LEN = 2048
 @singleton
 class WechatComAppChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = []
+    support_stream = True
 
     def __init__(self):
         super().__init__()
@@ -57,9 +57,8 @@ class WechatComAppChannel(ChatChannel):
             if len(texts) > 1:
                 logger.info("[wechatcom] text too long, split into {} parts".format(len(texts)))
             for i, text in enumerate(texts):
-                self.client.message.send_text(self.agent_id, receiver, text)
-                if i != len(texts) - 1:
-                    time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
+                # 间隔0.5秒，防止发送过快乱序
+                self.outbound.submit(receiver, self.client.message.send_text, self.agent_id, receiver, text, pace=0.5 if i != len(texts) - 1 else 0)
             logger.info("[wechatcom] Do send text to {}: {}".format(receiver, reply_text))
         elif reply.type == ReplyType.VOICE:
             try:
@@ -84,12 +83,11 @@ class WechatComAppChannel(ChatChannel):
             except Exception:
                 pass
             for media_id in media_ids:
-                self.client.message.send_voice(self.agent_id, receiver, media_id)
-                time.sleep(1)
+                self.outbound.submit(receiver, self.client.message.send_voice, self.agent_id, receiver, media_id, pace=1)
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
+            pic_res = get_http_client(use_proxy=True).get(img_url, stream=True)
             image_storage = io.BytesIO()
             for block in pic_res.iter_content(1024):
                 image_storage.write(block)
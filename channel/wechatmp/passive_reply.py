@@ -111,6 +111,15 @@ class Query:
 
                 reply_text = ""
                 if task_running:
+                    # 流式回复已经生成了部分内容，先返回已生成的部分，剩余的部分等用户回复后继续返回
+                    continue_text = "\n【未完待续，回复任意文字以继续】"
+                    partial = channel.take_stream_partial(from_user, MAX_UTF8_LEN - len(continue_text.encode("utf-8")))
+                    if partial.strip():
+                        channel.request_cnt.pop(message_id)
+                        reply_text = partial.strip() + continue_text
+                        logger.info("[wechatmp] Request {} do send partial to {} {}: {}\n{}".format(request_cnt, from_user, message_id, content, reply_text))
+                        replyPost = create_reply(reply_text, msg)
+                        return encrypt_func(replyPost.render())
                     if request_cnt < 3:
                         # waiting for timeout (the POST request will be closed by Wechat official server)
                         time.sleep(2)
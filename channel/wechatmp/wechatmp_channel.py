@@ -6,7 +6,6 @@ import os
 import threading
 import time
 
-import requests
 import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
@@ -14,8 +13,10 @@ from wechatpy.exceptions import WeChatClientException
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
+from channel.stream_chunker import StreamChunker
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common.http_client import get_http_client
 from common.log import logger
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length
@@ -32,9 +33,15 @@ from voice.audio_convert import any_to_mp3
 
 @singleton
 class WechatMPChannel(ChatChannel):
+    support_stream = True
+
     def __init__(self, passive_reply=True):
-        super().__init__()
         self.passive_reply = passive_reply
+        # 被动回复需要在处理线程结束前把回复写入cache_dict，因此在处理线程中同步发送
+        self.outbound_inline = passive_reply
+        # 被动回复只能在微信服务器的请求中返回，重启后无法再回复之前的消息
+        self.durable_inbound = not passive_reply
+        super().__init__()
         self.NOT_SUPPORT_REPLYTYPE = []
         appid = conf().get("wechatmp_app_id")
         secret = conf().get("wechatmp_app_secret")
@@ -51,6 +58,9 @@ class WechatMPChannel(ChatChannel):
             self.running = set()
             # Count the request from wechat official server by message_id
             self.request_cnt = dict()
+            # 流式回复中已生成、还没有返回给用户的分段，在微信服务器的请求超时前取走
+            self.stream_ready = dict()
+            self.stream_lock = threading.Lock()
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -103,7 +113,7 @@ class WechatMPChannel(ChatChannel):
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = get_http_client(use_proxy=True).get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -142,9 +152,8 @@ class WechatMPChannel(ChatChannel):
                 if len(texts) > 1:
                     logger.info("[wechatmp] text too long, split into {} parts".format(len(texts)))
                 for i, text in enumerate(texts):
-                    self.client.message.send_text(receiver, text)
-                    if i != len(texts) - 1:
-                        time.sleep(0.5)  # 休眠0.5秒，防止发送过快乱序
+                    # 间隔0.5秒，防止发送过快乱序
+                    self.outbound.submit(receiver, self.client.message.send_text, receiver, text, pace=0.5 if i != len(texts) - 1 else 0)
                 logger.info("[wechatmp] Do send text to {}: {}".format(receiver, reply_text))
             elif reply.type == ReplyType.VOICE:
                 try:
@@ -172,7 +181,7 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
+                pic_res = get_http_client(use_proxy=True).get(img_url, stream=True)
                 image_storage = io.BytesIO()
                 for block in pic_res.iter_content(1024):
                     image_storage.write(block)
@@ -204,6 +213,29 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
         return
 
+    # 被动回复不能主动发送消息，流式回复按句子累积在stream_ready中，由take_stream_partial在请求超时前取走，结束时剩余的部分写入cache_dict
+    def _create_stream_sink(self, context: Context):
+        if not self.passive_reply:
+            return super()._create_stream_sink(context)
+        return PassiveStreamSink(self, context["receiver"])
+
+    def take_stream_partial(self, receiver, max_utf8_len=MAX_UTF8_LEN):
+        """
+        取走流式回复中已生成的完整句子，没有时返回空字符串
+        :param max_utf8_len: 返回内容的最大字节数，超出的部分留到下次
+        """
+        with self.stream_lock:
+            chunks = self.stream_ready.get(receiver)
+            if not chunks:
+                return ""
+            text = "".join(chunks)
+            if len(text.encode("utf-8")) > max_utf8_len:
+                text, rest = split_string_by_utf8_length(text, max_utf8_len, max_split=1)
+                chunks[:] = [rest]
+            else:
+                chunks.clear()
+            return text
+
     def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
@@ -214,3 +246,26 @@ class WechatMPChannel(ChatChannel):
         if self.passive_reply:
             assert session_id not in self.cache_dict
             self.running.remove(session_id)
+
+
+class PassiveStreamSink(StreamChunker):
+    """被动回复的流式回复接收方，生成的句子放到channel.stream_ready中等待取走"""
+
+    def __init__(self, channel: WechatMPChannel, receiver):
+        super().__init__(self._ready, min_chars=1)
+        self.channel = channel
+        self.receiver = receiver
+        with channel.stream_lock:
+            channel.stream_ready[receiver] = []
+
+    def _ready(self, text):
+        with self.channel.stream_lock:
+            self.channel.stream_ready[self.receiver].append(text)
+
+    def close(self):
+        super().close()
+        with self.channel.stream_lock:
+            remaining = "".join(self.channel.stream_ready.pop(self.receiver, [])).strip()
+            if remaining:
+                logger.info("[wechatmp] stream finished, text cached, receiver {}\n{}".format(self.receiver, remaining))
+                self.channel.cache_dict[self.receiver] = ("text", remaining)
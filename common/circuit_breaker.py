@@ -0,0 +1,237 @@
+"""
+熔断器和重试退避
+
+开启 circuit_breaker 后，每个上游端点(open_ai_api_pool中的一项、openai默认地址、LinkAI)有一个熔断器：
+- 关闭(closed)：正常请求，连续 circuit_breaker_threshold 次上游故障(超时、连接失败、5xx)后打开
+- 打开(open)：不再请求该端点，直接返回友好的提示，circuit_breaker_recovery 秒后进入半开
+- 半开(half_open)：只放行一个探测请求，成功则关闭，失败则重新打开
+熔断器的状态可以通过 get_metrics() 查看。
+重试的等待时间按 backoff_delay 指数增长并加入随机抖动，避免大量请求在同一时刻重试。
+同步的重试通过 retry_after 等待：在 deferrable() 范围内(通道的处理线程)不在当前线程等待，而是抛出RetryLater，
+由通道释放处理线程，等待结束后再取得处理名额调用 RetryLater.resume() 继续；范围外仍在当前线程等待。
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from common import metrics
+from common.log import logger
+from config import conf
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+CIRCUIT_OPEN_REPLY = "服务暂时不可用，请稍后再试"  # 熔断时返回给用户的提示
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开时拒绝请求"""
+
+    def __init__(self, name):
+        super().__init__("circuit breaker {} is open".format(name))
+        self.name = name
+
+
+class CircuitBreaker(object):
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30, half_open_max_calls=1):
+        """
+        :param name: 端点名称
+        :param failure_threshold: 连续失败多少次后打开
+        :param recovery_timeout: 打开后进入半开的时间，单位秒
+        :param half_open_max_calls: 半开时同时放行的探测请求数
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.lock = threading.Lock()
+        self._state = CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0
+        self.probes = 0  # 半开时进行中的探测请求数
+        self.opened = 0  # 打开的次数
+        self.rejected = 0  # 被拒绝的请求数
+
+    @property
+    def state(self):
+        with self.lock:
+            self._refresh(time.monotonic())
+            return self._state
+
+    def available(self) -> bool:
+        """是否可以放行请求，不占用半开时的探测名额"""
+        with self.lock:
+            self._refresh(time.monotonic())
+            return self._state == CLOSED or (self._state == HALF_OPEN and self.probes < self.half_open_max_calls)
+
+    def allow(self) -> bool:
+        """
+        请求前调用，返回False时不应请求；返回True时请求结束后必须调用record_success、record_failure或release之一
+        """
+        with self.lock:
+            self._refresh(time.monotonic())
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self.probes < self.half_open_max_calls:
+                self.probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def check(self):
+        """allow的异常版本，拒绝时抛出CircuitOpenError"""
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+
+    def record_success(self):
+        with self.lock:
+            if self._state == HALF_OPEN:
+                logger.info("[CircuitBreaker] {} closed".format(self.name))
+            self._state = CLOSED
+            self.failures = 0
+            self.probes = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self.failures >= self.failure_threshold):
+                self._open(time.monotonic())
+
+    def record(self, failed):
+        if failed:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def release(self):
+        """请求被取消，不计入成功或失败，只归还半开时的探测名额"""
+        with self.lock:
+            if self._state == HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def get_metrics(self) -> dict:
+        """
+        :return: 状态、连续失败次数、打开次数、被拒绝的请求数和距离进入半开的秒数
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refresh(now)
+            retry_in = max(self.opened_at + self.recovery_timeout - now, 0) if self._state == OPEN else 0
+            return {"state": self._state, "failures": self.failures, "opened": self.opened, "rejected": self.rejected, "retry_in": retry_in}
+
+    def _open(self, now):
+        self._state = OPEN
+        self.opened_at = now
+        self.probes = 0
+        self.opened += 1
+        logger.warning("[CircuitBreaker] {} open after {} failures, retry in {}s".format(self.name, self.failures, self.recovery_timeout))
+
+    def _refresh(self, now):
+        if self._state == OPEN and now >= self.opened_at + self.recovery_timeout:
+            self._state = HALF_OPEN
+            self.probes = 0
+
+
+class RetryLater(Exception):
+    """deferrable()范围内需要等待后重试时抛出，调用方在delay秒后调用resume()继续"""
+
+    def __init__(self, delay, func, *args):
+        super().__init__("retry in {:.2f}s".format(delay))
+        self.delay = delay
+        self.func = func
+        self.args = args
+        self.callbacks = []  # 重试得到结果后依次调用，把结果转换为外层调用原本的返回值
+
+    def then(self, callback):
+        """
+        添加对重试结果的处理，外层调用捕获RetryLater后添加自己对返回值的处理再重新抛出
+        :return: self
+        """
+        self.callbacks.append(callback)
+        return self
+
+    def resume(self):
+        """执行重试并依次处理结果，需要再次等待时抛出带有剩余处理的RetryLater"""
+        try:
+            result = self.func(*self.args)
+        except RetryLater as e:
+            e.callbacks.extend(self.callbacks)
+            raise
+        for callback in self.callbacks:
+            result = callback(result)
+        return result
+
+
+_deferrable = threading.local()
+
+
+@contextmanager
+def deferrable():
+    """范围内的retry_after不在当前线程等待，改为抛出RetryLater"""
+    previous = getattr(_deferrable, "active", False)
+    _deferrable.active = True
+    try:
+        yield
+    finally:
+        _deferrable.active = previous
+
+
+def retry_after(delay, func, *args):
+    """
+    等待delay秒后返回func(*args)，在deferrable()范围内抛出RetryLater，不占用当前线程等待
+    """
+    if getattr(_deferrable, "active", False):
+        raise RetryLater(delay, func, *args)
+    time.sleep(delay)
+    return func(*args)
+
+
+def backoff_delay(retry_count, base, cap=60) -> float:
+    """
+    第retry_count次(从0开始)重试前的等待时间，按base指数增长，不超过cap，在一半到全部之间随机抖动
+    """
+    delay = min(cap, base * (2**retry_count))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """获取端点共享的熔断器，未开启circuit_breaker时返回None"""
+    if not conf().get("circuit_breaker", False):
+        return None
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    name,
+                    failure_threshold=conf().get("circuit_breaker_threshold", 5),
+                    recovery_timeout=conf().get("circuit_breaker_recovery", 30),
+                )
+                _breakers[name] = breaker
+                metrics.register("circuit_breaker", get_metrics)
+    return breaker
+
+
+def get_metrics() -> dict:
+    """
+    :return: 端点名称 -> 熔断器状态
+    """
+    return {name: breaker.get_metrics() for name, breaker in list(_breakers.items())}
+
+
+def is_upstream_failure(error) -> bool:
+    """是否为上游故障(超时、连接失败、5xx)，参数错误、鉴权失败、限流等说明上游可以正常响应，不计为故障"""
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    if status:
+        return status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return type(error).__name__ in ("Timeout", "APIError", "APIConnectionError", "ServiceUnavailableError", "TryAgain", "ConnectionError", "ConnectTimeout", "ReadTimeout")
@@ -1,22 +1,79 @@
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
 
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
-        super().__init__()
+class ExpiredDict(MutableMapping):
+    """
+    访问后重新计时的过期字典，可选按最近最少使用淘汰
+    所有条目的有效期相同，且每次访问都会移到末尾，因此条目按过期时间排列，过期条目总是在开头，
+    每次读写时顺带从开头清理过期条目，均摊O(1)。
+    条目保存在内部的OrderedDict中，所有读写都经过self.lock，不会绕过过期检查。
+    """
+
+    def __init__(self, expires_in_seconds, max_entries=0, on_expire=None):
+        """
+        :param expires_in_seconds: 条目在最后一次访问后的有效期
+        :param max_entries: 最多保留的条目数，超出时淘汰最久未访问的，0表示不限制
+        :param on_expire: 条目过期或被淘汰时的回调，参数为(key, value)，在释放锁之后调用；显式删除的条目不回调
+        """
         self.expires_in_seconds = expires_in_seconds
+        self.max_entries = max_entries
+        self.on_expire = on_expire
+        self.lock = threading.RLock()
+        self.data = OrderedDict()  # key -> (value, 过期时间)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
+        expired = []
+        try:
+            with self.lock:
+                return self._get(key, time.monotonic(), expired)
+        finally:
+            self._notify(expired)
+
+    def __setitem__(self, key, value):
+        expired = []
+        with self.lock:
+            now = time.monotonic()
+            self.data[key] = (value, now + self.expires_in_seconds)
+            self.data.move_to_end(key)
+            self._sweep(now, expired)
+            if self.max_entries:
+                while len(self.data) > self.max_entries:
+                    oldest, (oldest_value, _) = self.data.popitem(last=False)
+                    expired.append((oldest, oldest_value))
+        self._notify(expired)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def _get(self, key, now, expired):
+        """读取并重新计时，需持有self.lock"""
+        value, expiry_time = self.data[key]
+        if now > expiry_time:
+            del self.data[key]
+            expired.append((key, value))
             raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
+        self.data[key] = (value, now + self.expires_in_seconds)
+        self.data.move_to_end(key)
+        self._sweep(now, expired)
         return value
 
-    def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+    def _sweep(self, now, expired):
+        """从开头清理过期条目，清理的条目追加到expired中，需持有self.lock"""
+        while self.data:
+            key, (value, expiry_time) = next(iter(self.data.items()))
+            if expiry_time > now:
+                break
+            del self.data[key]
+            expired.append((key, value))
+
+    def _notify(self, expired):
+        if self.on_expire is not None:
+            for key, value in expired:
+                self.on_expire(key, value)
 
     def get(self, key, default=None):
         try:
@@ -24,6 +81,37 @@ class ExpiredDict(dict):
         except KeyError:
             return default
 
+    def pop(self, key, *default):
+        expired = []
+        try:
+            with self.lock:
+                try:
+                    value = self._get(key, time.monotonic(), expired)
+                except KeyError:
+                    if default:
+                        return default[0]
+                    raise
+                del self.data[key]
+                return value
+        finally:
+            self._notify(expired)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def copy(self):
+        """复制未过期的条目，保留剩余有效期和设置"""
+        copied = ExpiredDict(self.expires_in_seconds, self.max_entries, self.on_expire)
+        expired = []
+        with self.lock:
+            self._sweep(time.monotonic(), expired)
+            copied.data = self.data.copy()
+        self._notify(expired)
+        return copied
+
+    __copy__ = copy
+
     def __contains__(self, key):
         try:
             self[key]
@@ -31,12 +119,25 @@ class ExpiredDict(dict):
         except KeyError:
             return False
 
+    def __len__(self):
+        return len(self.keys())
+
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        return [key for key, _ in self.items()]
+
+    def values(self):
+        return [value for _, value in self.items()]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        expired = []
+        with self.lock:
+            self._sweep(time.monotonic(), expired)
+            items = [(key, value) for key, (value, _) in self.data.items()]
+        self._notify(expired)
+        return items
 
     def __iter__(self):
         return self.keys().__iter__()
+
+    def __repr__(self):
+        return "ExpiredDict({})".format(dict(self.items()))
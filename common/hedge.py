@@ -0,0 +1,121 @@
+"""
+对冲请求
+
+上游接口的长尾延迟远高于中位数，开启 request_hedging 后，请求在超过最近延迟的 hedge_percentile 分位数后仍未返回时，
+再发出一个相同的请求(配置了open_ai_api_pool时会落到进行中请求较少的另一个端点上)，两个请求中先成功返回的结果生效：
+- 只在async_handler模式下对冲，返回结果后取消落后的请求；同步模式下已经发出的http请求无法中断，两个请求都会完整计费，因此不对冲
+- 流式回复不对冲
+- 先返回的请求失败时继续等待另一个，都失败时抛出最先发出的请求的异常
+- 对冲的请求数不超过总请求数的 hedge_budget 比例，避免上游整体变慢时请求量翻倍
+延迟样本不足时使用 hedge_delay 作为等待时间。
+延迟样本由调用方通过record记录，只包含上游请求本身的耗时，不包含限流和端点的排队等待。
+"""
+
+import asyncio
+import threading
+from collections import deque
+
+from common.log import logger
+from config import conf
+
+MIN_SAMPLES = 20  # 计算分位数需要的最少延迟样本数
+
+
+class Hedger(object):
+    def __init__(self, name, percentile=95, budget=0.1, delay=10, min_delay=1, window=200):
+        """
+        :param name: 用于日志的名称
+        :param percentile: 发出对冲请求的延迟分位数
+        :param budget: 对冲请求数占总请求数的最大比例
+        :param delay: 延迟样本不足时发出对冲请求前的等待时间，单位秒
+        :param min_delay: 等待时间的下限，单位秒
+        :param window: 保留的最近延迟样本数
+        """
+        self.name = name
+        self.percentile = percentile
+        self.budget = budget
+        self.default_delay = delay
+        self.min_delay = min_delay
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedged = 0  # 发出的对冲请求数
+        self.hedge_wins = 0  # 对冲请求先返回的次数
+
+    def delay(self) -> float:
+        """当前发出对冲请求前的等待时间"""
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < MIN_SAMPLES:
+            return self.default_delay
+        index = min(int(len(samples) * self.percentile / 100), len(samples) - 1)
+        return max(samples[index], self.min_delay)
+
+    async def run_async(self, func, *args):
+        """
+        调用协程函数func，超过等待时间未返回时再调用一次，返回先成功的结果并取消落后的请求
+        两次调用同时进行，func需要自行处理限流、端点的归还等，并在上游请求成功后调用record记录延迟
+        """
+        self._count_request()
+        delay = self.delay()
+        primary = asyncio.ensure_future(func(*args))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._allow_hedge():
+                return await primary
+            logger.debug("[Hedger] {} no response in {:.2f}s, send hedged request".format(self.name, delay))
+            hedge = asyncio.ensure_future(func(*args))
+            tasks.append(hedge)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None:
+                        self._count_winner(task is hedge)
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def get_metrics(self) -> dict:
+        """
+        :return: 总请求数、对冲请求数、对冲请求先返回的次数和当前的等待时间
+        """
+        delay = self.delay()
+        with self.lock:
+            return {"requests": self.requests, "hedged": self.hedged, "hedge_wins": self.hedge_wins, "delay": delay}
+
+    def record(self, latency):
+        """记录一次上游请求的延迟，单位秒"""
+        with self.lock:
+            self.samples.append(latency)
+
+    def _count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def _allow_hedge(self):
+        with self.lock:
+            if self.hedged >= self.requests * self.budget:
+                return False
+            self.hedged += 1
+            return True
+
+    def _count_winner(self, hedge_won):
+        if hedge_won:
+            with self.lock:
+                self.hedge_wins += 1
+
+
+def create_hedger(name) -> Hedger:
+    """按request_hedging相关配置创建对冲器"""
+    return Hedger(
+        name,
+        percentile=conf().get("hedge_percentile", 95),
+        budget=conf().get("hedge_budget", 0.1),
+        delay=conf().get("hedge_delay", 10),
+        min_delay=conf().get("hedge_min_delay", 1),
+    )
@@ -0,0 +1,140 @@
+"""
+共享的HTTP客户端
+
+bot、插件和通道访问外部服务时共用按host划分的requests.Session，同一host的连接保持keep-alive并复用，
+避免每次请求都重新建立TCP和TLS连接。每个host的连接池大小、默认的连接和读取超时可以通过配置调整；
+访问openai相关的地址时可以使用 get_http_client(use_proxy=True) 获取走 proxy 配置代理的客户端。
+连接复用情况可以通过 get_metrics() 查看：requests为请求数，connections为新建的连接数，二者之差为复用连接的请求数。
+"""
+
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.log import logger
+from config import conf
+
+
+class HttpClient(object):
+    def __init__(self, pool_maxsize=10, pool_maxsize_per_host=None, connect_timeout=5, read_timeout=60, proxy=None):
+        """
+        :param pool_maxsize: 每个host保持的最大连接数
+        :param pool_maxsize_per_host: 单独指定连接池大小的host，host -> 最大连接数
+        :param connect_timeout: 默认的连接超时时间，单位秒
+        :param read_timeout: 默认的读取超时时间，单位秒
+        :param proxy: 代理地址，为空时直接连接
+        """
+        self.pool_maxsize = pool_maxsize
+        self.pool_maxsize_per_host = pool_maxsize_per_host or {}
+        self.timeout = (connect_timeout, read_timeout)
+        self.proxy = proxy
+        self.lock = threading.Lock()
+        self.sessions = {}  # scheme://host -> requests.Session
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        """
+        与requests.request参数相同，未指定timeout时使用默认超时
+        stream=True时需要读完或关闭响应，连接才会放回连接池
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self._get_session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def get_metrics(self) -> dict:
+        """
+        :return: host -> {"requests": 请求数, "connections": 新建的连接数, "reused": 复用连接的请求数}
+        """
+        with self.lock:
+            sessions = list(self.sessions.items())
+        metrics = {}
+        for host, session in sessions:
+            adapter = session.get_adapter(host)
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            num_requests = num_connections = 0
+            for manager in managers:
+                for key in manager.pools.keys():
+                    try:
+                        pool = manager.pools[key]
+                    except KeyError:  # 已被淘汰
+                        continue
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+            metrics[host] = {"requests": num_requests, "connections": num_connections, "reused": max(num_requests - num_connections, 0)}
+        return metrics
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def _get_session(self, url) -> requests.Session:
+        parts = urlsplit(url)
+        host = "{}://{}".format(parts.scheme, parts.netloc)
+        session = self.sessions.get(host)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(host)
+                if session is None:
+                    session = self._create_session(host, parts.hostname)
+                    self.sessions[host] = session
+        return session
+
+    def _create_session(self, host, hostname) -> requests.Session:
+        pool_maxsize = self.pool_maxsize_per_host.get(hostname, self.pool_maxsize)
+        session = requests.Session()
+        # 重定向到其它host时也能复用连接，pool_connections为缓存的连接池(host)数
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if self.proxy:
+            session.proxies = {"http": self.proxy, "https": self.proxy}
+        logger.debug("[HttpClient] create session for {}, pool_maxsize={}, proxy={}".format(host, pool_maxsize, self.proxy))
+        return session
+
+
+_clients = {}  # use_proxy -> HttpClient
+_clients_lock = threading.Lock()
+
+
+def get_http_client(use_proxy=False) -> HttpClient:
+    """
+    获取进程内共享的HTTP客户端
+    :param use_proxy: 是否使用proxy配置的代理，没有配置代理时与直接连接的客户端相同
+    """
+    use_proxy = bool(use_proxy and conf().get("proxy"))
+    client = _clients.get(use_proxy)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(use_proxy)
+            if client is None:
+                client = HttpClient(
+                    pool_maxsize=conf().get("http_pool_maxsize", 10),
+                    pool_maxsize_per_host=conf().get("http_pool_maxsize_per_host", {}),
+                    connect_timeout=conf().get("http_connect_timeout", 5),
+                    read_timeout=conf().get("http_read_timeout", 60),
+                    proxy=conf().get("proxy") if use_proxy else None,
+                )
+                _clients[use_proxy] = client
+    return client
+
+
+def get_metrics() -> dict:
+    """
+    :return: 所有共享客户端合并后的连接复用统计，host -> {"requests", "connections", "reused"}
+    """
+    metrics = {}
+    for client in list(_clients.values()):
+        for host, item in client.get_metrics().items():
+            total = metrics.setdefault(host, {"requests": 0, "connections": 0, "reused": 0})
+            for key, value in item.items():
+                total[key] += value
+    return metrics
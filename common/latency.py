@@ -0,0 +1,200 @@
+"""
+消息处理各阶段的耗时统计
+
+开启 latency_metrics 后，各阶段的耗时按 (阶段, 标签) 记录到进程内的直方图中，标签一般是通道、bot或插件名称。
+直方图采用HDR风格的对数-线性分桶，相对误差约3%，内存占用与样本数无关。
+统计结果可以通过 query() 获取，并按 latency_metrics_log_interval 定期输出到日志。未开启时 timer() 返回空操作对象，几乎没有额外开销。
+"""
+
+import threading
+import time
+
+from common.log import logger
+from config import conf_snapshot, subscribe_config_reload
+
+# 阶段名称
+STAGE_QUEUE_WAIT = "queue_wait"  # 从produce到被consume取出
+STAGE_PLUGIN = "plugin"  # 插件处理事件
+STAGE_BOT = "bot"  # build_reply_content
+STAGE_VOICE_TO_TEXT = "voice_to_text"
+STAGE_TEXT_TO_VOICE = "text_to_voice"
+STAGE_DECORATE = "decorate"  # _decorate_reply
+STAGE_SEND = "send"  # 发送调度器中执行send
+
+
+class LatencyHistogram(object):
+    """以微秒为单位记录耗时，每个2的幂区间再等分为 2**bits 个子桶"""
+
+    def __init__(self, bits=5):
+        self.bits = bits
+        self.sub_buckets = 1 << bits
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def _index(self, value):
+        if value < 2 * self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.bits - 1
+        return shift * self.sub_buckets + (value >> shift)
+
+    def _value(self, index):
+        if index < 2 * self.sub_buckets:
+            return index
+        shift = index // self.sub_buckets - 1
+        return (index - shift * self.sub_buckets) << shift
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        index = self._index(value)
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def percentiles(self, *ps):
+        with self.lock:
+            items = sorted(self.buckets.items())
+            count = self.count
+        result = []
+        for p in ps:
+            target = max(int(count * p / 100.0 + 0.5), 1)
+            seen = 0
+            value = 0
+            for index, n in items:
+                seen += n
+                if seen >= target:
+                    value = self._value(index)
+                    break
+            result.append(min(value, self.max) / 1000000.0)
+        return result
+
+    def summary(self) -> dict:
+        p50, p90, p99 = self.percentiles(50, 90, 99)
+        with self.lock:
+            return {
+                "count": self.count,
+                "min": (self.min or 0) / 1000000.0,
+                "max": self.max / 1000000.0,
+                "mean": self.total / self.count / 1000000.0 if self.count else 0.0,
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+            }
+
+
+class _Timer(object):
+    __slots__ = ("stage", "key", "start")
+
+    def __init__(self, stage, key):
+        self.stage = stage
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.stage, self.key, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+_enabled = False
+_histograms = {}
+_lock = threading.Lock()
+_reporter = None
+
+
+def enabled():
+    return _enabled
+
+
+def record(stage, key, seconds):
+    """
+    记录一次耗时
+    :param stage: 阶段名称
+    :param key: 标签，如通道、bot或插件名称
+    :param seconds: 耗时，单位秒
+    """
+    if not _enabled:
+        return
+    histogram = _histograms.get((stage, key))
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault((stage, key), LatencyHistogram())
+    histogram.record(seconds)
+
+
+def timer(stage, key):
+    """
+    用with语句统计代码块的耗时，未开启统计时返回空操作对象
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(stage, key)
+
+
+def query(stage=None) -> dict:
+    """
+    查询耗时统计
+    :param stage: 阶段名称，为None时返回所有阶段
+    :return: {(阶段, 标签): {count, min, max, mean, p50, p90, p99}}，单位秒
+    """
+    with _lock:
+        histograms = list(_histograms.items())
+    return {k: h.summary() for k, h in histograms if stage is None or k[0] == stage}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def _report_loop():
+    while True:
+        interval = conf_snapshot().latency_metrics_log_interval or 300
+        time.sleep(interval)
+        if not _enabled:
+            continue
+        stats = query()
+        if not stats:
+            continue
+        lines = ["[Latency] summary since startup:"]
+        for (stage, key), s in sorted(stats.items()):
+            lines.append(
+                "{}[{}] count={} mean={:.3f}s p50={:.3f}s p90={:.3f}s p99={:.3f}s max={:.3f}s".format(
+                    stage, key, s["count"], s["mean"], s["p50"], s["p90"], s["p99"], s["max"]
+                )
+            )
+        logger.info("\n".join(lines))
+
+
+def _on_config_reload(snapshot):
+    global _enabled, _reporter
+    _enabled = bool(snapshot.latency_metrics)
+    if _enabled and _reporter is None:
+        _reporter = threading.Thread(target=_report_loop)
+        _reporter.setDaemon(True)
+        _reporter.start()
+
+
+_on_config_reload(conf_snapshot())
+subscribe_config_reload(_on_config_reload)
@@ -0,0 +1,75 @@
+"""
+组件运行统计的定期输出
+
+调度器、回复缓存、熔断器、上游接口池、请求合并、对冲等组件创建时通过 register() 登记自己的 get_metrics，
+metrics_log_interval 大于0时按该间隔把所有登记的统计输出到日志，也可以通过 collect() 获取。
+同名的登记会覆盖之前的，重新创建的组件只保留最新的一个。
+"""
+
+import json
+import threading
+import time
+
+from common.log import logger
+from config import conf_snapshot, subscribe_config_reload
+
+_providers = {}  # 名称 -> 返回统计的函数
+_lock = threading.Lock()
+_reporter = None
+
+
+def register(name, get_metrics):
+    """
+    登记组件的统计
+    :param name: 名称，如 "scheduler.WechatChannel"、"upstream_pool.chatgpt"
+    :param get_metrics: 无参数、返回可以转换为JSON的统计的函数
+    """
+    with _lock:
+        _providers[name] = get_metrics
+
+
+def unregister(name):
+    with _lock:
+        _providers.pop(name, None)
+
+
+def collect() -> dict:
+    """
+    :return: 名称 -> 统计，获取失败的组件为错误信息
+    """
+    with _lock:
+        providers = sorted(_providers.items())
+    metrics = {}
+    for name, get_metrics in providers:
+        try:
+            metrics[name] = get_metrics()
+        except Exception as e:
+            metrics[name] = "error: {}".format(e)
+    return metrics
+
+
+def _report_loop():
+    while True:
+        interval = conf_snapshot().metrics_log_interval
+        time.sleep(interval or 60)  # 关闭期间按分钟检查配置是否重新开启
+        if not interval or not conf_snapshot().metrics_log_interval:
+            continue
+        metrics = collect()
+        if not metrics:
+            continue
+        lines = ["[Metrics] summary since startup:"]
+        for name, value in metrics.items():
+            lines.append("{} {}".format(name, json.dumps(value, ensure_ascii=False, default=str)))
+        logger.info("\n".join(lines))
+
+
+def _on_config_reload(snapshot):
+    global _reporter
+    if snapshot.metrics_log_interval and _reporter is None:
+        _reporter = threading.Thread(target=_report_loop)
+        _reporter.setDaemon(True)
+        _reporter.start()
+
+
+_on_config_reload(conf_snapshot())
+subscribe_config_reload(_on_config_reload)
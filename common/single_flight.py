@@ -0,0 +1,117 @@
+"""
+相同请求的合并
+
+同一时刻有多个相同的请求(如群里多人发送了同样的问题，且会话上下文相同)时，只有第一个请求(leader)真正调用接口，
+之后到达的相同请求(follower)等待leader的结果，leader结束后结果或异常分发给所有等待者。
+只合并同时在进行中的请求，leader结束后再到达的请求会重新调用，因此不会返回过期的结果。
+取消只影响被取消的调用者：follower被取消时leader和其它follower照常返回；leader被取消时follower重新发起，其中一个成为新的leader。
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import CancelledError, Future, InvalidStateError
+
+from common.log import logger
+
+
+def payload_key(*parts) -> str:
+    """按请求内容计算合并用的key，parts需要可以序列化为json"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class _LeaderCancelled(Exception):
+    """leader被取消，follower需要重新发起调用"""
+
+
+class SingleFlight(object):
+    def __init__(self, name):
+        """
+        :param name: 用于日志的名称
+        """
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> leader的Future
+        self.leaders = 0  # 实际调用的次数
+        self.followers = 0  # 合并掉的次数
+
+    def _join(self, key):
+        """返回(future, 是否为leader)"""
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.followers += 1
+                return future, False
+            future = Future()
+            self.calls[key] = future
+            self.leaders += 1
+            return future, True
+
+    def _finish(self, key, future: Future, result=None, exception=None):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+        if isinstance(exception, (asyncio.CancelledError, CancelledError)):
+            exception = _LeaderCancelled()  # 取消只针对leader自己，不分发给follower
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:  # future已被取消
+            pass
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        调用func，相同key的调用正在进行时等待它的结果
+        :return: func的返回值，func抛出的异常会抛给所有等待者
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            logger.debug("[SingleFlight] {} join in-flight request {}".format(self.name, key))
+            try:
+                return future.result()
+            except (_LeaderCancelled, CancelledError):
+                logger.debug("[SingleFlight] {} leader of {} cancelled, retry".format(self.name, key))
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, func, *args, **kwargs):
+        """do的协程版本，func为协程函数，与do共用进行中的请求"""
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            logger.debug("[SingleFlight] {} join in-flight request {}".format(self.name, key))
+            waiter = asyncio.wrap_future(future)
+            try:
+                # shield使本调用者被取消时不会取消共享的future
+                return await asyncio.shield(waiter)
+            except _LeaderCancelled:
+                logger.debug("[SingleFlight] {} leader of {} cancelled, retry".format(self.name, key))
+            except asyncio.CancelledError:
+                if not waiter.cancelled():  # 本调用者被取消
+                    raise
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def get_metrics(self) -> dict:
+        """
+        :return: 进行中的请求数、实际调用次数和被合并的次数
+        """
+        with self.lock:
+            return {"inflight": len(self.calls), "leaders": self.leaders, "followers": self.followers}
@@ -1,39 +1,75 @@
+"""
+令牌桶限流
+
+令牌按每分钟tpm个的速率连续生成，获取时按单调时钟的流逝时间补充，不需要后台线程。
+获取可以带权重(如按请求的token数扣减)，令牌不足时先预留，调用方在锁外等待到预留的令牌生成，
+因此等待中的请求不会阻塞其它请求的计算，且按获取的先后顺序放行。
+"""
+
+import asyncio
 import threading
 import time
 
 
 class TokenBucket:
-    def __init__(self, tpm, timeout=None):
-        self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
-        self.rate = int(tpm) / 60  # 令牌每秒生成速率
+    def __init__(self, tpm, timeout=None, capacity=None):
+        """
+        :param tpm: 每分钟生成的令牌数
+        :param timeout: 等待令牌的默认超时时间，单位秒，None表示一直等待
+        :param capacity: 令牌桶容量，即允许的突发量，默认等于tpm
+        """
+        self.rate = float(tpm) / 60  # 令牌每秒生成速率
+        self.capacity = float(capacity if capacity is not None else tpm)  # 令牌桶容量
         self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
+        self.tokens = self.capacity  # 当前令牌数，预留后可以为负数
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()  # 只保护令牌数的计算，不在持锁时等待
+
+    def _reserve(self, n, timeout):
+        """预留n个令牌，返回需要等待的秒数，超过timeout时不预留并返回None"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(n - self.tokens, 0) / self.rate if self.rate > 0 else float("inf")
+            if timeout is not None and wait > timeout:
+                return None
+            self.tokens -= n
+            return wait
+
+    def get_token(self, n=1, timeout=None):
+        """
+        获取n个令牌，令牌不足时阻塞等待
+        :param timeout: 本次的超时时间，None时使用默认超时时间
+        :return: 是否获取成功，等待时间会超过超时时间时立即返回False
+        """
+        wait = self._reserve(n, self.timeout if timeout is None else timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
         return True
 
+    async def get_token_async(self, n=1, timeout=None):
+        """get_token的协程版本，等待时不占用线程"""
+        wait = self._reserve(n, self.timeout if timeout is None else timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def charge(self, n):
+        """
+        不等待地调整已扣减的令牌数，用于按实际用量修正预估值，n为负数时退还
+        扣成负数时后续的获取需要等待对应的时间
+        """
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens - n)
+
     def close(self):
-        self.is_running = False
+        """没有后台线程，保留以兼容之前的调用"""
+        pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+"""
+tiktoken编码器注册表
+
+模型别名只解析一次，编码器按模型缓存，避免每次计数都重新查找；
+启动时可以在后台预加载配置中模型的BPE文件，避免第一条消息等待加载。
+"""
+
+import threading
+
+from common.log import logger
+
+# 计数规则与gpt-3.5-turbo/gpt-4相同的模型
+_MODEL_ALIASES = {
+    "gpt-3.5-turbo-0301": "gpt-3.5-turbo",
+    "gpt-35-turbo": "gpt-3.5-turbo",
+    "gpt-4-0314": "gpt-4",
+    "gpt-4-0613": "gpt-4",
+    "gpt-4-32k": "gpt-4",
+    "gpt-4-32k-0613": "gpt-4",
+    "gpt-3.5-turbo-0613": "gpt-4",
+    "gpt-3.5-turbo-16k": "gpt-4",
+    "gpt-3.5-turbo-16k-0613": "gpt-4",
+    "gpt-35-turbo-16k": "gpt-4",
+}
+
+# 每条消息的额外token数和name字段的额外token数
+_MESSAGE_OVERHEAD = {
+    "gpt-3.5-turbo": (4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+    "gpt-4": (3, 1),
+}
+
+_encodings = {}  # 模型名称 -> 编码器
+_token_params = {}  # 模型名称 -> (编码器, tokens_per_message, tokens_per_name)
+_lock = threading.Lock()
+
+
+def resolve_model(model):
+    """返回计数规则对应的模型名称"""
+    return _MODEL_ALIASES.get(model, model)
+
+
+def get_encoding(model):
+    """
+    获取模型对应的编码器，未知模型使用cl100k_base
+    :raise ImportError: 没有安装tiktoken
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    import tiktoken
+
+    with _lock:
+        encoding = _encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                logger.debug("Warning: model {} not found. Using cl100k_base encoding.".format(model))
+                encoding = tiktoken.get_encoding("cl100k_base")
+            _encodings[model] = encoding
+    return encoding
+
+
+def get_token_params(model):
+    """
+    :return: (encoding, tokens_per_message, tokens_per_name)，用于计算对话消息的token数
+    """
+    params = _token_params.get(model)
+    if params is not None:
+        return params
+    resolved = resolve_model(model)
+    if resolved not in _MESSAGE_OVERHEAD:
+        logger.warn(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+        resolved = "gpt-3.5-turbo"
+    params = (get_encoding(resolved),) + _MESSAGE_OVERHEAD[resolved]
+    _token_params[model] = params
+    return params
+
+
+def count_tokens(texts, model):
+    """
+    批量计算文本的token数
+    :param texts: 文本列表
+    :return: 与texts一一对应的token数列表
+    """
+    if not texts:
+        return []
+    encoding = get_encoding(model)
+    return [len(tokens) for tokens in encoding.encode_batch(list(texts), disallowed_special=())]
+
+
+def warm_up(model):
+    """在后台线程中预加载模型的编码器，失败时只记录日志"""
+
+    def load():
+        try:
+            get_encoding(resolve_model(model))
+            logger.info("[TokenCounter] encoding for model {} loaded".format(model))
+        except Exception as e:
+            logger.warning("[TokenCounter] failed to load encoding for model {}: {}".format(model, e))
+
+    _thread = threading.Thread(target=load)
+    _thread.setDaemon(True)
+    _thread.start()
@@ -0,0 +1,256 @@
+"""
+多key、多地址的上游接口池
+
+配置多组 (api_key, api_base, weight) 后，每次请求从池中选择一个端点：
+- 跳过429后处于冷却期的端点，所有端点都在冷却时选择最早恢复的
+- 按 进行中的请求数/权重 选择最空闲的端点，相同时选择延迟(EWMA)较低的
+- 端点配置了rate_limit(每分钟请求数)或rate_limit_tpm(每分钟token数)时单独限流，额度用完的端点先跳过，都用完时在最空闲的端点上排队
+请求结束后调用release归还端点，并记录延迟、是否被限流，用于之后的选择。
+开启circuit_breaker时每个端点有一个熔断器，熔断中的端点和探测名额已被占用的半开端点不参与选择，都不可用时抛出CircuitOpenError；
+用户自己的api_key通过acquire_direct按api_base共用熔断器。
+"""
+
+import asyncio
+import threading
+import time
+
+from common.circuit_breaker import CircuitOpenError, get_circuit_breaker, is_upstream_failure
+from common.log import logger
+from common.token_bucket import TokenBucket
+
+
+class Endpoint(object):
+    def __init__(self, api_key, api_base=None, weight=1, rate_limit=0, rate_limit_tpm=0, breaker_name=None):
+        """
+        :param weight: 权重，越大分到的请求越多
+        :param rate_limit: 每分钟最多的请求数，0表示不限制
+        :param rate_limit_tpm: 每分钟最多的token数，0表示不限制
+        :param breaker_name: 熔断器的名称，默认每个端点一个
+        """
+        self.api_key = api_key
+        self.api_base = api_base
+        self.weight = max(float(weight), 0.01)
+        self.rpm = TokenBucket(rate_limit) if rate_limit else None
+        self.tpm = TokenBucket(rate_limit_tpm) if rate_limit_tpm else None
+        self.outstanding = 0  # 进行中的请求数
+        self.cooldown_until = 0  # 429后的冷却结束时间
+        self.latency = None  # 延迟的指数加权移动平均，单位秒
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.breaker = get_circuit_breaker(breaker_name or self.name)  # 未开启circuit_breaker时为None
+
+    @property
+    def name(self):
+        return "{}...{}@{}".format(self.api_key[:5], self.api_key[-4:], self.api_base or "default")
+
+    def _try_reserve(self, tokens):
+        """不等待地扣减请求数和token数的额度，额度不足时返回False"""
+        if self.rpm is not None and not self.rpm.get_token(timeout=0):
+            return False
+        if self.tpm is not None and tokens and not self.tpm.get_token(tokens, timeout=0):
+            if self.rpm is not None:
+                self.rpm.charge(-1)
+            return False
+        return True
+
+    def _reserve(self, tokens):
+        """扣减额度，不足时等待；令牌桶在等待前已扣减，等待被中断时退还"""
+        try:
+            if self.rpm is not None:
+                self.rpm.get_token(timeout=float("inf"))
+            if self.tpm is not None and tokens:
+                self.tpm.get_token(tokens, timeout=float("inf"))
+        except BaseException:
+            self._refund(tokens)
+            raise
+
+    async def _reserve_async(self, tokens):
+        try:
+            if self.rpm is not None:
+                await self.rpm.get_token_async(timeout=float("inf"))
+            if self.tpm is not None and tokens:
+                await self.tpm.get_token_async(tokens, timeout=float("inf"))
+        except BaseException:  # 等待时被取消(如对冲中落后的请求)
+            self._refund(tokens)
+            raise
+
+    def _refund(self, tokens):
+        if self.rpm is not None:
+            self.rpm.charge(-1)
+        if self.tpm is not None and tokens:
+            self.tpm.charge(-tokens)
+
+
+class UpstreamPool(object):
+    def __init__(self, endpoints, cooldown=60, ewma_alpha=0.2):
+        """
+        :param endpoints: Endpoint列表
+        :param cooldown: 被限流(429)后的冷却时间，单位秒
+        :param ewma_alpha: 延迟平均的平滑系数，越大越偏重最近的请求
+        """
+        self.endpoints = endpoints
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self.limits_tokens = any(endpoint.tpm is not None for endpoint in endpoints)  # 是否需要预估请求的token数
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0) -> Endpoint:
+        """
+        选择一个端点，使用后必须调用release
+        :param tokens: 请求预计消耗的token数，用于端点的tpm限流
+        """
+        endpoint, reserved = self._select(tokens)
+        if not reserved:  # 所有端点的额度都已用完，在最空闲的端点上排队
+            try:
+                endpoint._reserve(tokens)
+            except BaseException:
+                self._abandon(endpoint)
+                raise
+        return endpoint
+
+    async def acquire_async(self, tokens=0) -> Endpoint:
+        """acquire的协程版本，等待额度时不占用线程"""
+        endpoint, reserved = self._select(tokens)
+        if not reserved:
+            try:
+                await endpoint._reserve_async(tokens)
+            except BaseException:
+                self._abandon(endpoint)
+                raise
+        return endpoint
+
+    def _abandon(self, endpoint: Endpoint):
+        """排队等待额度时被取消，撤销_select计入的请求，归还半开时的探测名额"""
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.requests -= 1
+        if endpoint.breaker is not None:
+            endpoint.breaker.release()
+
+    def acquire_direct(self, api_key, api_base=None) -> Endpoint:
+        """
+        用户自己的api_key不参与选择和限流，同一api_base的用户key共用一个熔断器，熔断时抛出CircuitOpenError，使用后同样调用release
+        """
+        endpoint = Endpoint(api_key, api_base, breaker_name="*@{}".format(api_base or "default"))
+        if endpoint.breaker is not None:
+            endpoint.breaker.check()
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def _select(self, tokens):
+        """选择端点并计入进行中的请求，返回(端点, 是否已扣减额度)"""
+        with self.lock:
+            now = time.monotonic()
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.breaker is None or endpoint.breaker.available()]
+            if not healthy:
+                raise CircuitOpenError(", ".join(endpoint.name for endpoint in self.endpoints))
+            available = [endpoint for endpoint in healthy if endpoint.cooldown_until <= now]
+            if not available:
+                available = [min(healthy, key=lambda endpoint: endpoint.cooldown_until)]
+            chosen = fallback = None
+            for endpoint in sorted(available, key=self._load):
+                # 半开的端点只放行探测请求，探测名额已被占用时跳过
+                if endpoint.breaker is not None and not endpoint.breaker.allow():
+                    continue
+                if endpoint._try_reserve(tokens):
+                    chosen = endpoint
+                    break
+                if fallback is None:
+                    fallback = endpoint  # 额度都用完时在最空闲的端点上排队，保留其探测名额
+                elif endpoint.breaker is not None:
+                    endpoint.breaker.release()
+            if chosen is None and fallback is None:
+                raise CircuitOpenError(", ".join(endpoint.name for endpoint in available))
+            reserved = chosen is not None
+            if chosen is None:
+                chosen = fallback
+            elif fallback is not None and fallback.breaker is not None:
+                fallback.breaker.release()
+            chosen.outstanding += 1
+            chosen.requests += 1
+            return chosen, reserved
+
+    def release(self, endpoint: Endpoint, latency=None, error=None, tokens_delta=0):
+        """
+        归还端点
+        :param latency: 请求成功时的耗时，单位秒
+        :param error: 请求失败时的异常，为限流错误时端点进入冷却期，被取消时为asyncio.CancelledError
+        :param tokens_delta: 实际消耗的token数与预估值的差，用于修正端点的tpm额度
+        """
+        self._record_breaker(endpoint, error)
+        with self.lock:
+            endpoint.outstanding -= 1
+            if latency is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += self.ewma_alpha * (latency - endpoint.latency)
+            if error is not None and not isinstance(error, asyncio.CancelledError):
+                endpoint.errors += 1
+                if _is_rate_limit_error(error):
+                    endpoint.rate_limited += 1
+                    endpoint.cooldown_until = time.monotonic() + self.cooldown
+                    logger.warning("[UpstreamPool] {} rate limited, cool down for {}s".format(endpoint.name, self.cooldown))
+        if tokens_delta and endpoint.tpm is not None:
+            endpoint.tpm.charge(tokens_delta)
+
+    def get_metrics(self) -> list:
+        """
+        :return: 每个端点的进行中请求数、请求数、错误数、限流次数、延迟EWMA和是否在冷却期
+        """
+        with self.lock:
+            now = time.monotonic()
+            return [
+                {
+                    "endpoint": endpoint.name,
+                    "weight": endpoint.weight,
+                    "outstanding": endpoint.outstanding,
+                    "requests": endpoint.requests,
+                    "errors": endpoint.errors,
+                    "rate_limited": endpoint.rate_limited,
+                    "latency": endpoint.latency,
+                    "cooling_down": endpoint.cooldown_until > now,
+                    "breaker": endpoint.breaker.state if endpoint.breaker is not None else None,
+                }
+                for endpoint in self.endpoints
+            ]
+
+    def _record_breaker(self, endpoint: Endpoint, error):
+        if endpoint.breaker is None:
+            return
+        if isinstance(error, asyncio.CancelledError):
+            endpoint.breaker.release()
+        else:
+            endpoint.breaker.record(error is not None and is_upstream_failure(error))
+
+    def _load(self, endpoint: Endpoint):
+        return ((endpoint.outstanding + 1) / endpoint.weight, endpoint.latency or 0)
+
+
+def _is_rate_limit_error(error):
+    if getattr(error, "http_status", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    return type(error).__name__ == "RateLimitError"
+
+
+def create_upstream_pool(entries, cooldown=60):
+    """
+    按配置创建上游接口池
+    :param entries: [{"api_key": ..., "api_base": ..., "weight": 1, "rate_limit": 0, "rate_limit_tpm": 0}, ...]，为空时返回None
+    """
+    if not entries:
+        return None
+    endpoints = [
+        Endpoint(
+            entry["api_key"],
+            entry.get("api_base"),
+            weight=entry.get("weight", 1),
+            rate_limit=entry.get("rate_limit", 0),
+            rate_limit_tpm=entry.get("rate_limit_tpm", 0),
+        )
+        for entry in entries
+    ]
+    logger.info("[UpstreamPool] {} endpoints: {}".format(len(endpoints), ", ".join(endpoint.name for endpoint in endpoints)))
+    return UpstreamPool(endpoints, cooldown)
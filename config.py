@@ -14,7 +14,15 @@ available_setting = {
     "open_ai_api_key": "",  # openai api key
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
+    # 多个api key/api base之间负载均衡，如[{"api_key": "sk-xxx", "api_base": "https://api.openai.com/v1", "weight": 1, "rate_limit": 0, "rate_limit_tpm": 0}]
+    # 每次请求选择进行中请求数/weight最小、延迟较低的一项，rate_limit、rate_limit_tpm为该项每分钟的请求数和token数限制，0表示不限制；为空时使用open_ai_api_key
+    "open_ai_api_pool": [],
+    "upstream_cooldown": 60,  # open_ai_api_pool中的一项被限流(429)后暂停使用的时间，单位秒
     "proxy": "",  # openai使用的代理
+    "http_pool_maxsize": 10,  # 访问外部服务时每个host保持的最大连接数，连接保持keep-alive并复用
+    "http_pool_maxsize_per_host": {},  # 单独指定连接池大小的host，如{"api.link-ai.chat": 20}
+    "http_connect_timeout": 5,  # 访问外部服务的默认连接超时时间，单位秒
+    "http_read_timeout": 60,  # 访问外部服务的默认读取超时时间，单位秒
     # chatgpt模型， 当use_azure_chatgpt为true时，其名称为Azure上model deployment名称
     "model": "gpt-3.5-turbo",
     "use_azure_chatgpt": False,  # 是否使用azure的chatgpt
@@ -33,16 +41,53 @@ available_setting = {
     "group_chat_in_one_session": ["ChatGPT测试群"],  # 支持会话上下文共享的群名称
     "trigger_by_self": False,  # 是否允许机器人触发
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
-    "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1时回复仍按消息顺序发送
+    "reorder_timeout": 60,  # concurrency_in_session大于1时，回复等待前面消息的最长时间，单位秒，超时后不再等待
+    "async_handler": False,  # 是否以协程方式处理消息，开启后等待对话接口响应时不占用线程，可以同时处理更多消息
+    "async_handler_max_inflight": 256,  # async_handler开启时最多同时处理的消息数
+    "async_handler_bot_workers": 32,  # async_handler开启时执行bot中阻塞步骤(会话读写、token计数、不支持协程的bot)的线程数
+    "session_queue_max_size": 0,  # 每个会话最多排队的消息数，0表示不限制
+    "session_queue_overflow_policy": "drop_oldest",  # 排队超出上限时的处理方式，支持：{drop_oldest(丢弃最早的，#管理命令除外), drop_newest(丢弃新消息), coalesce(合并同一发送者连续的文本消息)}
+    "chat_scheduler": "wfq",  # 跨会话的调度方式，支持：{wfq(按通道权重公平调度), fifo(按到达顺序)}
+    "chat_scheduler_lane_weights": {"admin": 8, "private": 4, "plugin": 2, "group": 1},  # wfq调度时各通道的权重，权重越大分到的处理机会越多
+    "outbound_workers": 4,  # 发送消息的线程数，同一接收者的消息按顺序发送
+    "outbound_rate_limit": 0,  # 每个账号每分钟最多发送的消息数，0表示不限制
+    "inbound_queue_durable": False,  # 是否把待处理的文字消息持久化到数据目录，重启后继续处理上次没有处理完的消息
+    "shutdown_drain_timeout": 10,  # 退出时等待处理中的消息完成的最长时间，单位秒
+    "stream_reply": False,  # 是否流式输出文本回复，边生成边按句子分段发送，仅chatgpt和linkai模型、支持多条回复的通道生效
+    "stream_reply_min_chars": 50,  # 流式输出时每段消息的最少字数，达到后在最近的句子结尾处分段发送
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_store": "",  # 会话持久化存储，重启后保留对话上下文，支持：{sqlite}，为空时只保存在内存中
+    "session_budget_max_sessions": 0,  # 所有bot合计最多保留在内存中的会话数，超出时淘汰最久未使用的，0表示不限制
+    "session_budget_max_bytes": 0,  # 所有bot合计内存中会话消息文本的字节数上限，超出时淘汰最久未使用的，0表示不限制
+    "session_cache_max_entries": 0,  # 内存中最多保留的会话数，超出时淘汰最久未使用的(开启session_store时淘汰的会话可以重新加载)，0表示不限制
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "conversation_compact": False,  # 是否在接近conversation_max_tokens时把较早的对话总结为摘要，而不是直接丢弃，仅chatgpt模型支持
+    "conversation_compact_threshold": 0.8,  # token数达到conversation_max_tokens的多少比例时开始总结
+    "conversation_compact_keep": 4,  # 总结时保留的最近消息数
+    "request_coalescing": False,  # 是否合并同时进行中的相同对话请求(上下文和问题都相同)，只请求一次接口，结果返回给所有请求，仅chatgpt和linkai模型支持
+    "request_hedging": False,  # 是否对冲长尾请求，chatgpt请求超过最近延迟的分位数仍未返回时再发一个相同的请求，先返回的结果生效并取消另一个，仅async_handler模式下的非流式回复支持
+    "hedge_percentile": 95,  # 发出对冲请求的延迟分位数
+    "hedge_budget": 0.1,  # 对冲请求数占总请求数的最大比例
+    "hedge_delay": 10,  # 延迟样本不足时发出对冲请求前的等待时间，单位秒
+    "hedge_min_delay": 1,  # 发出对冲请求前等待时间的下限，单位秒
+    "circuit_breaker": False,  # 是否开启熔断，对话接口的端点连续故障后一段时间内不再请求，直接返回提示，仅chatgpt和linkai模型支持
+    "circuit_breaker_threshold": 5,  # 连续多少次上游故障(超时、连接失败、5xx)后熔断
+    "circuit_breaker_recovery": 30,  # 熔断后多少秒放行一个探测请求，成功则恢复
+    "reply_cache": False,  # 是否缓存文本回复，相同的问题(忽略标点、空白、大小写)直接返回之前的回复，不再请求接口
+    "reply_cache_ttl": 3600,  # 缓存的回复的有效期，单位秒
+    "reply_cache_max_entries": 1000,  # 最多缓存的回复数，超出时淘汰最久未命中的
+    "reply_cache_context_turns": 0,  # 大于0时，只有会话最近这么多条消息也相同时才命中缓存，0表示只比较问题
+    "reply_cache_disabled_sessions": [],  # 不使用回复缓存的session_id列表
+    "tiktoken_warm_up": True,  # 启动时是否在后台预加载对话模型的tiktoken编码器，避免第一条消息等待加载
     # chatgpt限流配置
-    "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
-    "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    "rate_limit_chatgpt": 20,  # chatgpt每分钟最多的请求数
+    "rate_limit_chatgpt_tpm": 0,  # chatgpt每分钟最多消耗的token数(prompt+回复)，0表示不限制
+    "rate_limit_dalle": 50,  # openai dalle每分钟最多的请求数
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
@@ -99,6 +144,9 @@ available_setting = {
     "channel_type": "wx",  # 通道类型，支持：{wx,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app}
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
+    "latency_metrics": False,  # 是否统计消息处理各阶段的耗时
+    "latency_metrics_log_interval": 300,  # 耗时统计输出到日志的间隔，单位秒
+    "metrics_log_interval": 0,  # 大于0时按该间隔(秒)把调度器、回复缓存、熔断器、接口池、请求合并和对冲的统计输出到日志，0表示不输出
     "appdata_dir": "",  # 数据目录
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
@@ -109,6 +157,79 @@ available_setting = {
 }
 
 
+# 快照中未配置时使用的默认值，与各调用处conf().get的默认值保持一致
+snapshot_defaults = {
+    "model": "gpt-3.5-turbo",
+    "single_chat_prefix": [""],
+    "single_chat_reply_prefix": "",
+    "single_chat_reply_suffix": "",
+    "group_chat_prefix": [],
+    "group_chat_reply_prefix": "",
+    "group_chat_reply_suffix": "",
+    "group_chat_keyword": [],
+    "group_at_off": False,
+    "group_name_white_list": [],
+    "group_name_keyword_white_list": [],
+    "group_chat_in_one_session": [],
+    "trigger_by_self": True,
+    "image_create_prefix": [],
+    "concurrency_in_session": 4,
+    "reorder_timeout": 60,
+    "stream_reply": False,
+    "stream_reply_min_chars": 50,
+    "session_queue_max_size": 0,
+    "session_queue_overflow_policy": "drop_oldest",
+    "character_desc": "",
+    "conversation_max_tokens": 1000,
+    "voice_reply_voice": False,
+    "always_reply_voice": False,
+    "clear_memory_commands": ["#清除记忆"],
+    "plugin_trigger_prefix": "$",
+}
+
+
+SESSION_QUEUE_OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "coalesce")
+
+
+def validate_config(config):
+    """检查取值有限的配置项，不支持的取值给出警告并改为默认值"""
+    policy = config.get("session_queue_overflow_policy")
+    if policy is not None and policy not in SESSION_QUEUE_OVERFLOW_POLICIES:
+        default = snapshot_defaults["session_queue_overflow_policy"]
+        logger.warning(
+            "[INIT] unknown session_queue_overflow_policy: {}, supported: {}, use {} instead".format(policy, ", ".join(SESSION_QUEUE_OVERFLOW_POLICIES), default)
+        )
+        config["session_queue_overflow_policy"] = default
+
+
+class ConfigSnapshot(object):
+    """
+    只读的配置快照，每次加载配置时生成一份新的并整体替换，读取方拿到的快照在使用期间不会变化
+    属性名与available_setting中的配置项一致，未配置的项为snapshot_defaults中的默认值或None，列表类型的配置转换为元组
+    """
+
+    def __init__(self, config, version):
+        values = {}
+        for key in available_setting:
+            value = config.get(key)
+            if value is None:
+                value = snapshot_defaults.get(key)
+            if isinstance(value, list):
+                value = tuple(value)
+            values[key] = value
+        values["version"] = version
+        self.__dict__.update(values)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("ConfigSnapshot is read-only")
+
+    def __delattr__(self, key):
+        raise AttributeError("ConfigSnapshot is read-only")
+
+    def __repr__(self):
+        return "ConfigSnapshot(version={})".format(self.version)
+
+
 class Config(dict):
     def __init__(self, d=None):
         super().__init__()
@@ -118,6 +239,8 @@ class Config(dict):
             self[k] = v
         # user_datas: 用户数据，key为用户名，value为用户数据，也是dict
         self.user_datas = {}
+        # snapshot: 加载完成时生成的只读快照
+        self.snapshot = ConfigSnapshot(self, 0)
 
     def __getitem__(self, key):
         if key not in available_setting:
@@ -130,12 +253,9 @@ class Config(dict):
         return super().__setitem__(key, value)
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
-            return default
-        except Exception as e:
-            raise e
+        if key not in available_setting:
+            raise Exception("key {} not in available_setting".format(key))
+        return super().get(key, default)
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
@@ -164,10 +284,12 @@ class Config(dict):
 
 
 config = Config()
+config_version = 0
+reload_callbacks = []
 
 
 def load_config():
-    global config
+    global config, config_version
     config_path = "./config.json"
     if not os.path.exists(config_path):
         logger.info("配置文件不存在，将使用config-template.json模板")
@@ -176,8 +298,8 @@ def load_config():
     config_str = read_file(config_path)
     logger.debug("[INIT] config str: {}".format(config_str))
 
-    # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    # 将json字符串反序列化为dict类型，在新对象上完成全部加载后再替换全局配置，避免读取方看到加载了一半的配置
+    new_config = Config(json.loads(config_str))
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -186,22 +308,44 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                new_config[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    new_config[name] = False
                 elif value == "true":
-                    config[name] = True
+                    new_config[name] = True
                 else:
-                    config[name] = value
+                    new_config[name] = value
 
-    if config.get("debug", False):
+    if new_config.get("debug", False):
         logger.setLevel(logging.DEBUG)
         logger.debug("[INIT] set log level to DEBUG")
 
-    logger.info("[INIT] load config: {}".format(config))
+    logger.info("[INIT] load config: {}".format(new_config))
+    validate_config(new_config)
+
+    if config_version == 0:
+        new_config.load_user_datas()
+    else:  # 重新加载时沿用内存中的用户数据，避免丢失未保存的修改
+        new_config.user_datas = config.user_datas
 
-    config.load_user_datas()
+    config_version += 1
+    new_config.snapshot = ConfigSnapshot(new_config, config_version)
+    config = new_config
+
+    for callback in list(reload_callbacks):
+        try:
+            callback(new_config.snapshot)
+        except Exception as e:
+            logger.exception("[INIT] config reload callback error: {}".format(e))
+
+
+def subscribe_config_reload(callback):
+    """
+    订阅配置加载事件，每次加载配置完成后以新的快照调用callback
+    :param callback: 参数为ConfigSnapshot的函数
+    """
+    reload_callbacks.append(callback)
 
 
 def get_root():
@@ -217,6 +361,11 @@ def conf():
     return config
 
 
+def conf_snapshot() -> ConfigSnapshot:
+    """当前配置的只读快照，热路径上代替多次conf().get调用"""
+    return config.snapshot
+
+
 def get_appdata_dir():
     data_path = os.path.join(get_root(), conf().get("appdata_dir", ""))
     if not os.path.exists(data_path):
@@ -4,7 +4,7 @@ import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from config import conf
+from config import conf_snapshot
 from plugins import *
 
 
@@ -28,7 +28,7 @@ class Finish(Plugin):
 
         content = e_context["context"].content
         logger.debug("[Finish] on_handle_context. content: %s" % content)
-        trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+        trigger_prefix = conf_snapshot().plugin_trigger_prefix
         if content.startswith(trigger_prefix):
             reply = Reply()
             reply.type = ReplyType.ERROR
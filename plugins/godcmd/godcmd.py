@@ -13,7 +13,7 @@ from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
 from common.log import logger
-from config import conf, load_config
+from config import conf, conf_snapshot, load_config
 from plugins import *
 
 # 定义指令集
@@ -396,7 +396,7 @@ class Godcmd(Plugin):
                 else:
                     ok, result = False, "需要管理员权限才能执行该指令"
             else:
-                trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+                trigger_prefix = conf_snapshot().plugin_trigger_prefix
                 if trigger_prefix == "#":  # 跟插件聊天指令前缀相同，继续递交
                     return
                 ok, result = False, f"未知指令：{cmd}\n查看指令列表请输入#help \n"
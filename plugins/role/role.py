@@ -9,7 +9,7 @@ from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
 from common.log import logger
-from config import conf
+from config import conf_snapshot
 from plugins import *
 
 
@@ -107,7 +107,7 @@ class Role(Plugin):
         desckey = None
         customize = False
         sessionid = e_context["context"]["session_id"]
-        trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+        trigger_prefix = conf_snapshot().plugin_trigger_prefix
         if clist[0] == f"{trigger_prefix}停止扮演":
             if sessionid in self.roleplays:
                 self.roleplays[sessionid].reset()
@@ -188,7 +188,7 @@ class Role(Plugin):
         help_text = "让机器人扮演不同的角色。\n"
         if not verbose:
             return help_text
-        trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+        trigger_prefix = conf_snapshot().plugin_trigger_prefix
         help_text = f"使用方法:\n{trigger_prefix}角色" + " 预设角色名: 设定角色为{预设角色名}。\n" + f"{trigger_prefix}role" + " 预设角色名: 同上，但使用英文设定。\n"
         help_text += f"{trigger_prefix}设定扮演" + " 角色设定: 设定自定义角色人设为{角色设定}。\n"
         help_text += f"{trigger_prefix}停止扮演: 清除设定的角色。\n"
@@ -10,7 +10,7 @@ from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common import const
-from config import conf
+from config import conf, conf_snapshot
 from plugins import *
 
 
@@ -32,7 +32,7 @@ class Tool(Plugin):
 
     def get_help_text(self, verbose=False, **kwargs):
         help_text = "这是一个能让chatgpt联网，搜索，数字运算的插件，将赋予强大且丰富的扩展能力。"
-        trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+        trigger_prefix = conf_snapshot().plugin_trigger_prefix
         if not verbose:
             return help_text
         help_text += "\n使用说明：\n"
@@ -68,7 +68,7 @@ class Tool(Plugin):
         logger.debug("[tool] on_handle_context. content: %s" % content)
         reply = Reply()
         reply.type = ReplyType.TEXT
-        trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+        trigger_prefix = conf_snapshot().plugin_trigger_prefix
         # todo: 有些工具必须要api-key，需要修改config文件，所以这里没有实现query增删tool的功能
         if content.startswith(f"{trigger_prefix}tool"):
             if len(content_list) == 1:
@@ -96,7 +96,7 @@ class Tool(Plugin):
 
                 # Don't modify bot name
                 all_sessions = Bridge().get_bot("chat").sessions
-                user_session = all_sessions.session_query(query, e_context["context"]["session_id"]).messages
+                user_session = all_sessions.session_query(query, e_context["context"]["session_id"]).to_payload()
 
                 # chatgpt-tool-hub will reply you with many tools
                 logger.debug("[tool]: just-go")
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from channel.channel import Channel
+from channel.chat_channel import ChatChannel
+from common.circuit_breaker import RetryLater, retry_after
+
+
+class FakeChannel(ChatChannel):
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.done = threading.Event()
+
+    def send(self, reply: Reply, context: Context):
+        self.sent.append(reply.content)
+        self.done.set()
+
+
+def test_retry_releases_worker_slot_while_waiting(monkeypatch):
+    attempts = []
+
+    def ask(retry_count=0):
+        attempts.append(retry_count)
+        if retry_count < 2:
+            return retry_after(0.2, ask, retry_count + 1)
+        return "answer"
+
+    def build_reply_content(self, query, context=None):
+        try:
+            content = ask()
+        except RetryLater as e:
+            raise e.then(lambda content: Reply(ReplyType.TEXT, content))
+        return Reply(ReplyType.TEXT, content)
+
+    monkeypatch.setattr(Channel, "build_reply_content", build_reply_content)
+    channel = FakeChannel()
+    idle_slots = channel.worker_slots._value
+    channel.produce(Context(ContextType.TEXT, "question", {"session_id": "retry", "receiver": "retry"}))
+    time.sleep(0.1)
+    assert channel.retrying == 1
+    assert channel.worker_slots._value == idle_slots  # 等待重试时不占用处理名额
+    assert channel.done.wait(5)
+    assert attempts == [0, 1, 2]
+    assert channel.sent == ["answer"]
+    assert channel.retrying == 0
+
+
+def test_cancel_session_drops_waiting_retry(monkeypatch):
+    def build_reply_content(self, query, context=None):
+        return retry_after(0.2, lambda: Reply(ReplyType.TEXT, "answer"))
+
+    monkeypatch.setattr(Channel, "build_reply_content", build_reply_content)
+    channel = FakeChannel()
+    channel.produce(Context(ContextType.TEXT, "question", {"session_id": "cancel-retry", "receiver": "cancel-retry"}))
+    time.sleep(0.1)
+    assert channel.retrying == 1
+    channel.cancel_session("cancel-retry")
+    assert channel.retrying == 0
+    assert "cancel-retry" not in channel.retry_timers
+    time.sleep(0.2)
+    assert channel.sent == []
+    assert "cancel-retry" not in channel.sessions  # 并发名额已归还，session被清理
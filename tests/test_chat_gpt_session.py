@@ -0,0 +1,92 @@
+import threading
+
+import pytest
+
+pytest.importorskip("tiktoken")
+
+from bot.chatgpt.chat_gpt_session import ChatGPTSession, num_tokens_from_messages
+from bot.session_compactor import SessionCompactor
+from bot.session_manager import SessionManager
+
+
+def make_session(turns=4):
+    session = ChatGPTSession("a", "you are a helpful assistant")
+    for i in range(turns):
+        session.add_query("question number {}".format(i))
+        session.add_reply("answer number {} with a few more words".format(i))
+    return session
+
+
+def assert_tokens_consistent(session):
+    assert session.calc_tokens() == num_tokens_from_messages(session.messages, session.model)
+    assert session.approx_size() == sum(len(item.content.encode("utf-8")) for item in session.messages)
+
+
+def test_tokens_after_discard_exceeding():
+    session = make_session()
+    assert_tokens_consistent(session)
+    max_tokens = session.calc_tokens() - 10
+    assert session.discard_exceeding(max_tokens) <= max_tokens
+    assert session.messages[0].role == "system"
+    assert_tokens_consistent(session)
+
+
+def test_tokens_after_pop_and_reset():
+    session = make_session()
+    session._pop(1)
+    session._pop(len(session.messages) - 1)
+    assert_tokens_consistent(session)
+    session.reset()
+    assert len(session.messages) == 1
+    assert_tokens_consistent(session)
+
+
+def test_compact_replaces_old_messages():
+    session = make_session()
+    old_messages = session.messages[1:5]
+    assert session.compact(old_messages, "summary of the first two turns")
+    assert len(session.messages) == 6
+    assert session.messages[1].content == "summary of the first two turns"
+    assert_tokens_consistent(session)
+
+
+def test_compact_skips_discarded_messages():
+    session = make_session()
+    old_messages = session.messages[1:5]
+    session._pop(1)
+    assert session.compact(old_messages, "summary")
+    assert len(session.messages) == 6
+    assert_tokens_consistent(session)
+
+
+def test_compact_rejects_modified_messages():
+    session = make_session()
+    old_messages = session.messages[1:5]
+    session.reset()
+    session.add_query("new question")
+    assert not session.compact(old_messages, "summary")
+    assert_tokens_consistent(session)
+
+
+def test_compaction_runs_alongside_new_messages():
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def summarize(messages):
+        started.set()
+        proceed.wait(5)
+        return "summary"
+
+    manager = SessionManager(ChatGPTSession, model="gpt-3.5-turbo")
+    manager.compactor = SessionCompactor(summarize, threshold=0, keep=2)
+    for i in range(4):
+        manager.session_query("question {}".format(i), "a")
+        manager.session_reply("answer {}".format(i), "a")
+    assert started.wait(5)
+    session = manager.session_query("question while compacting", "a")
+    manager.session_reply("answer while compacting", "a")
+    proceed.set()
+    manager.compactor.pool.shutdown(wait=True)
+    assert session.messages[1].content.endswith("summary")
+    assert session.messages[-1].content == "answer while compacting"
+    assert_tokens_consistent(session)
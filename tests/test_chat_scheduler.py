@@ -0,0 +1,66 @@
+from collections import Counter
+
+import pytest
+
+from channel.chat_scheduler import LANE_ADMIN, LANE_GROUP, LANE_PLUGIN, LANE_PRIVATE, FifoScheduler, WeightedFairScheduler, create_scheduler
+
+
+def fill(scheduler, lane, count):
+    for i in range(count):
+        scheduler.put("{}-{}".format(lane, i), lane)
+
+
+def test_lanes_share_by_weight():
+    scheduler = WeightedFairScheduler()
+    for lane in (LANE_ADMIN, LANE_PRIVATE, LANE_PLUGIN, LANE_GROUP):
+        fill(scheduler, lane, 20)
+    lanes = Counter(scheduler.get().split("-")[0] for _ in range(30))
+    assert lanes == {LANE_ADMIN: 16, LANE_PRIVATE: 8, LANE_PLUGIN: 4, LANE_GROUP: 2}
+
+
+def test_idle_lanes_do_not_bank_credit():
+    scheduler = WeightedFairScheduler({LANE_ADMIN: 0, LANE_PLUGIN: 0})
+    fill(scheduler, LANE_GROUP, 10)
+    for _ in range(5):
+        scheduler.get()
+    fill(scheduler, LANE_PRIVATE, 10)
+    order = [scheduler.get().split("-")[0] for _ in range(5)]
+    assert order.count(LANE_PRIVATE) == 4
+
+
+def test_sessions_in_a_lane_take_turns():
+    scheduler = WeightedFairScheduler()
+    scheduler.put("a", LANE_GROUP)
+    scheduler.put("b", LANE_GROUP)
+    assert scheduler.get() == "a"
+    scheduler.put("a", LANE_GROUP)  # a处理完一条后还有消息，排到b之后
+    assert scheduler.get() == "b"
+    assert scheduler.get() == "a"
+
+
+def test_duplicate_put_is_ignored_and_upgrade_moves_lane():
+    scheduler = WeightedFairScheduler()
+    scheduler.put("a", LANE_GROUP)
+    scheduler.put("a", LANE_GROUP)
+    scheduler.put("b", LANE_GROUP)
+    scheduler.put("b", LANE_ADMIN)
+    assert scheduler.get() == "b"
+    assert scheduler.get() == "a"
+    assert scheduler.get_metrics()[LANE_GROUP]["queued"] == 0
+    assert scheduler.get_metrics()[LANE_ADMIN]["count"] == 1
+
+
+def test_fifo_scheduler_keeps_notify_order():
+    scheduler = FifoScheduler()
+    for session_id in ("b", "a", "b", "c"):
+        scheduler.put(session_id, LANE_ADMIN if session_id == "c" else LANE_GROUP)
+    assert [scheduler.get() for _ in range(3)] == ["b", "a", "c"]
+
+
+def test_create_scheduler():
+    assert isinstance(create_scheduler("fifo"), FifoScheduler)
+    assert isinstance(create_scheduler("wfq", {LANE_GROUP: 3}), WeightedFairScheduler)
+    with pytest.raises(RuntimeError):
+        create_scheduler("unknown")
+    with pytest.raises(ValueError):
+        WeightedFairScheduler({lane: 0 for lane in (LANE_ADMIN, LANE_PRIVATE, LANE_PLUGIN, LANE_GROUP)})
@@ -0,0 +1,135 @@
+import time
+
+import pytest
+
+from common.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, RetryLater, backoff_delay, deferrable, is_upstream_failure, retry_after
+from common.upstream_pool import Endpoint, UpstreamPool
+
+
+def open_breaker(name="test", recovery_timeout=0.05):
+    breaker = CircuitBreaker(name, failure_threshold=2, recovery_timeout=recovery_timeout)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.get_metrics()["rejected"] == 2
+
+
+def test_half_open_admits_one_probe():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.available()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.get_metrics()["opened"] == 2
+
+
+def test_released_probe_is_returned():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    for retry_count in range(8):
+        delay = backoff_delay(retry_count, 2, cap=10)
+        ceiling = min(10, 2 * 2**retry_count)
+        assert ceiling / 2 <= delay <= ceiling
+
+
+def test_is_upstream_failure():
+    assert is_upstream_failure(TimeoutError())
+    assert not is_upstream_failure(ValueError())
+
+    class HttpError(Exception):
+        def __init__(self, http_status):
+            self.http_status = http_status
+
+    assert is_upstream_failure(HttpError(502))
+    assert not is_upstream_failure(HttpError(429))
+
+
+def make_pool(*breakers):
+    endpoints = []
+    for i, breaker in enumerate(breakers):
+        endpoint = Endpoint("sk-endpoint-{}".format(i))
+        endpoint.breaker = breaker
+        endpoints.append(endpoint)
+    return UpstreamPool(endpoints)
+
+
+def test_pool_skips_half_open_endpoint_with_probe_in_flight():
+    half_open = open_breaker("a")
+    time.sleep(0.06)
+    pool = make_pool(half_open, CircuitBreaker("b"))
+    pool.endpoints[1].outstanding = 5  # 半开的端点更空闲，会被优先选择
+    probe = pool.acquire()
+    assert probe is pool.endpoints[0]
+    assert pool.acquire() is pool.endpoints[1]
+    assert pool.acquire() is pool.endpoints[1]
+    pool.release(probe, latency=0.1)
+    assert half_open.state == CLOSED
+
+
+def test_pool_raises_when_last_endpoint_is_probing():
+    half_open = open_breaker("a")
+    time.sleep(0.06)
+    pool = make_pool(half_open)
+    probe = pool.acquire()
+    with pytest.raises(CircuitOpenError):
+        pool.acquire()
+    pool.release(probe, error=TimeoutError())
+    assert half_open.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        pool.acquire()
+
+
+def test_retry_after_waits_outside_deferrable():
+    start = time.monotonic()
+    assert retry_after(0.05, lambda value: value + 1, 1) == 2
+    assert time.monotonic() - start >= 0.05
+
+
+def test_retry_later_resumes_with_callbacks():
+    def attempt(n):
+        if n < 2:
+            return retry_after(1, attempt, n + 1)
+        return n
+
+    with deferrable():
+        with pytest.raises(RetryLater) as first:
+            try:
+                attempt(0)
+            except RetryLater as e:
+                raise e.then(lambda n: n * 10)
+        with pytest.raises(RetryLater) as second:
+            first.value.resume()
+        assert second.value.args == (2,)
+        assert second.value.resume() == 20
@@ -0,0 +1,10 @@
+from config import Config, validate_config
+
+
+def test_unknown_overflow_policy_falls_back_to_default():
+    config = Config({"session_queue_overflow_policy": "drop_random"})
+    validate_config(config)
+    assert config.get("session_queue_overflow_policy") == "drop_oldest"
+    config = Config({"session_queue_overflow_policy": "coalesce"})
+    validate_config(config)
+    assert config.get("session_queue_overflow_policy") == "coalesce"
@@ -0,0 +1,58 @@
+import copy
+import time
+
+from common.expired_dict import ExpiredDict
+
+
+def test_entries_expire_after_last_access():
+    cache = ExpiredDict(0.1)
+    cache["a"] = 1
+    cache["b"] = 2
+    time.sleep(0.06)
+    assert cache["a"] == 1  # 访问后重新计时
+    time.sleep(0.06)
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert len(cache) == 1
+
+
+def test_max_entries_evicts_least_recently_used():
+    expired = []
+    cache = ExpiredDict(float("inf"), max_entries=2, on_expire=lambda key, value: expired.append((key, value)))
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache["a"] == 1
+    cache["c"] = 3
+    assert expired == [("b", 2)]
+    assert sorted(cache.keys()) == ["a", "c"]
+
+
+def test_on_expire_is_not_called_for_explicit_removal():
+    expired = []
+    cache = ExpiredDict(0.05, on_expire=lambda key, value: expired.append((key, value)))
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["c"] = 3
+    del cache["a"]
+    assert cache.pop("b") == 2
+    time.sleep(0.06)
+    assert cache.items() == []
+    assert expired == [("c", 3)]
+    cache["d"] = 4
+    cache.clear()
+    assert len(cache) == 0
+    assert expired == [("c", 3)]
+
+
+def test_copy_keeps_settings_and_expiry():
+    cache = ExpiredDict(0.1, max_entries=5)
+    cache["a"] = 1
+    for copied in (cache.copy(), copy.copy(cache)):
+        assert isinstance(copied, ExpiredDict)
+        assert copied.max_entries == 5
+        assert copied["a"] == 1
+        copied["b"] = 2
+        assert "b" not in cache
+    time.sleep(0.11)
+    assert "a" not in cache.copy()
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from common.hedge import MIN_SAMPLES, Hedger
+
+
+class FakeUpstream(object):
+    """按调用顺序返回预设延迟和结果的上游，记录被取消的调用"""
+
+    def __init__(self, hedger, *responses):
+        self.hedger = hedger
+        self.responses = list(responses)
+        self.calls = 0
+        self.cancelled = []
+
+    async def call(self, query):
+        index = self.calls
+        self.calls += 1
+        delay, result = self.responses[index]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(index)
+            raise
+        if isinstance(result, Exception):
+            raise result
+        self.hedger.record(delay)
+        return "{} {}".format(query, result)
+
+
+def run(hedger, upstream, query="q"):
+    return asyncio.run(hedger.run_async(upstream.call, query))
+
+
+def test_no_hedge_before_deadline():
+    hedger = Hedger("test", delay=0.2)
+    upstream = FakeUpstream(hedger, (0.05, "primary"))
+    assert run(hedger, upstream) == "q primary"
+    assert upstream.calls == 1
+    assert hedger.get_metrics()["hedged"] == 0
+
+
+def test_hedge_wins_and_primary_is_cancelled():
+    hedger = Hedger("test", delay=0.05)
+    upstream = FakeUpstream(hedger, (1, "primary"), (0.01, "hedge"))
+    assert run(hedger, upstream) == "q hedge"
+    assert upstream.cancelled == [0]
+    metrics = hedger.get_metrics()
+    assert metrics["hedged"] == 1 and metrics["hedge_wins"] == 1
+
+
+def test_failed_winner_waits_for_the_other():
+    hedger = Hedger("test", delay=0.05)
+    upstream = FakeUpstream(hedger, (0.15, "primary"), (0.01, IOError("hedge failed")))
+    assert run(hedger, upstream) == "q primary"
+    assert hedger.get_metrics()["hedge_wins"] == 0
+
+
+def test_both_failed_raise_primary_error():
+    hedger = Hedger("test", delay=0.05)
+    upstream = FakeUpstream(hedger, (0.1, ValueError("primary failed")), (0.01, IOError("hedge failed")))
+    with pytest.raises(ValueError):
+        run(hedger, upstream)
+
+
+def test_budget_caps_hedged_requests():
+    hedger = Hedger("test", budget=0.5, delay=0.02)
+    upstream = FakeUpstream(hedger, *[(0.05, "slow")] * 8)
+    for _ in range(4):
+        assert run(hedger, upstream) == "q slow"
+    metrics = hedger.get_metrics()
+    assert metrics["requests"] == 4
+    assert metrics["hedged"] == 2  # 不超过请求数的一半
+
+
+def test_delay_follows_recorded_percentile():
+    hedger = Hedger("test", percentile=90, delay=10, min_delay=0.5)
+    for i in range(MIN_SAMPLES - 1):
+        hedger.record(i)
+    assert hedger.delay() == 10
+    hedger.record(MIN_SAMPLES - 1)
+    assert hedger.delay() == 18
+    hedger.samples.clear()
+    for _ in range(MIN_SAMPLES):
+        hedger.record(0.1)
+    assert hedger.delay() == 0.5
@@ -0,0 +1,16 @@
+from common import metrics
+from common.single_flight import SingleFlight
+
+
+def test_collect_registered_metrics():
+    flight = SingleFlight("test")
+    metrics.register("single_flight.test", flight.get_metrics)
+    metrics.register("broken.test", lambda: 1 / 0)
+    try:
+        collected = metrics.collect()
+        assert collected["single_flight.test"] == {"inflight": 0, "leaders": 0, "followers": 0}
+        assert collected["broken.test"].startswith("error:")
+    finally:
+        metrics.unregister("single_flight.test")
+        metrics.unregister("broken.test")
+    assert "single_flight.test" not in metrics.collect()
@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+
+from channel.outbound_dispatcher import OutboundDispatcher
+
+
+class FastRetryDispatcher(OutboundDispatcher):
+    """把重试等待缩短到原来的1/100"""
+
+    def _execute(self, job):
+        finished, delay = super()._execute(job)
+        return finished, delay / 100
+
+
+def record(sent, receiver, item, pause=0):
+    if pause:
+        time.sleep(pause)
+    sent.append((receiver, item))
+
+
+def test_keeps_order_per_receiver():
+    dispatcher = OutboundDispatcher("test", workers=4)
+    sent = []
+    for i in range(20):
+        for receiver in ("a", "b", "c"):
+            dispatcher.submit(receiver, record, sent, receiver, i, random.random() / 200)
+    assert dispatcher.join(5)
+    for receiver in ("a", "b", "c"):
+        assert [item for r, item in sent if r == receiver] == list(range(20))
+
+
+def test_retry_holds_back_later_jobs_of_the_same_receiver():
+    dispatcher = FastRetryDispatcher("test", workers=2)
+    sent = []
+    failures = [1]
+
+    def flaky():
+        if failures[0]:
+            failures[0] -= 1
+            raise IOError("send failed")
+        sent.append(("a", "first"))
+
+    dispatcher.submit("a", flaky)
+    dispatcher.submit("a", record, sent, "a", "second")
+    dispatcher.submit("b", record, sent, "b", "other")
+    assert dispatcher.join(5)
+    assert [item for r, item in sent if r == "a"] == ["first", "second"]
+    assert sent[0] == ("b", "other")  # 重试等待期间不阻塞其它接收者
+
+
+def test_gives_up_after_max_retry():
+    dispatcher = FastRetryDispatcher("test", workers=1)
+    attempts = []
+    sent = []
+
+    def broken():
+        attempts.append(1)
+        raise IOError("send failed")
+
+    def unsupported():
+        attempts.append(1)
+        raise NotImplementedError
+
+    dispatcher.submit("a", broken)
+    dispatcher.submit("a", unsupported)
+    dispatcher.submit("a", record, sent, "a", "next")
+    assert dispatcher.join(5)
+    assert len(attempts) == OutboundDispatcher.MAX_RETRY + 2
+    assert sent == [("a", "next")]
+
+
+def test_jobs_submitted_while_sending_follow_the_current_job():
+    dispatcher = OutboundDispatcher("test", workers=1)
+    sent = []
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def split():
+        started.set()
+        proceed.wait(5)
+        sent.append(("a", "part 1"))
+        dispatcher.submit("a", record, sent, "a", "part 2")
+
+    dispatcher.submit("a", split)
+    assert started.wait(5)
+    dispatcher.submit("a", record, sent, "a", "later")
+    proceed.set()
+    assert dispatcher.join(5)
+    assert [item for _, item in sent] == ["part 1", "part 2", "later"]
+
+
+def test_pace_delays_the_next_job():
+    dispatcher = OutboundDispatcher("test", workers=2)
+    times = []
+    dispatcher.submit("a", lambda: times.append(time.monotonic()), pace=0.1)
+    dispatcher.submit("a", lambda: times.append(time.monotonic()))
+    assert dispatcher.join(5)
+    assert times[1] - times[0] >= 0.1
+
+
+def test_inline_sends_in_the_caller_thread():
+    dispatcher = OutboundDispatcher("test", inline=True)
+    threads = []
+    dispatcher.submit("a", lambda: threads.append(threading.current_thread()))
+    assert threads == [threading.current_thread()]
+
+
+def test_after_runs_once_earlier_jobs_are_sent():
+    dispatcher = OutboundDispatcher("test", workers=2)
+    sent = []
+
+    def split(receiver):
+        sent.append((receiver, "head"))
+        dispatcher.submit(receiver, record, sent, receiver, "tail", 0.02)
+
+    dispatcher.submit("a", record, sent, "a", "first", 0.02)
+    dispatcher.submit("a", split, "a")
+    dispatcher.after("a", sent.append, ("a", "done"))
+    dispatcher.after("b", sent.append, ("b", "done"))  # 没有待发送的任务，立即执行
+    assert sent == [("b", "done")]
+    assert dispatcher.join(5)
+    assert [item for r, item in sent if r == "a"] == ["first", "head", "tail", "done"]
@@ -0,0 +1,63 @@
+import threading
+
+from channel.reorder_buffer import ReorderBuffer
+
+
+def make_buffer(timeout=60):
+    released = []
+    return ReorderBuffer(released.append, timeout), released
+
+
+def test_head_replies_are_sent_immediately():
+    buffer, released = make_buffer()
+    seq = buffer.stamp()
+    buffer.put(seq, "a1")
+    buffer.put(seq, "a2")
+    assert released == ["a1", "a2"]
+    buffer.complete(seq)
+    assert buffer.empty()
+
+
+def test_later_replies_wait_for_earlier_messages():
+    buffer, released = make_buffer()
+    first, second, third = buffer.stamp(), buffer.stamp(), buffer.stamp()
+    buffer.put(third, "c")
+    buffer.complete(third)
+    buffer.put(second, "b1")
+    buffer.put(second, "b2")
+    assert released == []
+    buffer.put(first, "a")
+    assert released == ["a"]
+    buffer.complete(first)
+    assert released == ["a", "b1", "b2"]
+    buffer.complete(second)
+    assert released == ["a", "b1", "b2", "c"]
+    assert buffer.empty()
+
+
+def test_message_without_reply_unblocks_the_next():
+    buffer, released = make_buffer()
+    first, second = buffer.stamp(), buffer.stamp()
+    buffer.put(second, "b")
+    buffer.complete(first)
+    assert released == ["b"]
+    buffer.put(second, "b again")
+    assert released == ["b", "b again"]
+
+
+def test_stuck_head_is_skipped_after_timeout():
+    done = threading.Event()
+    released = []
+
+    def release(reply):
+        released.append(reply)
+        done.set()
+
+    buffer = ReorderBuffer(release, timeout=0.05)
+    first, second = buffer.stamp(), buffer.stamp()
+    buffer.put(second, "b")
+    assert done.wait(5)
+    assert released == ["b"]
+    buffer.complete(first)  # 超时后才结束的消息不影响后面的回复
+    buffer.put(first, "late a")
+    assert released == ["b", "late a"]
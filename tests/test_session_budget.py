@@ -0,0 +1,119 @@
+import time
+
+from bot.session_budget import SessionBudget
+from bot.session_manager import Session, SessionManager
+from common.expired_dict import ExpiredDict
+
+
+class FakeManager(object):
+    namespace = "FakeManager"
+
+    def __init__(self):
+        self.evicted = []
+
+    def evict_session(self, session_id, session):
+        self.evicted.append(session_id)
+
+
+def make_session(session_id, text=""):
+    session = Session(session_id, "")
+    session.reset()
+    if text:
+        session.add_query(text)
+    return session
+
+
+def test_touch_evicts_least_recently_used():
+    budget = SessionBudget(max_sessions=2)
+    manager = FakeManager()
+    a, b, c = make_session("a"), make_session("b"), make_session("c")
+    budget.touch(manager, a)
+    budget.touch(manager, b)
+    budget.touch(manager, a)
+    budget.touch(manager, c)
+    assert manager.evicted == ["b"]
+    assert budget.get_metrics() == {"sessions": 2, "bytes": 0, "evictions": 1}
+
+
+def test_bytes_follow_session_size():
+    budget = SessionBudget(max_bytes=10)
+    manager = FakeManager()
+    a = make_session("a", "1234")
+    budget.touch(manager, a)
+    assert budget.get_metrics()["bytes"] == 4
+    a.add_reply("你好")
+    budget.touch(manager, a)
+    assert budget.get_metrics()["bytes"] == 10
+    budget.touch(manager, make_session("b", "x"))
+    assert manager.evicted == ["a"]
+    assert budget.get_metrics() == {"sessions": 1, "bytes": 1, "evictions": 1}
+
+
+def test_remove_keeps_recreated_session():
+    budget = SessionBudget(max_sessions=10)
+    manager = FakeManager()
+    old, new = make_session("a", "old"), make_session("a", "new!")
+    budget.touch(manager, old)
+    budget.touch(manager, new)
+    budget.remove(manager, "a", old)
+    assert budget.get_metrics()["sessions"] == 1
+    budget.remove(manager, "a", new)
+    assert budget.get_metrics() == {"sessions": 0, "bytes": 0, "evictions": 0}
+
+
+def test_session_size_is_incremental():
+    session = make_session("a", "abc")
+    session.add_reply("你好")
+    assert session.approx_size() == 9
+    session._pop(1)
+    assert session.approx_size() == 6
+    session.reset()
+    assert session.approx_size() == 0
+
+
+def test_expired_sessions_leave_budget():
+    manager = SessionManager(Session)
+    manager.budget = SessionBudget(max_sessions=10)
+    manager.sessions = ExpiredDict(0.05, on_expire=manager._session_expired)
+    manager.session_query("hello", "a")
+    assert manager.budget.get_metrics()["sessions"] == 1
+    time.sleep(0.1)
+    manager.session_query("hi", "b")
+    assert manager.budget.get_metrics() == {"sessions": 1, "bytes": 2, "evictions": 0}
+
+
+def test_max_entries_eviction_leaves_budget():
+    expired = []
+    cache = ExpiredDict(float("inf"), max_entries=2, on_expire=lambda key, value: expired.append((key, value)))
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["c"] = 3
+    assert expired == [("a", 1)]
+    del cache["b"]
+    assert expired == [("a", 1)]
+
+
+def test_sessions_waiting_for_reply_are_not_evicted():
+    budget = SessionBudget(max_sessions=2)
+    manager = FakeManager()
+    a, b, c = make_session("a"), make_session("b"), make_session("c")
+    a.pinned_until = time.monotonic() + 60
+    budget.touch(manager, a)
+    budget.touch(manager, b)
+    budget.touch(manager, c)
+    assert manager.evicted == ["b"]
+    a.pinned_until = 0
+    budget.touch(manager, make_session("d"))
+    assert manager.evicted == ["b", "a"]
+
+
+def test_pinned_between_query_and_reply():
+    manager = SessionManager(Session)
+    manager.budget = SessionBudget(max_sessions=1)
+    manager.session_query("hello", "a")
+    manager.session_query("hi", "b")
+    assert "a" in manager.sessions  # 还在等待回复，超出预算也保留
+    manager.session_reply("hello back", "a")
+    manager.session_reply("hi back", "b")
+    assert "a" not in manager.sessions
+    assert [item.content for item in manager.sessions["b"].messages[-2:]] == ["hi", "hi back"]
@@ -0,0 +1,29 @@
+from bot.session_manager import Session
+from bot.session_store import SqliteSessionStore
+
+
+class CountingSession(Session):
+    def __init__(self, session_id, system_prompt=None):
+        super().__init__(session_id, system_prompt)
+        self.dumps = 0
+
+    def dump(self):
+        self.dumps += 1
+        return super().dump()
+
+
+def test_saves_are_dumped_when_written(tmp_path):
+    store = SqliteSessionStore(str(tmp_path / "sessions.db"))
+    session = CountingSession("a", "prompt")
+    session.reset()
+    with store.cond:  # 暂停后台写入，多次保存合并为一次
+        for i in range(10):
+            session.add_query("question {}".format(i))
+            store.save("Session", "a", session)
+        assert session.dumps == 0
+    assert store.flush(5)
+    assert session.dumps == 1
+    record = store.load("Session", "a")
+    assert record["messages"][-1] == ["user", "question 9"]
+    store.delete("Session", "a")
+    assert store.load("Session", "a") is None
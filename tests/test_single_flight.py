@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from common.single_flight import SingleFlight, payload_key
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_payload_key_depends_on_content_only():
+    assert payload_key("k", [{"role": "user", "content": "hi"}], {"b": 1, "a": 2}) == payload_key("k", [{"content": "hi", "role": "user"}], {"a": 2, "b": 1})
+    assert payload_key("k", "hi") != payload_key("k", "hi ")
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight("test")
+    release = threading.Event()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        release.wait(5)
+        return value * 2
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        leader = pool.submit(flight.do, "key", slow, 21)
+        wait_until(lambda: calls)
+        followers = [pool.submit(flight.do, "key", slow, 21) for _ in range(3)]
+        wait_until(lambda: flight.get_metrics()["followers"] == 3)
+        release.set()
+        assert [future.result() for future in [leader] + followers] == [42] * 4
+    assert calls == [21]
+    assert flight.get_metrics() == {"inflight": 0, "leaders": 1, "followers": 3}
+
+
+def test_exception_reaches_all_waiters():
+    flight = SingleFlight("test")
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise ValueError("upstream error")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(flight.do, "key", failing)
+        wait_until(lambda: flight.get_metrics()["inflight"])
+        follower = pool.submit(flight.do, "key", failing)
+        wait_until(lambda: flight.get_metrics()["followers"])
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_finished_calls_are_not_reused():
+    flight = SingleFlight("test")
+    results = iter([1, 2])
+    assert flight.do("key", lambda: next(results)) == 1
+    assert flight.do("key", lambda: next(results)) == 2
+    assert flight.get_metrics()["leaders"] == 2
+
+
+def test_async_followers_share_the_leader():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "reply"
+
+    async def main():
+        return await asyncio.gather(*[flight.do_async("key", slow) for _ in range(3)])
+
+    assert asyncio.run(main()) == ["reply"] * 3
+    assert calls == [1]
+
+
+def test_cancelled_follower_does_not_affect_others():
+    flight = SingleFlight("test")
+
+    async def slow():
+        await asyncio.sleep(0.1)
+        return "reply"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do_async("key", slow))
+        await asyncio.sleep(0.01)
+        cancelled = asyncio.ensure_future(flight.do_async("key", slow))
+        follower = asyncio.ensure_future(flight.do_async("key", slow))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        return await leader, await follower
+
+    assert asyncio.run(main()) == ("reply", "reply")
+    assert flight.get_metrics()["inflight"] == 0
+
+
+def test_cancelled_leader_hands_over_to_a_follower():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "reply"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do_async("key", slow))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.ensure_future(flight.do_async("key", slow)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+
+    assert asyncio.run(main()) == ["reply", "reply"]
+    assert len(calls) == 2
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from common.token_bucket import TokenBucket
+
+
+def test_burst_up_to_capacity_then_refuse():
+    bucket = TokenBucket(60, capacity=3)
+    assert all(bucket.get_token(timeout=0) for _ in range(3))
+    assert not bucket.get_token(timeout=0)
+
+
+def test_refills_with_elapsed_time():
+    bucket = TokenBucket(600, capacity=1)  # 每秒10个
+    assert bucket.get_token(timeout=0)
+    assert not bucket.get_token(timeout=0)
+    time.sleep(0.12)
+    assert bucket.get_token(timeout=0)
+
+
+def test_waits_for_reserved_tokens():
+    bucket = TokenBucket(600, capacity=1)
+    assert bucket.get_token()
+    start = time.monotonic()
+    assert bucket.get_token(timeout=1)
+    assert 0.05 <= time.monotonic() - start < 0.5
+
+
+def test_refused_request_reserves_nothing():
+    bucket = TokenBucket(60, capacity=10)
+    assert not bucket.get_token(100, timeout=1)
+    assert bucket.get_token(10, timeout=0)
+
+
+def test_weighted_tokens_and_charge():
+    bucket = TokenBucket(6000, capacity=1000)
+    assert bucket.get_token(800, timeout=0)
+    assert not bucket.get_token(300, timeout=0)
+    bucket.charge(-500)  # 实际用量少于预估，退还
+    assert bucket.get_token(300, timeout=0)
+    bucket.charge(2000)  # 实际用量多于预估，扣成负数后需要等待
+    assert not bucket.get_token(1, timeout=0)
+
+
+def test_charge_does_not_exceed_capacity():
+    bucket = TokenBucket(60, capacity=5)
+    bucket.charge(-100)
+    assert bucket.get_token(5, timeout=0)
+    assert not bucket.get_token(1, timeout=0)
+
+
+def test_get_token_async_waits_without_blocking_the_loop():
+    bucket = TokenBucket(600, capacity=1)
+    assert bucket.get_token()
+
+    async def main():
+        ticks = []
+
+        async def tick():
+            for _ in range(3):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        results = await asyncio.gather(bucket.get_token_async(timeout=1), tick())
+        return results[0], ticks
+
+    ok, ticks = asyncio.run(main())
+    assert ok
+    assert len(ticks) == 3
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import pytest
+
+from common.circuit_breaker import CircuitBreaker
+from common.upstream_pool import Endpoint, UpstreamPool
+
+
+def test_cancelled_wait_undoes_the_reservation():
+    endpoint = Endpoint("sk-endpoint-0", rate_limit=1, rate_limit_tpm=1000)
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    endpoint.breaker = breaker
+    pool = UpstreamPool([endpoint])
+    pool.release(pool.acquire(10), latency=0.1)  # 用完每分钟1次的额度，探测成功后熔断器关闭
+    breaker.record_failure()
+    time.sleep(0.02)  # 重新进入半开
+
+    async def main():
+        task = asyncio.ensure_future(pool.acquire_async(10))
+        await asyncio.sleep(0.05)
+        assert endpoint.outstanding == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert endpoint.outstanding == 0
+    assert endpoint.requests == 1
+    assert endpoint.rpm.tokens > -0.5  # 预扣的请求数已退还
+    assert endpoint.tpm.tokens > 980
+    assert breaker.available()  # 探测名额已归还
+
+
+class RateLimitError(Exception):
+    pass
+
+
+def make_pool(*endpoints, **kwargs):
+    for endpoint in endpoints:
+        endpoint.breaker = None
+    return UpstreamPool(list(endpoints), **kwargs)
+
+
+def test_selects_least_outstanding_per_weight():
+    a, b = Endpoint("sk-endpoint-a"), Endpoint("sk-endpoint-b", weight=2)
+    pool = make_pool(a, b)
+    chosen = [pool.acquire() for _ in range(6)]
+    assert chosen.count(a) == 2 and chosen.count(b) == 4  # 按权重分配进行中的请求
+    for endpoint in chosen[:3]:
+        pool.release(endpoint, latency=0.1)
+    assert a.outstanding + b.outstanding == 3
+
+
+def test_equal_load_prefers_lower_latency():
+    a, b = Endpoint("sk-endpoint-a"), Endpoint("sk-endpoint-b")
+    pool = make_pool(a, b)
+    pool.release(pool.acquire(), latency=2)
+    assert a.latency == 2
+    assert pool.acquire() is b
+
+
+def test_latency_is_ewma():
+    a = Endpoint("sk-endpoint-a")
+    pool = make_pool(a, ewma_alpha=0.5)
+    for latency in (1, 3, 3):
+        pool.release(pool.acquire(), latency=latency)
+    assert a.latency == pytest.approx(2.5)
+
+
+def test_rate_limited_endpoint_cools_down():
+    a, b = Endpoint("sk-endpoint-a"), Endpoint("sk-endpoint-b")
+    pool = make_pool(a, b, cooldown=0.05)
+    pool.release(pool.acquire(), error=RateLimitError("429"))
+    assert a.rate_limited == 1
+    assert [pool.acquire() for _ in range(3)] == [b, b, b]
+    pool.release(pool.acquire(), error=RateLimitError("429"))
+    assert pool.acquire() is a  # 都在冷却时选择最早恢复的
+    time.sleep(0.06)
+    assert not any(item["cooling_down"] for item in pool.get_metrics())
+
+
+def test_endpoint_rpm_limit_moves_requests_to_others():
+    a, b = Endpoint("sk-endpoint-a", rate_limit=2), Endpoint("sk-endpoint-b", weight=0.5)
+    pool = make_pool(a, b)
+    chosen = [pool.acquire() for _ in range(4)]
+    assert chosen.count(a) == 2
+    assert chosen[2:] == [b, b]
+
+
+def test_endpoint_tpm_limit_and_settlement():
+    a, b = Endpoint("sk-endpoint-a", rate_limit_tpm=100), Endpoint("sk-endpoint-b", weight=0.5)
+    pool = make_pool(a, b)
+    assert pool.limits_tokens
+    first = pool.acquire(80)
+    assert first is a
+    assert pool.acquire(80) is b  # a的token额度不足
+    pool.release(first, latency=0.1, tokens_delta=-60)  # 实际只用了20
+    assert pool.acquire(60) is a
+
+
+def test_waits_on_least_loaded_when_all_limits_are_used():
+    a = Endpoint("sk-endpoint-a", rate_limit=600)
+    pool = make_pool(a)
+    a.rpm.charge(a.rpm.tokens + 1)  # 额度用完，约0.2秒后恢复1个
+    start = time.monotonic()
+    assert pool.acquire() is a
+    assert time.monotonic() - start > 0.05
+    assert a.outstanding == 1
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("wechaty")
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from channel.wechat.wechaty_channel import WechatyChannel
+
+
+class FakeReceiver(object):
+    def __init__(self):
+        self.said = []
+
+    async def say(self, msg):
+        self.said.append(msg)
+
+
+class FakeFinder(object):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    async def find(self, receiver_id):
+        return self.receiver
+
+
+class FakeBot(object):
+    def __init__(self, receiver):
+        self.Contact = FakeFinder(receiver)
+        self.Room = FakeFinder(receiver)
+
+
+def test_send_from_thread_without_event_loop():
+    # 回复在发送调度器的线程中发送，这些线程没有事件循环
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    receiver = FakeReceiver()
+    channel = WechatyChannel()
+    channel.handler_loop = loop
+    channel.bot = FakeBot(receiver)
+    errors = []
+
+    def send():
+        try:
+            channel.send(Reply(ReplyType.TEXT, "hello"), Context(ContextType.TEXT, "hi", {"receiver": "user", "isgroup": False}))
+        except Exception as e:
+            errors.append(e)
+
+    sender = threading.Thread(target=send, name="outbound-WechatyChannel-0")
+    sender.start()
+    sender.join(5)
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join(5)
+    assert errors == []
+    assert receiver.said == ["hello"]